@@ -0,0 +1,219 @@
+"""
+Process wide caches, shared between requests.
+
+This module must not import QGIS, so it can be used from anywhere in the plugin.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, List, Tuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'weight'])
+
+_MISSING = object()
+
+
+class LRUCache:
+
+    def __init__(self, maxsize: int = 100, ttl: float = 0, max_weight: int = 0, grace: float = 0) -> None:
+        """ Bounded and thread safe LRU cache, with an optional time to live.
+
+        :param maxsize: Maximum number of entries, the least recently used one is dropped first.
+        :param ttl: Number of seconds an entry is valid, 0 means no expiration.
+        :param max_weight: Maximum total weight of entries, for instance a memory budget in bytes.
+            0 means no limit.
+        :param grace: Number of seconds after the TTL an expired entry is kept, to be returned by get_stale.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.grace = grace
+        self.max_weight = max_weight
+        self.weight = 0
+        # key -> (value, creation time, weight)
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_expired(self, created: float) -> bool:
+        """ If an entry created at the given time is expired. """
+        return self.ttl > 0 and time.monotonic() - created > self.ttl
+
+    def _is_too_old(self, created: float) -> bool:
+        """ If an entry created at the given time is expired, even for get_stale. """
+        return self.ttl > 0 and time.monotonic() - created > self.ttl + self.grace
+
+    def _lookup(self, key: Hashable) -> Any:
+        """ The entry for the key, removed if too old even for get_stale, the lock must be acquired. """
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return entry
+
+        if self._is_too_old(entry[1]):
+            self._remove(key)
+            return _MISSING
+
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Return the value for the key, or the default value if missing or expired. """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is _MISSING or self._is_expired(entry[1]):
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Tuple[Any, bool]:
+        """ Return the value for the key, even if expired during the grace period.
+
+        :returns: The value, or the default value if missing, and if the value is expired.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is _MISSING:
+                self.misses += 1
+                return default, False
+
+            self.hits += 1
+            return entry[0], self._is_expired(entry[1])
+
+    def set(self, key: Hashable, value: Any, weight: int = 1) -> None:
+        """ Store the value for the key, dropping the least recently used entries if needed.
+
+        An entry heavier than the maximum weight is not stored.
+        """
+        if self.maxsize <= 0:
+            return
+
+        if 0 < self.max_weight < weight:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, time.monotonic(), weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (0 < self.max_weight < self.weight):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key: Hashable) -> None:
+        """ Remove the key, the lock must be acquired. """
+        entry = self._data.pop(key, _MISSING)
+        if entry is not _MISSING:
+            self.weight -= entry[2]
+
+    def pop(self, key: Hashable) -> None:
+        """ Remove the key from the cache, if present. """
+        with self._lock:
+            self._remove(key)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]) -> int:
+        """ Remove all entries with a key matching the predicate.
+
+        :returns: The number of removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def items(self, predicate: Callable[[Hashable], bool]) -> List[Tuple[Hashable, Any]]:
+        """ Keys and values of the entries with a key matching the predicate, even if expired.
+
+        Counters and the order of the entries are not changed.
+        """
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._data.items() if predicate(key)]
+
+    def replace(self, key: Hashable, value: Any) -> bool:
+        """ Replace the value of a key, keeping its creation time and its weight.
+
+        :returns: If the key was in the cache.
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return False
+            self._data[key] = (value, entry[1], entry[2])
+            return True
+
+    def clear(self) -> None:
+        """ Remove all entries and reset counters. """
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        """ Statistics about the cache, like functools.lru_cache. """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data), self.weight)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            return entry is not _MISSING and not self._is_expired(entry[1])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class BackgroundRefresh:
+
+    def __init__(self, max_workers: int = 1) -> None:
+        """ Compute values in background threads, at most once at a time for a given key.
+
+        :param max_workers: Maximum number of threads, started when needed.
+        """
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        # Keys being computed
+        self._pending = set()
+
+    def submit(self, key: Hashable, function: Callable[[], None]) -> bool:
+        """ Call the function in a background thread, if the key is not already being computed.
+
+        :returns: If the function has been submitted.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='lizmap-refresh')
+            self._pending.add(key)
+            self._executor.submit(self._run, key, function)
+        return True
+
+    def _run(self, key: Hashable, function: Callable[[], None]) -> None:
+        try:
+            function()
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def pending(self) -> int:
+        """ Number of keys being computed. """
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self) -> None:
+        """ Wait for running computations and stop the threads. """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
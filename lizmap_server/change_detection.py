@@ -0,0 +1,282 @@
+"""
+Detect when the data behind a layer has changed, to invalidate caches.
+
+A stamp is computed for a layer, a cached entry is still valid while the stamp of the layer is the same.
+A stamp is None if the change can not be detected, the entry is then only valid during the TTL of the cache.
+
+* For files, the modification time, the size and the inode are used.
+* For PostgreSQL tables, a change token can be read with the SQL query given in
+  QGIS_SERVER_LIZMAP_CHANGE_TOKEN_SQL, at most every QGIS_SERVER_LIZMAP_CHANGE_TOKEN_INTERVAL seconds.
+  The query can use {schema} and {table} as quoted identifiers and {name} as the literal 'schema.table', eg :
+  SELECT max(updated_at) FROM {schema}.{table}
+  SELECT counter FROM lizmap.changes WHERE relation = {name}
+* For PostgreSQL tables, with psycopg2, the channel QGIS_SERVER_LIZMAP_CHANGE_NOTIFY_CHANNEL can be listened.
+  The payload of a notification is the name 'schema.table' of the edited table, or empty for all tables, eg :
+  NOTIFY lizmap_changes, 'public.townhalls'
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import os
+import select
+import threading
+import time
+
+from collections import defaultdict, namedtuple
+from typing import Callable, List, Tuple, Union
+
+from qgis.core import QgsDataSourceUri, QgsProviderRegistry, QgsVectorLayer
+
+from lizmap_server.logger import Logger
+from lizmap_server.tools import env_number
+
+try:
+    import psycopg2
+    HAS_PSYCOPG2 = True
+except ImportError:
+    HAS_PSYCOPG2 = False
+
+CHANGE_TOKEN_SQL = os.getenv('QGIS_SERVER_LIZMAP_CHANGE_TOKEN_SQL', '')
+CHANGE_TOKEN_INTERVAL = env_number('QGIS_SERVER_LIZMAP_CHANGE_TOKEN_INTERVAL', 1.0)
+NOTIFY_CHANNEL = os.getenv('QGIS_SERVER_LIZMAP_CHANGE_NOTIFY_CHANNEL', '')
+NOTIFY_RECONNECT_DELAY = 5.0
+
+# A cached value, with the stamp of the data used to compute it
+Stamped = namedtuple('Stamped', ['stamp', 'value'])
+
+
+def file_stamp(path: str) -> Union[Tuple[int, int, int], None]:
+    """ Modification time, size and inode of a file, None if the file is not found.
+
+    The inode changes if the file is replaced by another one, even with the same modification time and size.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def layer_source_stamp(layer: QgsVectorLayer) -> Union[Tuple, None]:
+    """ Modification stamp of the files behind a layer.
+
+    None if the layer is not stored in a file, or if the file is not found.
+    """
+    if layer.providerType() not in ('ogr', 'spatialite'):
+        return None
+
+    # noinspection PyArgumentList
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    if not path:
+        return None
+
+    stamp = file_stamp(path)
+    if stamp is None:
+        return None
+
+    # The write-ahead log of a GeoPackage is modified before the file itself
+    return stamp + (file_stamp(path + '-wal'), )
+
+
+def layer_change_token(layer: QgsVectorLayer) -> Union[str, None]:
+    """ The change token of a PostgreSQL table, it can be stored as it does not depend on the process.
+
+    None if the layer is not a PostgreSQL table, or if there is no change token.
+    """
+    if layer.providerType() != 'postgres':
+        return None
+
+    uri = QgsDataSourceUri(layer.source())
+    if uri.table().startswith('('):
+        return None
+
+    return CHANGE_TOKENS.token(uri.connectionInfo(False), uri.schema(), uri.table())
+
+
+def layer_stamp(layer: QgsVectorLayer) -> Union[Tuple, None]:
+    """ Modification stamp of the data behind a layer, from files or from PostgreSQL.
+
+    None if changes of the layer can not be detected.
+    """
+    if layer.providerType() != 'postgres':
+        return layer_source_stamp(layer)
+
+    uri = QgsDataSourceUri(layer.source())
+    if uri.table().startswith('('):
+        # A SQL query, the tables are unknown
+        return None
+
+    connection_info = uri.connectionInfo(False)
+    token = CHANGE_TOKENS.token(connection_info, uri.schema(), uri.table())
+    generation = NOTIFICATIONS.generation(connection_info, uri.schema(), uri.table(), uri.connectionInfo(True))
+    if token is None and generation is None:
+        return None
+    return token, generation
+
+
+def _quoted_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _quoted_literal(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def _execute_sql(connection_info: str, sql: str) -> List:
+    """ Execute the query like the other queries of the filter by polygon. """
+    # Imported here, the filter by polygon uses this module
+    from lizmap_server.filter_by_polygon import execute_sql
+    return execute_sql(QgsDataSourceUri(connection_info), sql)
+
+
+class ChangeTokens:
+
+    def __init__(
+            self, sql_template: str, interval: float,
+            execute: Callable[[str, str], List] = _execute_sql) -> None:
+        """ Change tokens of PostgreSQL tables, read with a SQL query.
+
+        :param sql_template: The query returning the token of a table, empty to disable the tokens.
+        :param interval: Number of seconds a token is kept before reading it again.
+        :param execute: Function executing a SQL query for a connection, returning the rows.
+        """
+        self.sql_template = sql_template
+        self.interval = interval
+        self.execute = execute
+        self._lock = threading.Lock()
+        # (connection, schema, table) -> (read time, token)
+        self._tokens = {}
+
+    def token(self, connection_info: str, schema: str, table: str) -> Union[str, None]:
+        """ The current token of the table, None if it is not available. """
+        if not self.sql_template:
+            return None
+
+        key = (connection_info, schema, table)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tokens.get(key)
+        if entry is not None and now - entry[0] < self.interval:
+            return entry[1]
+
+        sql = self.sql_template.format(
+            schema=_quoted_identifier(schema),
+            table=_quoted_identifier(table),
+            name=_quoted_literal('{}.{}'.format(schema, table)),
+        )
+        # noinspection PyBroadException
+        try:
+            rows = self.execute(connection_info, sql)
+        except Exception as e:
+            Logger.warning("The change token of the table {}.{} can not be read : {}".format(schema, table, e))
+            return None
+
+        # Read as text, the type of the token depends on the query
+        token = str(rows[0][0]) if rows and rows[0] else ''
+        with self._lock:
+            self._tokens[key] = (now, token)
+        return token
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+
+class ChangeNotifications:
+
+    def __init__(self, channel: str, reconnect_delay: float = NOTIFY_RECONNECT_DELAY) -> None:
+        """ Generations of PostgreSQL tables, incremented by notifications.
+
+        A thread listens to the channel for each database.
+
+        :param channel: The channel to listen, empty to disable the notifications.
+        :param reconnect_delay: Number of seconds to wait before connecting again, if the connection is lost.
+        """
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # (connection, name) -> generation, the name is empty for all tables of the database
+        self._generations = defaultdict(int)
+        # connection -> thread
+        self._listeners = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.channel) and HAS_PSYCOPG2
+
+    def generation(self, connection_info: str, schema: str, table: str, dsn: str = None) -> Union[Tuple, None]:
+        """ The current generation of the table, None if notifications are not enabled.
+
+        :param connection_info: The connection, as used in the pool
+        :param schema: The schema of the table
+        :param table: The table
+        :param dsn: The connection string for psycopg2, with credentials, by default the connection
+        """
+        if not self.enabled:
+            return None
+
+        self.listen(connection_info, dsn or connection_info)
+        with self._lock:
+            return (
+                self._generations[(connection_info, '')],
+                self._generations[(connection_info, '{}.{}'.format(schema, table))],
+            )
+
+    def notify(self, connection_info: str, payload: str) -> None:
+        """ A table has been edited, or all tables if the payload is empty. """
+        with self._lock:
+            self._generations[(connection_info, payload.strip())] += 1
+
+    def listen(self, connection_info: str, dsn: str) -> None:
+        """ Start listening to the channel for this database, if not done yet. """
+        with self._lock:
+            if connection_info in self._listeners:
+                return
+            thread = threading.Thread(
+                target=self._listen, args=(connection_info, dsn), name='lizmap-notify', daemon=True)
+            self._listeners[connection_info] = thread
+        thread.start()
+
+    def _listen(self, connection_info: str, dsn: str) -> None:
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = psycopg2.connect(dsn, application_name='QGIS Lizmap Server : Change detection')
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN {};'.format(_quoted_identifier(self.channel)))
+                # Notifications might have been missed before, everything must be checked again
+                self.notify(connection_info, '')
+                Logger.info("Listening to PostgreSQL notifications on the channel {}".format(self.channel))
+
+                while not self._stop.is_set():
+                    if select.select([connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.notify(connection_info, connection.notifies.pop(0).payload)
+            except psycopg2.Error as e:
+                Logger.warning("Error while listening to PostgreSQL notifications : {}".format(e))
+                # Changes are missed while the connection is lost
+                self.notify(connection_info, '')
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def stop(self) -> None:
+        """ Stop all listening threads. """
+        self._stop.set()
+        with self._lock:
+            listeners = list(self._listeners.values())
+            self._listeners.clear()
+        for thread in listeners:
+            thread.join()
+        self._stop.clear()
+
+
+CHANGE_TOKENS = ChangeTokens(CHANGE_TOKEN_SQL, CHANGE_TOKEN_INTERVAL)
+NOTIFICATIONS = ChangeNotifications(NOTIFY_CHANNEL)
@@ -0,0 +1,146 @@
+"""
+The Lizmap config compiled once for each version of the CFG file.
+
+Access control hooks are called for each layer of each request, they read these lookup tables instead of walking
+the raw JSON config.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+from collections import namedtuple
+from typing import Dict, FrozenSet, Iterable, Union
+
+from lizmap_server.logger import Logger
+from lizmap_server.tools import to_bool
+
+# name : the layer name, key of the Lizmap config layers
+# id : the layer ID, None if not given
+# group_visibility : frozenset of groups allowed to see the layer, None if the layer is visible by everyone
+LayerConfig = namedtuple('LayerConfig', ['name', 'id', 'group_visibility'])
+
+# acl : frozenset of groups allowed to edit the layer, None if any group can edit it
+# can_insert, can_update, can_delete : the capabilities, False if not defined
+EditionConfig = namedtuple('EditionConfig', ['acl', 'can_insert', 'can_update', 'can_delete'])
+
+# layer_id : the layer ID
+# attribute : the field with the user login or the user group
+# private : if the layer is filtered by the user login, otherwise by the user groups
+# edition_only : if the filter is only used for editing, the layer is not filtered
+LoginFilter = namedtuple('LoginFilter', ['layer_id', 'attribute', 'private', 'edition_only'])
+
+# The filter by polygon configuration of a layer
+PolygonFilterLayer = namedtuple(
+    'PolygonFilterLayer', ['layer_id', 'primary_key', 'filter_mode', 'spatial_relationship'])
+
+
+def parse_groups(value: Union[str, Iterable[str], None]) -> Union[FrozenSet[str], None]:
+    """ Groups from a list or from a comma separated string, None if no group is given. """
+    if not value:
+        return None
+
+    if isinstance(value, str):
+        value = value.split(',')
+
+    return frozenset(g.strip() for g in value)
+
+
+def polygon_filter_layers(config: Union[Dict, None]) -> Dict[str, PolygonFilterLayer]:
+    """ The layers filtered by polygon, by layer ID.
+
+    :param config: The filter by polygon configuration as dictionary
+    """
+    if not config or not config.get('layers'):
+        return {}
+
+    layers = {}
+    for layer in config['layers']:
+        if not isinstance(layer, dict) or not layer.get('layer'):
+            Logger.warning("A layer in the filter by polygon config has no layer ID, it is ignored")
+            continue
+
+        # The first entry is used if the layer is given several times
+        layers.setdefault(layer['layer'], PolygonFilterLayer(
+            layer_id=layer['layer'],
+            primary_key=layer.get('primary_key'),
+            filter_mode=layer.get('filter_mode'),
+            spatial_relationship=layer.get('spatial_relationship'),
+        ))
+    return layers
+
+
+class CompiledConfig:
+
+    def __init__(self, config: Dict) -> None:
+        """ Lookup tables built from the Lizmap config.
+
+        :param config: The Lizmap config as dictionary, it must not be modified afterwards.
+        """
+        self.config = config
+
+        # Groups allowed to use the project, None if there is no restriction
+        options = config.get('options')
+        self.acl = parse_groups(options.get('acl')) if isinstance(options, dict) else None
+
+        self.layers_by_name = {}
+        self.layers_by_id = {}
+        layers = config.get('layers')
+        if isinstance(layers, dict):
+            for name, layer in layers.items():
+                if not isinstance(layer, dict):
+                    continue
+
+                group_visibility = parse_groups(layer.get('group_visibility'))
+                if group_visibility == frozenset(['']):
+                    # The group visibility was just an empty string
+                    group_visibility = None
+
+                layer_config = LayerConfig(name=name, id=layer.get('id'), group_visibility=group_visibility)
+                self.layers_by_name[name] = layer_config
+                if layer_config.id:
+                    self.layers_by_id[layer_config.id] = layer_config
+
+        # If at least one layer is not visible by everyone, the cache key depends on the groups
+        self.has_group_visibility = any(
+            layer.group_visibility is not None for layer in self.layers_by_name.values())
+
+        self.edition_layers = {}
+        edition_layers = config.get('editionLayers')
+        if isinstance(edition_layers, dict):
+            for layer_id, layer in edition_layers.items():
+                if not layer or not isinstance(layer, dict):
+                    continue
+
+                capabilities = layer.get('capabilities') or {}
+                self.edition_layers[layer_id] = EditionConfig(
+                    acl=parse_groups(layer.get('acl')),
+                    can_insert=to_bool(capabilities.get('createFeature')),
+                    can_update=any([
+                        to_bool(capabilities.get('modifyAttribute')),
+                        to_bool(capabilities.get('modifyGeometry')),
+                    ]),
+                    can_delete=to_bool(capabilities.get('deleteFeature')),
+                )
+
+        self.login_filters = {}
+        login_filtered_layers = config.get('loginFilteredLayers')
+        if isinstance(login_filtered_layers, dict):
+            for name, layer in login_filtered_layers.items():
+                if not layer:
+                    continue
+
+                if not isinstance(layer, dict) or not {'layerId', 'filterAttribute', 'filterPrivate'} <= layer.keys():
+                    # loginFilteredLayers for layer not well formed
+                    Logger.warning("loginFilteredLayers for layer {} not well formed".format(name))
+                    continue
+
+                self.login_filters[name] = LoginFilter(
+                    layer_id=layer['layerId'],
+                    attribute=layer['filterAttribute'],
+                    private=to_bool(layer['filterPrivate']),
+                    edition_only=to_bool(layer.get('edition_only', False)),
+                )
+
+        self.filter_by_polygon = config.get('filter_by_polygon')
+        self.polygon_filter_layers = polygon_filter_layers(self.filter_by_polygon)
@@ -0,0 +1,246 @@
+"""
+Process wide pool of database connections, shared between requests.
+
+This module must not import QGIS, the function creating a connection is given to the pool.
+
+PostgreSQL connections are psycopg2 connections, each one holding its own socket. QGIS connections made with
+QgsAbstractDatabaseProviderConnection are not pooled here, QGIS already borrows a connection from the pool of its
+provider for each query.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import threading
+import time
+
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from typing import Any, Callable, List, Union
+
+try:
+    import psycopg2
+    HAS_PSYCOPG2 = True
+except ImportError:
+    HAS_PSYCOPG2 = False
+
+PoolInfo = namedtuple('PoolInfo', ['created', 'reused', 'discarded', 'idle', 'in_use'])
+
+
+class ConnectionPoolError(Exception):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(
+            self,
+            factory: Callable[[str], Any],
+            max_size: int = 4,
+            idle_timeout: float = 300,
+            health_check: Union[Callable[[Any], None], None] = None,
+            health_check_interval: float = 30,
+            acquire_timeout: float = 30,
+            close: Union[Callable[[Any], None], None] = None,
+    ) -> None:
+        """ Pool of connections, keyed by connection URI.
+
+        :param factory: Function creating a new connection for the given URI.
+        :param max_size: Maximum number of connections for a given URI, idle or in use.
+        :param idle_timeout: Number of seconds before an idle connection is dropped, 0 to keep them.
+        :param health_check: Function raising an exception if the given connection is broken.
+        :param health_check_interval: A connection idle for more seconds is checked before its reuse.
+        :param acquire_timeout: Number of seconds to wait for a free connection.
+        :param close: Function closing a connection dropped by the pool.
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.close = close
+
+        self._condition = threading.Condition()
+        # uri -> list of (connection, released time), the most recent at the end
+        self._idle = defaultdict(list)
+        # uri -> number of connections in use
+        self._in_use = defaultdict(int)
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _close(self, connection: Any) -> None:
+        """ Close a dropped connection, errors are ignored as the connection might be broken. """
+        if self.close is None:
+            return
+
+        # noinspection PyBroadException
+        try:
+            self.close(connection)
+        except Exception:
+            pass
+
+    def _prune(self, uri: str) -> list:
+        """ Drop idle connections older than the idle timeout, the lock must be acquired.
+
+        :returns: The dropped connections, to be closed once the lock is released.
+        """
+        if self.idle_timeout <= 0:
+            return []
+
+        now = time.monotonic()
+        kept = [(c, t) for c, t in self._idle[uri] if now - t <= self.idle_timeout]
+        dropped = [c for c, t in self._idle[uri] if now - t > self.idle_timeout]
+        self.discarded += len(dropped)
+        self._idle[uri] = kept
+        return dropped
+
+    def acquire(self, uri: str) -> Any:
+        """ Take a connection from the pool, or create a new one. """
+        deadline = time.monotonic() + self.acquire_timeout
+        dropped = []
+        with self._condition:
+            while True:
+                dropped.extend(self._prune(uri))
+                if self._idle[uri]:
+                    connection, released = self._idle[uri].pop()
+                    break
+
+                if len(self._idle[uri]) + self._in_use[uri] < self.max_size:
+                    connection, released = None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionPoolError(
+                        "No database connection available after {} seconds".format(self.acquire_timeout))
+                self._condition.wait(remaining)
+
+            self._in_use[uri] += 1
+
+        for old in dropped:
+            self._close(old)
+
+        try:
+            if connection is not None and self.health_check is not None:
+                if time.monotonic() - released > self.health_check_interval:
+                    try:
+                        self.health_check(connection)
+                    except Exception:
+                        # Broken connection, let's create a new one
+                        with self._condition:
+                            self.discarded += 1
+                        self._close(connection)
+                        connection = None
+
+            if connection is None:
+                connection = self.factory(uri)
+                with self._condition:
+                    self.created += 1
+            else:
+                with self._condition:
+                    self.reused += 1
+        except Exception:
+            with self._condition:
+                self._in_use[uri] -= 1
+                self._condition.notify()
+            raise
+
+        return connection
+
+    def release(self, uri: str, connection: Any) -> None:
+        """ Give back a connection to the pool. """
+        with self._condition:
+            self._in_use[uri] -= 1
+            self._idle[uri].append((connection, time.monotonic()))
+            self._condition.notify()
+
+    def discard(self, uri: str, connection: Any) -> None:
+        """ Drop a connection which is not usable anymore. """
+        with self._condition:
+            self._in_use[uri] -= 1
+            self.discarded += 1
+            self._condition.notify()
+        self._close(connection)
+
+    @contextmanager
+    def connection(self, uri: str):
+        """ Context manager giving a connection, released when leaving.
+
+        If an exception is raised, the connection is discarded.
+        """
+        connection = self.acquire(uri)
+        try:
+            yield connection
+        except Exception:
+            self.discard(uri, connection)
+            raise
+        else:
+            self.release(uri, connection)
+
+    def clear(self) -> None:
+        """ Drop all idle connections. """
+        with self._condition:
+            dropped = [c for idle in self._idle.values() for c, _ in idle]
+            self.discarded += len(dropped)
+            self._idle.clear()
+
+        for connection in dropped:
+            self._close(connection)
+
+    def info(self) -> PoolInfo:
+        """ Statistics about the pool. """
+        with self._condition:
+            return PoolInfo(
+                self.created,
+                self.reused,
+                self.discarded,
+                sum(len(v) for v in self._idle.values()),
+                sum(self._in_use.values()),
+            )
+
+
+def connect_postgres(dsn: str, application_name: str = 'QGIS Lizmap Server') -> Any:
+    """ New psycopg2 connection, for a pool keyed by the libpq connection string. """
+    return psycopg2.connect(dsn, application_name=application_name)
+
+
+def check_postgres(connection: Any) -> None:
+    """ Raise an exception if the psycopg2 connection is broken. """
+    if connection.closed:
+        raise ConnectionPoolError("The connection is closed")
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1;")
+    connection.rollback()
+
+
+def close_postgres(connection: Any) -> None:
+    """ Close the psycopg2 connection. """
+    connection.close()
+
+
+def execute_postgres(pool: ConnectionPool, dsn: str, sql: str, statement_timeout: float = 0) -> List[tuple]:
+    """ Execute a read only query with a psycopg2 connection from the pool.
+
+    The query is run in its own transaction, rolled back at the end, so the statement timeout does not stay on
+    the connection.
+
+    :param pool: The pool of psycopg2 connections
+    :param dsn: The libpq connection string
+    :param sql: The SQL query
+    :param statement_timeout: In milliseconds, 0 to disable
+    :returns: The rows, empty if the query does not return rows.
+    """
+    with pool.connection(dsn) as connection:
+        try:
+            with connection.cursor() as cursor:
+                if statement_timeout > 0:
+                    cursor.execute("SET LOCAL statement_timeout = {};".format(int(statement_timeout)))
+                cursor.execute(sql)
+                return cursor.fetchall() if cursor.description is not None else []
+        finally:
+            connection.rollback()
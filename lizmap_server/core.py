@@ -2,34 +2,66 @@ __copyright__ = 'Copyright 2021, 3Liz'
 __license__ = 'GPL version 3'
 __email__ = 'info@3liz.org'
 
-import json
 import os
+import time
+import xml.etree.ElementTree as ET
 
-from functools import lru_cache
+from collections import namedtuple
 from typing import Dict, Tuple, Union
 
 from qgis.core import (
     Qgis,
+    QgsCoordinateReferenceSystem,
     QgsExpression,
     QgsFeature,
     QgsFields,
     QgsMapLayer,
     QgsProject,
+    QgsRectangle,
+    QgsReferencedRectangle,
     QgsVectorDataProvider,
     QgsVectorLayer,
 )
+from qgis.PyQt.QtCore import QByteArray
 from qgis.server import QgsRequestHandler, QgsServerResponse
 
+from lizmap_server import json_backend
+from lizmap_server.cache import LRUCache
+from lizmap_server.change_detection import file_stamp
+from lizmap_server.compiled_config import CompiledConfig
 from lizmap_server.logger import Logger
-from lizmap_server.tools import to_bool
+from lizmap_server.tools import env_number, to_bool
+
+# Ratio of the width and height added around the extent of a request,
+# for symbols and labels of features just outside
+REQUEST_EXTENT_MARGIN = 0.25
+# Minimum tolerance in pixels around the point of a GetFeatureInfo
+GET_FEATURE_INFO_TOLERANCE = 64
+
+# Minimum number of seconds between two checks of the modification of a CFG file
+CONFIG_CHECK_INTERVAL = env_number('QGIS_SERVER_LIZMAP_CONFIG_CHECK_INTERVAL', 1.0)
+
+# stamp : the modification time, the size and the inode of the CFG file, None if it does not exist
+# checked : when the stamp has been checked, from time.monotonic()
+# config : the Lizmap config, None if not found
+# compiled : the Lizmap config compiled for the access control hooks, None if not found
+StoredConfig = namedtuple('StoredConfig', ['stamp', 'checked', 'config', 'compiled'])
+
+# Lizmap configs by QGIS project path, with a budget in bytes of CFG files
+CONFIG_STORE = LRUCache(
+    maxsize=env_number('QGIS_SERVER_LIZMAP_CONFIG_CACHE_SIZE', 100),
+    max_weight=env_number('QGIS_SERVER_LIZMAP_CONFIG_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+)
 
 
 def write_json_response(data: Dict[str, str], response: QgsServerResponse, code: int = 200) -> None:
     """ Write data as JSON response. """
     response.setStatusCode(code)
     response.setHeader("Content-Type", "application/json")
-    Logger.info("Sending JSON response : {}".format(data))
-    response.write(json.dumps(data))
+    # UTF-8 bytes, without an intermediate string
+    content = json_backend.dumps(data)
+    Logger.info("Sending JSON response : {} bytes".format(len(content)))
+    response.write(QByteArray(content))
 
 
 def find_vector_layer_from_params(params, project):
@@ -77,9 +109,45 @@ def get_server_fid(feature: QgsFeature, pk_attributes: list) -> str:
     return '@@'.join([str(feature.attribute(pk)) for pk in pk_attributes])
 
 
-@lru_cache(maxsize=100)
 def get_lizmap_config(qgis_project_path: str) -> Union[Dict, None]:
-    """ Get the lizmap config based on QGIS project path """
+    """ Get the lizmap config based on QGIS project path
+
+    The config is read again if the CFG file has been modified or replaced.
+    """
+    return _stored_lizmap_config(qgis_project_path).config
+
+
+def get_lizmap_compiled_config(qgis_project_path: str) -> Union[CompiledConfig, None]:
+    """ Get the lizmap config compiled for the access control hooks, built once per version of the CFG file """
+    return _stored_lizmap_config(qgis_project_path).compiled
+
+
+def _stored_lizmap_config(qgis_project_path: str) -> StoredConfig:
+    """ The lizmap config from the store, read again if the CFG file has been modified or replaced.
+
+    The CFG file is checked at most once every CONFIG_CHECK_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    stored = CONFIG_STORE.get(qgis_project_path)
+    if stored is not None and now - stored.checked < CONFIG_CHECK_INTERVAL:
+        return stored
+
+    stamp = file_stamp(qgis_project_path + '.cfg')
+    if stored is not None and stored.stamp == stamp:
+        stored = stored._replace(checked=now)
+    else:
+        # The stamp is read before the file, a file modified meanwhile is read again at the next check
+        config = _read_lizmap_config(qgis_project_path)
+        compiled = CompiledConfig(config) if isinstance(config, dict) else None
+        stored = StoredConfig(stamp, now, config, compiled)
+
+    # The size of the file as weight, the memory used by the config is proportional
+    CONFIG_STORE.set(qgis_project_path, stored, weight=stamp[1] if stamp else 0)
+    return stored
+
+
+def _read_lizmap_config(qgis_project_path: str) -> Union[Dict, None]:
+    """ Read the lizmap config from the CFG file """
 
     logger = Logger()
 
@@ -98,10 +166,11 @@ def get_lizmap_config(qgis_project_path: str) -> Union[Dict, None]:
         return None
 
     # Get Lizmap config
-    with open(config_path, 'r') as cfg_file:
+    with open(config_path, 'rb') as cfg_file:
         # noinspection PyBroadException
         try:
-            cfg = json.loads(cfg_file.read())
+            # UTF-8 bytes, decoded by the JSON backend
+            cfg = json_backend.loads(cfg_file.read())
             if not cfg:
                 # Lizmap config is empty
                 logger.warning("Lizmap config is empty")
@@ -321,6 +390,143 @@ def is_editing_context(handler: QgsRequestHandler) -> bool:
     return False
 
 
+def _parse_bbox(
+        bbox: str, crs: QgsCoordinateReferenceSystem, axis_order: bool) -> Union[QgsReferencedRectangle, None]:
+    """ Read a BBOX parameter.
+
+    :param bbox: The BBOX, as "xmin,ymin,xmax,ymax"
+    :param crs: The CRS of the BBOX
+    :param axis_order: If the axis order of the CRS must be followed, like in WMS 1.3.0
+    """
+    if not crs.isValid():
+        return None
+
+    try:
+        values = [float(v) for v in bbox.split(',')[0:4]]
+    except ValueError:
+        return None
+
+    if len(values) != 4:
+        return None
+
+    if axis_order and crs.hasAxisInverted():
+        values = [values[1], values[0], values[3], values[2]]
+
+    rectangle = QgsRectangle(*values)
+    if rectangle.isEmpty():
+        return None
+
+    return QgsReferencedRectangle(rectangle, crs)
+
+
+def _parse_filter_bbox(xml_filter: str) -> Union[QgsReferencedRectangle, None]:
+    """ Read the extent of an OGC filter made only of a BBOX. """
+    try:
+        root = ET.fromstring(xml_filter)
+    except ET.ParseError:
+        return None
+
+    # Only if the BBOX is the whole filter, otherwise it might be in a OR
+    if len(root) != 1 or not root[0].tag.endswith('BBOX'):
+        return None
+
+    for envelope in root[0]:
+        if envelope.tag.endswith('Envelope'):
+            corners = [c.text.split() for c in envelope if c.text]
+            if len(corners) != 2:
+                return None
+            bbox = ','.join(corners[0] + corners[1])
+        elif envelope.tag.endswith('Box'):
+            coordinates = [c.text for c in envelope if c.text]
+            if len(coordinates) != 1:
+                return None
+            bbox = coordinates[0].replace(' ', ',')
+        else:
+            continue
+
+        crs = QgsCoordinateReferenceSystem(envelope.attrib.get('srsName', ''))
+        if crs.hasAxisInverted():
+            # The axis order depends on the WFS version and on the CRS notation
+            return None
+        return _parse_bbox(bbox, crs, axis_order=False)
+
+    return None
+
+
+def get_request_extent(handler: QgsRequestHandler) -> Union[QgsReferencedRectangle, None]:
+    """ Extent of a WMS GetMap, WMS GetFeatureInfo or WFS GetFeature request, with a margin.
+
+    None if the request is not limited to an extent, or if the extent can not be read.
+    """
+    params = handler.parameterMap()
+    service = params.get('SERVICE', '').upper()
+    request = params.get('REQUEST', '').upper()
+
+    extent = None
+    if service == 'WMS' and request in ('GETMAP', 'GETFEATUREINFO'):
+        crs = QgsCoordinateReferenceSystem(params.get('CRS', params.get('SRS', '')))
+        extent = _parse_bbox(params.get('BBOX', ''), crs, params.get('VERSION', '1.3.0') == '1.3.0')
+
+        if extent is not None and request == 'GETFEATUREINFO':
+            if params.get('FILTER'):
+                # Features are selected with the filter, not with the extent
+                return None
+
+            try:
+                i = float(params.get('I', params.get('X')))
+                j = float(params.get('J', params.get('Y')))
+                width = float(params.get('WIDTH'))
+                height = float(params.get('HEIGHT'))
+            except (TypeError, ValueError):
+                return None
+
+            tolerance = GET_FEATURE_INFO_TOLERANCE
+            for key in ('FI_POINT_TOLERANCE', 'FI_LINE_TOLERANCE', 'FI_POLYGON_TOLERANCE'):
+                try:
+                    tolerance = max(tolerance, float(params.get(key, 0)))
+                except ValueError:
+                    pass
+
+            pixel_width = extent.width() / width
+            pixel_height = extent.height() / height
+            x = extent.xMinimum() + (i + 0.5) * pixel_width
+            y = extent.yMaximum() - (j + 0.5) * pixel_height
+            extent = QgsReferencedRectangle(
+                QgsRectangle(
+                    x - tolerance * pixel_width,
+                    y - tolerance * pixel_height,
+                    x + tolerance * pixel_width,
+                    y + tolerance * pixel_height,
+                ),
+                extent.crs())
+
+    elif service == 'WFS' and request == 'GETFEATURE':
+        bbox = params.get('BBOX')
+        if bbox:
+            values = bbox.split(',')
+            crs = QgsCoordinateReferenceSystem(values[4] if len(values) > 4 else params.get('SRSNAME', ''))
+            if crs.hasAxisInverted():
+                # The axis order depends on the WFS version and on the CRS notation
+                return None
+            extent = _parse_bbox(bbox, crs, axis_order=False)
+        elif params.get('FILTER'):
+            extent = _parse_filter_bbox(params.get('FILTER'))
+
+    if extent is None:
+        return None
+
+    margin_x = extent.width() * REQUEST_EXTENT_MARGIN
+    margin_y = extent.height() * REQUEST_EXTENT_MARGIN
+    return QgsReferencedRectangle(
+        QgsRectangle(
+            extent.xMinimum() - margin_x,
+            extent.yMinimum() - margin_y,
+            extent.xMaximum() + margin_x,
+            extent.yMaximum() + margin_y,
+        ),
+        extent.crs())
+
+
 def server_feature_id_expression(feature_id, data_provider: QgsVectorDataProvider) -> str:
     """ Fetch the QGIS server feature ID expression according to the current QGIS version. """
     if Qgis.QGIS_VERSION_INT >= 32400:
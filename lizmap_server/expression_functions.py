@@ -0,0 +1,145 @@
+"""
+Expression functions registered by the plugin.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+from collections import namedtuple
+from typing import Any, Iterable, Union
+
+from qgis.core import (
+    QgsExpressionContext,
+    QgsGeometry,
+    QgsGeometryEngine,
+    QgsProject,
+    qgsfunction,
+)
+
+from lizmap_server.cache import LRUCache
+from lizmap_server.logger import Logger
+from lizmap_server.request_context import current_request_context
+from lizmap_server.tools import env_number
+
+FUNCTION_GROUP = 'Lizmap'
+
+# The polygon of the user, in the CRS of the filtered layer, with a prepared engine
+UserPolygon = namedtuple('UserPolygon', ['source', 'geometry', 'engine', 'relationship'])
+
+# Filled by the filter by polygon before returning the expression using lizmap_in_user_polygon
+# One entry for each layer and group set, like the subset strings of the filter by polygon
+USER_POLYGONS = LRUCache(maxsize=env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_SIZE', 100))
+
+
+def joined_groups(groups: Union[str, Iterable[str], None]) -> str:
+    """ Sorted and deduplicated groups, separated by a comma. """
+    if not groups:
+        return ''
+    if isinstance(groups, str):
+        groups = groups.split(',')
+    return ','.join(sorted({g.strip() for g in groups if g.strip()}))
+
+
+def user_polygon_key(layer_id: str, groups: Union[str, Iterable[str]]) -> tuple:
+    """ Key of the polygon of the user, for the given filtered layer and user groups. """
+    # noinspection PyArgumentList
+    return QgsProject.instance().fileName(), layer_id, joined_groups(groups)
+
+
+def current_user_groups() -> str:
+    """ The groups of the user of the current request, separated by a comma.
+
+    They are not read from the expression context, an expression can change its variables with with_variable.
+    """
+    context = current_request_context()
+    if context is not None:
+        return joined_groups(context.groups)
+
+    # Outside of the Lizmap filter, the variable set on the project
+    # noinspection PyArgumentList
+    return joined_groups(QgsProject.instance().customVariables().get('lizmap_user_groups'))
+
+
+def lizmap_in_user_polygon(values: list, feature, parent, context: QgsExpressionContext) -> bool:
+    """
+    If the geometry is in the polygon of the current user, according to the filter by polygon.
+
+    <h4>Syntax</h4>
+    <p>lizmap_in_user_polygon(<i>geometry</i>[, <i>layer_id</i>, <i>groups</i>])</p>
+
+    <h4>Arguments</h4>
+    <p><i>  geometry</i>: a geometry, usually $geometry</p>
+    <p><i>  layer_id</i>: the filtered layer ID, the current layer by default</p>
+    <p><i>  groups</i>: the user groups separated by a comma, they must be the groups of the current user</p>
+
+    <h4>Example</h4>
+    <p><!-- Show example of function.-->
+         lizmap_in_user_polygon($geometry) → true</p>
+    """
+    _ = feature
+    if not values or len(values) > 3:
+        parent.setEvalErrorString('lizmap_in_user_polygon needs a geometry, a layer ID and groups')
+        return False
+
+    geometry = values[0]
+    if not isinstance(geometry, QgsGeometry) or geometry.isNull():
+        return False
+
+    layer_id = values[1] if len(values) > 1 else context.variable('layer_id')
+    # Always the groups of the request, the polygon of other groups must not be used
+    groups = current_user_groups()
+    if not layer_id or not groups:
+        return False
+
+    if len(values) > 2 and joined_groups(values[2]) != groups:
+        parent.setEvalErrorString('lizmap_in_user_polygon can only use the groups of the current user')
+        return False
+
+    user_polygon = USER_POLYGONS.get(user_polygon_key(layer_id, groups))
+    if user_polygon is None:
+        # Removed from the cache by another request, or never computed : computed again from the arguments
+        # Imported here, the filter by polygon imports this module
+        from lizmap_server.filter_by_polygon import user_polygon_for_groups
+        user_polygon = user_polygon_for_groups(layer_id, groups)
+
+    if user_polygon is None:
+        # Let's be safe, the filter by polygon can not be computed for this user
+        Logger.warning("No polygon for the user groups {} and the layer {}".format(groups, layer_id))
+        return False
+
+    if user_polygon.relationship == 'contains':
+        # Same relationship as the filter by polygon, the polygon contains the feature
+        return user_polygon.engine.contains(geometry.constGet())
+
+    return user_polygon.engine.intersects(geometry.constGet())
+
+
+def set_user_polygon(
+        layer_id: str, groups: Iterable[str], source: Any, geometry: QgsGeometry, engine: QgsGeometryEngine,
+        relationship: str) -> UserPolygon:
+    """ Store the polygon used by lizmap_in_user_polygon for the given layer and user groups.
+
+    :param layer_id: The filtered layer ID
+    :param groups: The user groups
+    :param source: Where the polygon comes from, to know if it has changed
+    :param geometry: The polygon in the CRS of the filtered layer, it must not be edited in place
+    :param engine: The prepared engine of the polygon
+    :param relationship: The spatial relationship, 'intersects' or 'contains'
+    """
+    user_polygon = UserPolygon(source, geometry, engine, relationship)
+    USER_POLYGONS.set(user_polygon_key(layer_id, groups), user_polygon)
+    return user_polygon
+
+
+def get_user_polygon(layer_id: str, groups: Iterable[str]) -> Union[UserPolygon, None]:
+    """ The polygon used by lizmap_in_user_polygon for the given layer and user groups, if any. """
+    return USER_POLYGONS.get(user_polygon_key(layer_id, groups))
+
+
+def register_expression_functions() -> None:
+    """ Register all expression functions of the plugin. """
+    # No referenced columns, the geometry is given as argument
+    qgsfunction(
+        args=-1, group=FUNCTION_GROUP, usesgeometry=False, referenced_columns=[], handlesnull=True,
+    )(lizmap_in_user_polygon)
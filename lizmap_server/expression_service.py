@@ -2,7 +2,6 @@ __copyright__ = 'Copyright 2021, 3Liz'
 __license__ = 'GPL version 3'
 __email__ = 'info@3liz.org'
 
-import json
 import traceback
 
 from typing import Dict
@@ -27,6 +26,7 @@ from qgis.server import (
     QgsService,
 )
 
+from lizmap_server import json_backend
 from lizmap_server.core import (
     find_vector_layer,
     get_lizmap_groups,
@@ -156,7 +156,7 @@ class ExpressionService(QgsService):
 
         # try to load expressions list or dict
         try:
-            exp_json = json.loads(expressions)
+            exp_json = json_backend.loads(expressions)
         except Exception:
             logger.critical(
                 "JSON loads expressions '{}' exception:\n{}".format(expressions, traceback.format_exc()))
@@ -233,7 +233,7 @@ class ExpressionService(QgsService):
                     result[k] = None
                     error[k] = exp.evalErrorString()
                 else:
-                    result[k] = json.loads(QgsJsonUtils.encodeValue(value))
+                    result[k] = json_backend.loads(QgsJsonUtils.encodeValue(value))
             body['results'].append(result)
             body['errors'].append(error)
             write_json_response(body, response)
@@ -241,7 +241,7 @@ class ExpressionService(QgsService):
 
         # Check features
         try:
-            geojson = json.loads(features)
+            geojson = json_backend.loads(features)
         except Exception:
             logger.critical(
                 "JSON loads features '{}' exception:\n{}".format(features, traceback.format_exc()))
@@ -318,7 +318,7 @@ class ExpressionService(QgsService):
                     result[k] = None
                     error[k] = exp.evalErrorString()
                 else:
-                    result[k] = json.loads(QgsJsonUtils.encodeValue(value))
+                    result[k] = json_backend.loads(QgsJsonUtils.encodeValue(value))
                     error[k] = exp.expression()
             body['results'].append(result)
             body['errors'].append(error)
@@ -375,7 +375,7 @@ class ExpressionService(QgsService):
 
         # try to load expressions list or dict
         try:
-            str_json = json.loads(strings)
+            str_json = json_backend.loads(strings)
         except Exception:
             logger.critical(
                 "JSON loads strings '{}' exception:\n{}".format(strings, traceback.format_exc()))
@@ -425,14 +425,14 @@ class ExpressionService(QgsService):
             result = {}
             for k, s in str_map.items():
                 value = QgsExpression.replaceExpressionText(s, exp_context, da)
-                result[k] = json.loads(QgsJsonUtils.encodeValue(value))
+                result[k] = json_backend.loads(QgsJsonUtils.encodeValue(value))
             body['results'].append(result)
             write_json_response(body, response)
             return
 
         # Check features
         try:
-            geojson = json.loads(features)
+            geojson = json_backend.loads(features)
         except Exception:
             logger.critical(
                 "JSON loads features '{}' exception:\n{}".format(features, traceback.format_exc()))
@@ -502,7 +502,7 @@ class ExpressionService(QgsService):
             result = {}
             for k, s in str_map.items():
                 value = QgsExpression.replaceExpressionText(s, exp_context, da)
-                result[k] = json.loads(QgsJsonUtils.encodeValue(value))
+                result[k] = json_backend.loads(QgsJsonUtils.encodeValue(value))
             body['results'].append(result)
 
         write_json_response(body, response)
@@ -556,7 +556,7 @@ class ExpressionService(QgsService):
 
         # Check features
         try:
-            geojson = json.loads(form_feature)
+            geojson = json_backend.loads(form_feature)
         except Exception:
             logger.critical(
                 "JSON loads form feature '{}' exception:\n{}".format(form_feature, traceback.format_exc()))
@@ -716,7 +716,7 @@ class ExpressionService(QgsService):
 
         # try to load virtuals dict
         try:
-            vir_json = json.loads(virtuals)
+            vir_json = json_backend.loads(virtuals)
         except Exception:
             logger.critical(
                 "JSON loads virtuals '{}' exception:\n{}".format(virtuals, traceback.format_exc()))
@@ -836,7 +836,7 @@ class ExpressionService(QgsService):
                     extra[k] = None
                     errors[k] = exp.evalErrorString()
                 else:
-                    extra[k] = json.loads(QgsJsonUtils.encodeValue(value))
+                    extra[k] = json_backend.loads(QgsJsonUtils.encodeValue(value))
                     errors[k] = exp.expression()
 
             response.write(separator + json_exporter.exportFeature(feat, extra, fid))
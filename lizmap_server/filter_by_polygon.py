@@ -3,53 +3,453 @@ __license__ = 'GPL version 3'
 __email__ = 'info@3liz.org'
 
 import binascii
+import os
 
-from functools import lru_cache
-from typing import Tuple, Union
+from collections import namedtuple
+from enum import Enum
+from typing import Dict, FrozenSet, Iterable, List, Tuple, Union
 
 from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
+    QgsCsException,
     QgsDataSourceUri,
+    QgsExpression,
     QgsFeatureRequest,
     QgsGeometry,
+    QgsGeometryEngine,
     QgsProject,
-    QgsProviderConnectionException,
     QgsProviderRegistry,
+    QgsRectangle,
+    QgsReferencedRectangle,
     QgsSpatialIndex,
     QgsVectorLayer,
+    QgsWkbTypes,
 )
 from qgis.PyQt.QtCore import QVariant
 
+from lizmap_server.cache import BackgroundRefresh, LRUCache
+from lizmap_server.change_detection import (
+    CHANGE_TOKENS,
+    Stamped,
+    layer_stamp,
+)
+from lizmap_server.compiled_config import (
+    PolygonFilterLayer,
+    polygon_filter_layers,
+)
+from lizmap_server.connection_pool import (
+    HAS_PSYCOPG2,
+    ConnectionPool,
+    check_postgres,
+    close_postgres,
+    connect_postgres,
+    execute_postgres,
+)
+from lizmap_server.core import get_lizmap_compiled_config
+from lizmap_server.expression_functions import (
+    USER_POLYGONS,
+    UserPolygon,
+    get_user_polygon,
+    set_user_polygon,
+)
 from lizmap_server.logger import Logger, profiling
-
-# TODO implement LRU cache with this variable
-CACHE_MAX_SIZE = 100
+from lizmap_server.parallel_join import (
+    can_spawn_processes,
+    parallel_features_ids,
+)
+from lizmap_server.polygon_layer import LAYERS as POLYGON_LAYERS
+from lizmap_server.polygon_layer import (
+    PolygonLayer,
+    polygon_layer,
+    split_groups,
+)
+from lizmap_server.polygon_membership import MEMBERSHIPS, polygon_membership
+from lizmap_server.precomputed import (
+    PRECOMPUTED,
+    Precomputed,
+    discard_precomputed,
+    precomputed,
+)
+from lizmap_server.sqlite_layer import sqlite_features_ids
+from lizmap_server.tools import env_number, to_bool
+from lizmap_server.vectorized import HAS_NUMPY, HAS_SHAPELY
+
+# Shared between all requests, for a given group set, layer and polygon layer
+CACHE_MAX_SIZE = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_SIZE', 100)
+# In seconds, 0 to disable the expiration
+CACHE_TTL = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_TTL', 60.0)
+# In seconds after the TTL, an expired subset string is still returned while it is computed again
+# in the background, 0 to disable
+CACHE_GRACE = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_GRACE', 0.0)
+
+POLYGON_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+# For a single group, to build the polygon of any combination of groups
+GROUP_POLYGON_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE * 10, ttl=CACHE_TTL)
+SUBSET_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL, grace=CACHE_GRACE)
+# The IDs of the features in the whole polygon, clipped to the extent of each request
+# Budget in number of IDs, for all entries
+FEATURE_IDS_CACHE_MAX_IDS = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_IDS_CACHE_MAX', 10000000)
+FEATURE_IDS_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL, max_weight=FEATURE_IDS_CACHE_MAX_IDS)
+REFRESH = BackgroundRefresh()
+# For a given group set, the polygon in the CRS of each filtered layer
+TRANSFORMED_POLYGON_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL)
+
+# Spatial indexes of filtered layers stored in files, kept until the file is modified
+# Memory budget in megabytes, estimated from the number of features
+SPATIAL_INDEX_MEMORY_BUDGET = env_number('QGIS_SERVER_LIZMAP_SPATIAL_INDEX_MEMORY_BUDGET', 256)
+SPATIAL_INDEX_BYTES_PER_FEATURE = 200
+SPATIAL_INDEX_CACHE = LRUCache(
+    maxsize=CACHE_MAX_SIZE, max_weight=SPATIAL_INDEX_MEMORY_BUDGET * 1024 * 1024)
+
+# The polygon layer is kept in memory, if it is not bigger than this number of features, 0 to disable
+POLYGON_LAYER_MAX_FEATURES = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_MEMORY_MAX_FEATURES', 10000)
+
+# In milliseconds, for each SQL query made by the filter by polygon with psycopg2, 0 to disable
+STATEMENT_TIMEOUT = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_STATEMENT_TIMEOUT', 30000)
 
 # 1 = 0 results in a "false" in OGR/PostGIS
 # ET : I didn't find a proper false value in OGR
 NO_FEATURES = '1 = 0'
 ALL_FEATURES = ''
 
+# Consecutive integer IDs are written as a range, from this length
+SQL_RANGE_MIN_LENGTH = 5
+# Maximum number of values in a single IN statement
+SQL_IN_CHUNK_SIZE = 1000
+# Above this number of IDs, a spatial predicate is used if it is enabled and if the filter type allows it
+MAX_FEATURE_IDS = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_MAX_IDS', 10000)
+# The access control can write ST_Intersects/ST_Contains in the subset string of PostgreSQL layers
+USE_SPATIAL_PREDICATE = to_bool(
+    os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_SPATIAL_PREDICATE', ''), default_value=False)
+
+# In the units of the polygon layer CRS, the polygon of the groups moves less than this tolerance, 0 to disable
+PRECISION_TOLERANCE = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_TOLERANCE', 0.0)
+# Polygons are written as hexadecimal WKB instead of WKT in PostGIS spatial predicates
+SQL_GEOMETRY_AS_WKB = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_WKB', ''), default_value=False)
+
+# Polygons with more vertices are split in small parts for PostGIS spatial predicates, 0 to disable
+SUBDIVIDE_MAX_VERTICES = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_SUBDIVIDE', 0)
+# Parts of each transformed polygon, with the transformed polygon to check the entry
+SUBDIVIDED_POLYGON_CACHE = LRUCache(maxsize=CACHE_MAX_SIZE)
+
+# PostgreSQL layers in the same database as the polygon layer are filtered with an EXISTS subquery
+USE_SQL_EXISTS = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_SQL_EXISTS', ''), default_value=False)
+
+# GeoPackage and SpatiaLite layers are queried directly with SQLite, using their spatial index
+USE_SQLITE = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_SQLITE', 'True'))
+
+# Layers stored in a file with many features are filtered by a pool of processes, 0 to disable
+PARALLEL_WORKERS = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_WORKERS', 0)
+PARALLEL_MIN_FEATURES = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_PARALLEL_MIN_FEATURES', 100000)
+# In seconds, after this delay the layer is filtered by the server process itself, 0 to disable
+PARALLEL_TIMEOUT = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_PARALLEL_TIMEOUT', 30.0)
+
+# The features intersecting each polygon are computed once for each filtered layer
+USE_MEMBERSHIP = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_MEMBERSHIP', ''), default_value=False)
+
+# Points of GeoPackage layers are read at once and checked with a bulk point in polygon test, if Shapely 2 is installed
+USE_VECTORIZED = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_VECTORIZED', 'True'))
+# Without Shapely, the ray casting with NumPy is used only if enabled : unlike GEOS, a point exactly on the
+# boundary of the polygon might be considered outside
+USE_RAY_CASTING = to_bool(
+    os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_RAY_CASTING', ''), default_value=False)
+
+# Results computed offline are read from the file next to the project, if it exists
+USE_PRECOMPUTED = to_bool(os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_PRECOMPUTED', 'True'))
+
+# Layers which are not stored in PostgreSQL are filtered with the lizmap_in_user_polygon expression function
+USE_EXPRESSION_FUNCTION = to_bool(
+    os.getenv('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_EXPRESSION_FUNCTION', ''), default_value=False)
+
+
+# The polygon of the groups in the CRS of a filtered layer, with a prepared engine
+TransformedPolygon = namedtuple('TransformedPolygon', ['source', 'geometry', 'engine'])
+
+# An expired subset string computed again in a background thread, only from plain data
+# dsn : the libpq connection string of the database
+# sql : the query returning the primary keys of the features
+RefreshJob = namedtuple('RefreshJob', ['dsn', 'sql', 'primary_key', 'filter_type'])
+
+
+class FilterType(Enum):
+    """ Where the filter is used, to write it with the correct syntax. """
+    # Subset string given to the data provider, or returned to Lizmap Web Client
+    SafeSqlQuery = 'sql'
+    # Expression evaluated by QGIS on each feature
+    QgisExpression = 'expression'
+
+
+def cache_info() -> dict:
+    """ Statistics about the filter by polygon caches. """
+    return {
+        'polygons': POLYGON_CACHE.info()._asdict(),
+        'group_polygons': GROUP_POLYGON_CACHE.info()._asdict(),
+        'transformed_polygons': TRANSFORMED_POLYGON_CACHE.info()._asdict(),
+        'subdivided_polygons': SUBDIVIDED_POLYGON_CACHE.info()._asdict(),
+        'subset_strings': SUBSET_CACHE.info()._asdict(),
+        'feature_ids': FEATURE_IDS_CACHE.info()._asdict(),
+        'background_refresh': {'pending': REFRESH.pending()},
+        'spatial_indexes': SPATIAL_INDEX_CACHE.info()._asdict(),
+        'user_polygons': USER_POLYGONS.info()._asdict(),
+        'memberships': MEMBERSHIPS.info()._asdict(),
+        'connections': CONNECTION_POOL.info()._asdict(),
+    }
+
+
+def clear_cache() -> None:
+    """ Remove all filter by polygon results from the caches. """
+    # A running computation would fill the cache again
+    REFRESH.shutdown()
+    POLYGON_CACHE.clear()
+    GROUP_POLYGON_CACHE.clear()
+    TRANSFORMED_POLYGON_CACHE.clear()
+    SUBDIVIDED_POLYGON_CACHE.clear()
+    SUBSET_CACHE.clear()
+    FEATURE_IDS_CACHE.clear()
+    SPATIAL_INDEX_CACHE.clear()
+    USER_POLYGONS.clear()
+    MEMBERSHIPS.clear()
+    CHANGE_TOKENS.clear()
+    PRECOMPUTED.clear()
+
+
+def invalidate_layer(project: str, layer_id: str) -> int:
+    """ Remove cached results for a filtered layer which has been edited.
+
+    Polygons are still valid, only subset strings and indexes of the layer are removed.
+
+    :returns: The number of removed entries.
+    """
+    count = 0
+    for cache in (SUBSET_CACHE, FEATURE_IDS_CACHE):
+        count += cache.invalidate(lambda key: key[0] == project and key[4] == layer_id)
+    count += SPATIAL_INDEX_CACHE.invalidate(lambda key: key[0] == layer_id)
+    count += MEMBERSHIPS.invalidate(lambda key: key[0] == project and key[1] == layer_id)
+    count += discard_precomputed(project, layer_id)
+    return count
+
+
+def invalidate_features(
+        project: QgsProject, layer: QgsVectorLayer, stamp: Union[Tuple, None], geometries: List[QgsGeometry]) -> int:
+    """ Remove cached results for a filtered layer only for the groups with a polygon touching the edited features.
+
+    Results of the other groups are kept. If they were up to date before the edit, they get the new stamp of the
+    layer, so they are still used after the modification of the file or of the change token.
+
+    :param project: The project
+    :param layer: The edited filtered layer
+    :param stamp: The stamp of the layer before the edit
+    :param geometries: The geometries of the edited features, before and after the edit, in the CRS of the layer
+    :returns: The number of removed entries.
+    """
+    project_file = project.fileName()
+    new_stamp = layer_stamp(layer)
+    # By polygon layer ID, the edited features in the CRS of the polygon layer
+    edited_areas = {}
+
+    def is_edited(key: tuple, cached: Stamped) -> bool:
+        """ If the result of the cache key might contain an edited feature, before or after the edit. """
+        polygon = POLYGON_CACHE.get(key[0:4])
+        if polygon is None or polygon.stamp != cached.stamp[1]:
+            # The polygon of the groups is not known anymore
+            return True
+
+        if key[1] not in edited_areas:
+            edited_areas[key[1]] = _edited_areas(project, layer, project.mapLayer(key[1]), geometries)
+        areas = edited_areas[key[1]]
+        return areas is None or any(polygon.value.intersects(area) for area in areas)
+
+    count = 0
+    for cache in (SUBSET_CACHE, FEATURE_IDS_CACHE):
+        for key, cached in cache.items(lambda k: k[0] == project_file and k[4] == layer.id()):
+            if is_edited(key, cached):
+                cache.pop(key)
+                count += 1
+            elif cached.stamp[0] == stamp:
+                cache.replace(key, Stamped((new_stamp, cached.stamp[1]), cached.value))
+
+    count += SPATIAL_INDEX_CACHE.invalidate(lambda key: key[0] == layer.id())
+    count += MEMBERSHIPS.invalidate(lambda key: key[0] == project_file and key[1] == layer.id())
+    count += discard_precomputed(project_file, layer.id())
+    return count
+
+
+def _edited_areas(
+        project: QgsProject, layer: QgsVectorLayer, polygon_layer: Union[QgsVectorLayer, None],
+        geometries: List[QgsGeometry]) -> Union[List[QgsGeometry], None]:
+    """ The edited features in the CRS of the polygon layer, None if they can not be transformed.
+
+    With a precision tolerance, the polygon of the groups has been simplified, the bounding box of each feature is
+    grown by the tolerance.
+    """
+    if not isinstance(polygon_layer, QgsVectorLayer):
+        return None
+
+    transform = QgsCoordinateTransform(layer.crs(), polygon_layer.crs(), project)
+    areas = []
+    for geometry in geometries:
+        # Work on a copy, the geometry might be shared
+        area = QgsGeometry(geometry)
+        try:
+            area.transform(transform)
+        except QgsCsException:
+            return None
+
+        if PRECISION_TOLERANCE > 0:
+            rectangle = area.boundingBox()
+            rectangle.grow(PRECISION_TOLERANCE)
+            area = QgsGeometry.fromRect(rectangle)
+        areas.append(area)
+    return areas
+
+
+def invalidate_polygon_layer(
+        project: str, layer_id: str, groups: Union[frozenset, None] = None, layer: QgsVectorLayer = None,
+        stamp: Union[Tuple, None] = None) -> int:
+    """ Remove cached results for a polygon layer which has been edited.
+
+    If the layer and its stamp before the edit are given, the results of the other groups get the new stamp of the
+    layer, so they are still used after the modification of the file or of the change token.
+
+    :param project: The project file name
+    :param layer_id: The polygon layer ID
+    :param groups: Groups of the edited polygons, None if they are unknown to remove all groups.
+    :param layer: The polygon layer
+    :param stamp: The stamp of the polygon layer before the edit
+    :returns: The number of removed entries.
+    """
+    def polygon_key(key: tuple) -> bool:
+        """ Keys starting with the polygon cache key. """
+        if key[0] != project or key[1] != layer_id:
+            return False
+        return groups is None or not groups.isdisjoint(key[3])
+
+    count = 0
+    for cache in (POLYGON_CACHE, GROUP_POLYGON_CACHE, TRANSFORMED_POLYGON_CACHE, SUBSET_CACHE, FEATURE_IDS_CACHE):
+        count += cache.invalidate(polygon_key)
+
+    if layer is not None and groups is not None:
+        new_stamp = layer_stamp(layer)
+        if new_stamp != stamp:
+            def other_groups(key: tuple) -> bool:
+                return key[0] == project and key[1] == layer_id
+
+            # The stamp of the polygon layer alone
+            for cache in (POLYGON_CACHE, GROUP_POLYGON_CACHE):
+                for key, cached in cache.items(other_groups):
+                    if cached.stamp == stamp:
+                        cache.replace(key, Stamped(new_stamp, cached.value))
+
+            # The stamps of the filtered layer and of the polygon layer
+            for cache in (SUBSET_CACHE, FEATURE_IDS_CACHE):
+                for key, cached in cache.items(other_groups):
+                    if cached.stamp[1] == stamp:
+                        cache.replace(key, Stamped((cached.stamp[0], new_stamp), cached.value))
+
+    # A project has a single polygon layer, these keys do not have the polygon layer ID
+    # These keys have the groups of the request, split like the polygon layer might do
+    count += USER_POLYGONS.invalidate(
+        lambda key: key[0] == project and (
+            groups is None or not groups.isdisjoint(split_groups(key[2], False) | split_groups(key[2], True))))
+    count += MEMBERSHIPS.invalidate(lambda key: key[0] == project and key[3] == layer_id)
+    # The in memory copy must be reloaded, even if the file has not been written yet
+    count += POLYGON_LAYERS.invalidate(lambda key: key[0] == layer_id)
+    count += discard_precomputed(project, layer_id)
+    return count
+
+
+def user_polygon_for_groups(layer_id: str, groups: str) -> Union[UserPolygon, None]:
+    """ The polygon used by lizmap_in_user_polygon, computed again for the layer of the expression.
+
+    The Lizmap config of the current project is used, like the access control filter.
+
+    :param layer_id: The filtered layer ID
+    :param groups: The groups of the current user, separated by a comma
+    :returns: The polygon of the user, None if the layer is not filtered by polygon.
+    """
+    # noinspection PyArgumentList
+    project = QgsProject.instance()
+    layer = project.mapLayer(layer_id)
+    if not isinstance(layer, QgsVectorLayer):
+        return None
+
+    compiled = get_lizmap_compiled_config(project.fileName())
+    if not compiled or not compiled.filter_by_polygon:
+        return None
+
+    config = FilterByPolygon(
+        compiled.filter_by_polygon, layer, filter_type=FilterType.QgisExpression,
+        layers=compiled.polygon_filter_layers)
+    if not config.is_filtered() or not config.is_valid():
+        return None
+
+    return config.user_polygon(tuple(groups.split(',')))
+
+
+def _create_connection(dsn: str):
+    """ New psycopg2 connection for the pool. """
+    return connect_postgres(dsn, 'QGIS Lizmap Server : Filter By Polygon')
+
+
+# Only used with psycopg2, QGIS already pools the connections of its PostgreSQL provider
+CONNECTION_POOL = ConnectionPool(
+    _create_connection,
+    max_size=env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_POOL_SIZE', 4),
+    idle_timeout=env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_POOL_IDLE_TIMEOUT', 300.0),
+    health_check=check_postgres,
+    close=close_postgres,
+)
+
+
+def execute_sql(uri: QgsDataSourceUri, sql: str) -> list:
+    """ For a given URI, execute a read only SQL query and return the rows.
+
+    With psycopg2, the connection is taken from the process wide pool and the query has a statement timeout.
+    Otherwise, QGIS borrows a connection from the pool of its PostgreSQL provider. There is no statement timeout
+    in this case, it would stay on a connection shared with the rest of QGIS.
+    """
+    if HAS_PSYCOPG2:
+        return execute_postgres(CONNECTION_POOL, uri.connectionInfo(True), sql, STATEMENT_TIMEOUT)
+
+    # noinspection PyArgumentList
+    metadata = QgsProviderRegistry.instance().providerMetadata('postgres')
+    return metadata.createConnection(uri.connectionInfo(False), {}).executeSql(sql)
+
 
 class FilterByPolygon:
 
     def __init__(
-            self, config: dict, layer: QgsVectorLayer, editing: bool = False, use_st_relationship: bool = False):
+            self, config: dict, layer: QgsVectorLayer, editing: bool = False, use_st_relationship: bool = False,
+            filter_type: FilterType = FilterType.SafeSqlQuery, extent: QgsReferencedRectangle = None,
+            use_sql_exists: bool = False, layers: Dict[str, PolygonFilterLayer] = None,
+            use_spatial_predicate: bool = False):
         """Constructor for the filter by polygon.
 
         :param config: The filter by polygon configuration as dictionary
         :param layer: The vector layer to filter
+        :param use_sql_exists: If the subset string can reference the polygon table, for a PostgreSQL layer
+        :param filter_type: If the filter is used as a SQL subset string or as a QGIS expression
+        :param extent: The extent of the request, features outside might not be in the filter
+        :param layers: The filtered layers by layer ID, from the compiled Lizmap config. Read from the
+            configuration if not given.
+        :param use_spatial_predicate: If a spatial predicate can be used instead of too many IDs
         """
-        self.connection = None
         # QGIS Server can consider the ST_Intersect/ST_Contains not safe regarding SQL injection.
         # Using this flag will transform or not the ST_Intersect/ST_Contains into an IN by making the query
         # straight to PostGIS.
         self.use_st_relationship = use_st_relationship
+        self.use_sql_exists = use_sql_exists
+        self.use_spatial_predicate = use_spatial_predicate
+        self.filter_type = filter_type
+        self.extent = extent
         self.config = config
+        self.layers = layers
         self.editing = editing
         # noinspection PyArgumentList
         self.project = QgsProject.instance()
+        # Kept for cache keys, the project instance might read another project during a background refresh
+        self.project_file = self.project.fileName()
 
         # Current layer in the request
         self.layer = layer
@@ -79,16 +479,16 @@ class FilterByPolygon:
         if self.config is None:
             return None
 
-        layers = self.config.get('layers')
-        if not layers:
+        if self.layers is None:
+            self.layers = polygon_filter_layers(self.config)
+
+        layer = self.layers.get(self.layer.id())
+        if layer is None:
             return None
 
-        for layer in layers:
-            if layer.get("layer") == self.layer.id():
-                self.primary_key = layer.get('primary_key')
-                self.filter_mode = layer.get('filter_mode')
-                self.spatial_relationship = layer.get('spatial_relationship')
-                break
+        self.primary_key = layer.primary_key
+        self.filter_mode = layer.filter_mode
+        self.spatial_relationship = layer.spatial_relationship
 
         if self.primary_key is None:
             return None
@@ -126,26 +526,86 @@ class FilterByPolygon:
 
         return True
 
-    def sql_query(self, uri: QgsDataSourceUri, sql) -> Tuple[Tuple]:
+    def uses_expression_function(self) -> bool:
+        """ If the layer is filtered with the lizmap_in_user_polygon expression function.
+
+        The SQL subset string does not need to filter the layer in this case.
+        """
+        return USE_EXPRESSION_FUNCTION and self.layer.providerType() != 'postgres'
+
+    def uses_sql_exists(self) -> bool:
+        """ If the layer is filtered with a subquery on the polygon table, in the subset string.
+
+        Both layers must be in the same PostgreSQL database, the layer must be a table and the spatial
+        relationship must be 'intersects', as a feature can be contained in the union of several polygons.
+        """
+        if not self.use_sql_exists or self.spatial_relationship != 'intersects':
+            return False
+
+        if self.layer.providerType() != 'postgres' or self.polygon.providerType() != 'postgres':
+            return False
+
+        layer_uri = QgsDataSourceUri(self.layer.source())
+        if layer_uri.table().startswith('('):
+            # A SQL query, the table can not be referenced
+            return False
+
+        return layer_uri.connectionInfo(False) == QgsDataSourceUri(self.polygon.source()).connectionInfo(False)
+
+    @staticmethod
+    def sql_query(uri: QgsDataSourceUri, sql: str) -> list:
         """ For a given URI, execute an SQL query and return the result. """
-        if self.connection is None:
-            # noinspection PyArgumentList
-            metadata = QgsProviderRegistry.instance().providerMetadata('postgres')
-            self.connection = metadata.createConnection(uri.uri(), {})
-            try:
-                self.connection.executeSql("SET application_name='QGIS Lizmap Server : Filter By Polygon';")
-            except QgsProviderConnectionException as e:
-                Logger.log_exception(e)
-
-        results = self.connection.executeSql(sql)
-        return results
+        return execute_sql(uri, sql)
+
+    def _groups(self, groups: Iterable[str]) -> Tuple[str]:
+        """ Sorted and deduplicated groups, split like the groups in the polygon layer. """
+        # noinspection PyTypeChecker
+        return tuple(sorted(split_groups(','.join(groups), self.polygon.providerType() == 'postgres')))
+
+    def _polygon_cache_key(self, groups: tuple) -> tuple:
+        """ Cache key for the polygon of the given groups. """
+        return (
+            self.project_file,
+            self.polygon.id(),
+            self.polygon.source(),
+            self._groups(groups),
+        )
+
+    def _features_ids_cache_key(self, groups: tuple) -> tuple:
+        """ Cache key for the features of the current layer in the polygon of the given groups.
+
+        The features do not depend on how the filter is written, it is shared by SQL subset strings and
+        expressions.
+        """
+        return self._polygon_cache_key(groups) + (
+            self.layer.id(),
+            self.layer.source(),
+            self.primary_key,
+            self.spatial_relationship,
+            self.editing,
+        )
+
+    def _subset_cache_key(self, groups: tuple) -> tuple:
+        """ Cache key for the subset string of the current layer for the given groups. """
+        return self._polygon_cache_key(groups) + (
+            self.layer.id(),
+            self.layer.source(),
+            self.primary_key,
+            self.spatial_relationship,
+            self.editing,
+            self.use_st_relationship,
+            self.use_sql_exists,
+            self.use_spatial_predicate,
+            self.filter_type,
+        )
 
     @profiling
-    def subset_sql(self, groups: tuple) -> Tuple[str, str]:
+    def subset_sql(self, groups: tuple, with_polygon: bool = True) -> Tuple[str, str]:
         """ Get the SQL subset string for the current groups of the user.
 
         :param groups: List of groups belongings to the user.
-        :returns: The subset SQL string to use
+        :param with_polygon: If the EWKT polygon of the groups is returned, only needed by GETSUBSETSTRING.
+        :returns: The subset SQL string to use and the EWKT polygon, empty if it is not requested
         """
         if self.filter_mode == 'editing':
             if not self.editing:
@@ -156,51 +616,513 @@ class FilterByPolygon:
             Logger.info(
                 "Layer is editing only AND we are in an editing session. Continue to find the subset string")
 
-        # We need to have a cache for this, valid for the combo polygon layer id & user_groups
-        # as it will be done for each WMS or WFS query
-        if self.polygon.providerType() == 'postgres':
-            polygon = self._polygon_for_groups_with_sql_query(groups)
+        if self.filter_type == FilterType.QgisExpression and self.uses_expression_function():
+            # Not cached, the polygon of the user must be available for the expression function
+            sql = self._expression_function_filter(groups)
         else:
-            polygon = self._polygon_for_groups_with_qgis_api(groups)
-        # Logger.info("LRU Cache _polygon_for_groups : {}".format(self._polygon_for_groups.cache_info()))
+            sql = self._cached_subset_sql(groups)
+
+        if not with_polygon:
+            return sql, ''
 
+        polygon = self._polygon_for_groups(groups)
         if polygon.isEmpty():
-            # Let's try to free the connection
-            self.connection = None
-            return NO_FEATURES, ''
+            return sql, ''
+        return sql, self._ewkt(polygon)
+
+    def _cached_subset_sql(self, groups: tuple) -> str:
+        """ The SQL subset string, shared between requests. """
+        if self.extent is not None:
+            # Each tile has its own extent, the features of the whole polygon are clipped to it
+            return self._subset_sql(groups)
+
+        # The result is shared between requests, as it will be done for each WMS or WFS query
+        key = self._subset_cache_key(groups)
+        stamp = (layer_stamp(self.layer), layer_stamp(self.polygon))
+        cached, stale = SUBSET_CACHE.get_stale(key)
+        if cached is not None and cached.stamp == stamp:
+            if not stale:
+                Logger.info("Subset string for layer {} found in the cache : {}".format(
+                    self.layer.name(), SUBSET_CACHE.info()))
+                return cached.value
+
+            job = self._refresh_job(groups)
+            if job is not None:
+                if REFRESH.submit(key, lambda: _refresh_subset_sql(key, job, stamp)):
+                    Logger.info("Subset string for layer {} expired, computed again in the background".format(
+                        self.layer.name()))
+                return cached.value
+
+        result = self._subset_sql(groups)
+        SUBSET_CACHE.set(key, Stamped(stamp, result))
+        return result
+
+    def _refresh_job(self, groups: tuple) -> Union[RefreshJob, None]:
+        """ The job computing an expired subset string in a background thread, None if it is not possible.
+
+        The thread must not use QGIS layers nor the project, they belong to the request. The subset string is
+        computed with a single query, so both layers must be PostgreSQL tables in the same database, read with
+        psycopg2, and the result must not depend on the polygon computed by QGIS. Never in an editing session.
+        """
+        if self.editing or not HAS_PSYCOPG2 or PRECISION_TOLERANCE > 0:
+            return None
+
+        if self.use_st_relationship or self.use_spatial_predicate or self.uses_sql_exists():
+            return None
+
+        if self.spatial_relationship not in ('contains', 'intersects'):
+            return None
+
+        if self.layer.providerType() != 'postgres' or self.polygon.providerType() != 'postgres':
+            return None
+
+        layer_uri = QgsDataSourceUri(self.layer.source())
+        polygon_uri = QgsDataSourceUri(self.polygon.source())
+        if layer_uri.table().startswith('(') or polygon_uri.table().startswith('('):
+            # A SQL query, the table can not be referenced
+            return None
+
+        if layer_uri.connectionInfo(False) != polygon_uri.connectionInfo(False):
+            return None
+
+        if self._precomputed() is not None:
+            return None
+
+        sql = self._format_sql_features_ids(
+            layer_uri,
+            self.layer.crs().postgisSrid(),
+            polygon_uri,
+            self.polygon.crs().postgisSrid(),
+            self.group_field,
+            self._groups(groups),
+            self.primary_key,
+            self.spatial_relationship,
+        )
+        return RefreshJob(layer_uri.connectionInfo(True), sql, self.primary_key, self.filter_type)
+
+    def _polygon_for_groups(self, groups: tuple) -> QgsGeometry:
+        """ The polygon for the given groups, from the cache if possible.
 
-        ewkt = "SRID={crs};{wkt}".format(
+        The geometry is shared, it must not be edited in place.
+        """
+        key = self._polygon_cache_key(groups)
+        stamp = layer_stamp(self.polygon)
+        cached = POLYGON_CACHE.get(key)
+        if cached is not None and cached.stamp == stamp:
+            Logger.info("Polygon for groups found in the cache : {}".format(POLYGON_CACHE.info()))
+            return cached.value
+
+        layer = None
+        if POLYGON_LAYER_MAX_FEATURES > 0 and self._precomputed() is None:
+            layer = polygon_layer(self.polygon, self.group_field, CACHE_TTL, POLYGON_LAYER_MAX_FEATURES)
+
+        if layer is not None and not layer.postgres:
+            # Collecting the polygons of the user is only a dictionary lookup, nothing to share
+            polygon = layer.polygon_for_groups(groups)
+        else:
+            # The union is built from the union of each group, shared between combinations of groups
+            parts = [self._polygon_for_group(group, layer) for group in self._groups(groups)]
+            parts = [part for part in parts if not part.isEmpty()]
+            if not parts:
+                polygon = QgsGeometry()
+            elif len(parts) == 1:
+                polygon = parts[0]
+            else:
+                polygon = QgsGeometry.unaryUnion(parts)
+
+        polygon = self._reduce_precision(polygon)
+        POLYGON_CACHE.set(key, Stamped(stamp, polygon))
+        return polygon
+
+    def _reduce_precision(self, polygon: QgsGeometry) -> QgsGeometry:
+        """ Simplify and snap the polygon to a grid, to write a smaller filter.
+
+        Half of the tolerance is used to simplify and half of the tolerance is used as the grid size,
+        so any vertex moves less than the tolerance.
+        """
+        if PRECISION_TOLERANCE <= 0 or polygon.isEmpty():
+            return polygon
+
+        step = PRECISION_TOLERANCE / 2
+        reduced = polygon.simplify(step).snappedToGrid(step, step)
+        if not reduced.isGeosValid():
+            # Snapping might create self intersections
+            reduced = reduced.makeValid()
+
+        if reduced.isEmpty():
+            # Let's be safe, the polygon is smaller than the tolerance
+            return polygon
+
+        Logger.info("Polygon of layer {} reduced from {} to {} vertices with the tolerance {}".format(
+            self.polygon.name(),
+            polygon.constGet().nCoordinates(),
+            reduced.constGet().nCoordinates(),
+            PRECISION_TOLERANCE))
+        return reduced
+
+    def _polygon_for_group(self, group: str, layer: Union[PolygonLayer, None]) -> QgsGeometry:
+        """ The polygon for a single group, from the cache if possible.
+
+        :param group: The group
+        :param layer: The in memory polygon layer, if available
+        """
+        key = self._polygon_cache_key((group, ))
+        stamp = layer_stamp(self.polygon)
+        cached = GROUP_POLYGON_CACHE.get(key)
+        if cached is not None and cached.stamp == stamp:
+            return cached.value
+
+        precomputed_results = self._precomputed()
+        if precomputed_results is not None:
+            polygon = precomputed_results.polygon(group)
+        elif layer is not None:
+            polygon = layer.polygon_for_groups((group, ))
+        elif self.polygon.providerType() == 'postgres':
+            polygon = self._polygon_for_groups_with_sql_query((group, ))
+        else:
+            polygon = self._polygon_for_groups_with_qgis_api((group, ))
+
+        GROUP_POLYGON_CACHE.set(key, Stamped(stamp, polygon))
+        return polygon
+
+    def _ewkt(self, polygon: QgsGeometry) -> str:
+        """ The polygon as EWKT, in the CRS of the polygon layer. """
+        return "SRID={crs};{wkt}".format(
             crs=self.polygon.crs().postgisSrid(),
             wkt=polygon.asWkt(6 if self.polygon.crs().isGeographic() else 2)
         )
 
+    def _expression_function_filter(self, groups: tuple) -> str:
+        """ The expression using lizmap_in_user_polygon.
+
+        Each feature is checked against the prepared polygon while QGIS iterates over the layer.
+        """
+        if self.user_polygon(groups) is None:
+            return NO_FEATURES
+
+        # The function reads the groups of the current request
+        return 'lizmap_in_user_polygon($geometry, {layer})'.format(layer=QgsExpression.quotedString(self.layer.id()))
+
+    def user_polygon(self, groups: Iterable[str]) -> Union[UserPolygon, None]:
+        """ The polygon used by lizmap_in_user_polygon for the given groups, stored if it has changed.
+
+        :returns: The polygon of the user, None if the polygon of the groups is empty.
+        """
+        polygon = self._polygon_for_groups(groups)
+
+        if polygon.isEmpty():
+            return None
+
+        transformed = self._polygon_in_layer_crs(groups, polygon)
+        # Stored with the groups of the request, as read by the expression function
+        user_polygon = get_user_polygon(self.layer.id(), groups)
+        if user_polygon is None or user_polygon.source is not transformed \
+                or user_polygon.relationship != self.spatial_relationship:
+            user_polygon = set_user_polygon(
+                self.layer.id(), groups, transformed, transformed.geometry, transformed.engine,
+                self.spatial_relationship)
+        return user_polygon
+
+    def _polygon_in_layer_crs(self, groups: tuple, polygon: QgsGeometry) -> TransformedPolygon:
+        """ The polygon of the groups in the CRS of the filtered layer, from the cache if possible.
+
+        :param groups: The groups of the user
+        :param polygon: The polygon of the groups, in the CRS of the polygon layer
+        """
+        crs = self.layer.crs()
+        key = self._polygon_cache_key(groups) + (crs.authid() or crs.toWkt(), )
+        transformed = TRANSFORMED_POLYGON_CACHE.get(key)
+        if transformed is not None and transformed.source is polygon:
+            return transformed
+
+        geometry = polygon
+        if self.polygon.crs() != crs:
+            # Work on a copy, the polygon is shared with the cache
+            geometry = QgsGeometry(polygon)
+            geometry.transform(QgsCoordinateTransform(self.polygon.crs(), crs, self.project))
+
+        transformed = TransformedPolygon(polygon, geometry, self._prepared(geometry))
+        TRANSFORMED_POLYGON_CACHE.set(key, transformed)
+        return transformed
+
+    def _subset_sql(self, groups: tuple) -> str:
+        """ Compute the SQL subset string, without the cache of subset strings. """
+        if self.filter_type == FilterType.SafeSqlQuery and self.uses_sql_exists():
+            # Everything is done by the database, the polygon is not needed
+            return self._format_sql_exists(
+                QgsDataSourceUri(self.layer.source()),
+                self.layer.crs().postgisSrid(),
+                QgsDataSourceUri(self.polygon.source()),
+                self.polygon.crs().postgisSrid(),
+                self.group_field,
+                self._groups(groups),
+            )
+
+        polygon = self._polygon_for_groups(groups)
+
+        if polygon.isEmpty():
+            return NO_FEATURES
+
+        transformed = self._polygon_in_layer_crs(groups, polygon)
+
         if self.layer.providerType() == 'postgres':
             if self.use_st_relationship:
-                uri = QgsDataSourceUri(self.layer.source())
-                use_st_intersect = False if self.spatial_relationship == 'contains' else True
-                st_relation = self._format_sql_st_relationship(
-                    self.layer.sourceCrs(),
-                    self.polygon.sourceCrs(),
-                    uri.geometryColumn(),
-                    polygon,
-                    use_st_intersect
-                )
+                st_relation = self._sql_st_relationship(transformed)
 
                 if self.use_st_relationship:
-                    return st_relation, ewkt
+                    return st_relation
+
+                unique_ids = self._features_ids_with_sql_query(st_relation)
+                return self._format_filter(unique_ids, transformed)
+
+        unique_ids = self._cached_features_ids(groups, transformed)
+        if self.extent is not None:
+            unique_ids = self._features_ids_in_extent(unique_ids)
+        return self._format_filter(unique_ids, transformed)
+
+    def _cached_features_ids(self, groups: tuple, transformed: TransformedPolygon) -> FrozenSet:
+        """ The IDs of the features in the whole polygon, shared between requests and between tiles. """
+        key = self._features_ids_cache_key(groups)
+        stamp = (layer_stamp(self.layer), layer_stamp(self.polygon))
+        cached = FEATURE_IDS_CACHE.get(key)
+        if cached is not None and cached.stamp == stamp:
+            Logger.info("Feature IDs for layer {} found in the cache : {}".format(
+                self.layer.name(), FEATURE_IDS_CACHE.info()))
+            return cached.value
+
+        unique_ids = frozenset(self._features_ids(groups, transformed))
+        FEATURE_IDS_CACHE.set(key, Stamped(stamp, unique_ids), weight=max(len(unique_ids), 1))
+        return unique_ids
+
+    def _features_ids_in_extent(self, unique_ids: FrozenSet) -> list:
+        """ The IDs in the extent of the request, with the spatial index of the provider. """
+        extent = self._layer_extent()
+        if extent is None or not unique_ids:
+            return list(unique_ids)
+
+        request = QgsFeatureRequest()
+        request.setFilterRect(extent)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([self.primary_key], self.layer.fields())
+        return [f[self.primary_key] for f in self.layer.getFeatures(request) if f[self.primary_key] in unique_ids]
+
+    def _features_ids(self, groups: tuple, transformed: TransformedPolygon) -> list:
+        """ The IDs of the features in the whole polygon, without any cache. """
+        unique_ids = None
+        # Computed offline with the polygons not reduced, like the membership
+        precomputed_results = self._precomputed() if PRECISION_TOLERANCE <= 0 else None
+        if precomputed_results is not None and self.spatial_relationship == 'intersects':
+            unique_ids = precomputed_results.feature_ids(self.layer, self.primary_key, self._groups(groups))
+
+        if unique_ids is None and USE_MEMBERSHIP and self.spatial_relationship == 'intersects':
+            unique_ids = self._features_ids_with_membership(groups)
+
+        if unique_ids is None and PARALLEL_WORKERS > 0 and self.layer.providerType() == 'ogr' \
+                and self.layer.featureCount() >= PARALLEL_MIN_FEATURES:
+            unique_ids = self._features_ids_in_parallel(transformed)
+
+        if unique_ids is None and USE_SQLITE and self.layer.providerType() in ('ogr', 'spatialite'):
+            unique_ids = self._features_ids_with_sqlite(transformed)
+
+        if unique_ids is None:
+            # Still here ? So we use the slow method with QGIS API
+            unique_ids = self._features_ids_with_qgis_api(transformed)
+        return unique_ids
+
+    def _format_filter(self, unique_ids: Iterable, polygon: TransformedPolygon) -> str:
+        """ The filter for the given IDs, or a spatial predicate if there are too many IDs. """
+        if self.use_spatial_predicate and 0 < MAX_FEATURE_IDS < len(unique_ids):
+            predicate = self._spatial_predicate(polygon)
+            if predicate:
+                Logger.info(
+                    "{} features found in the polygon for layer {}, using a spatial predicate".format(
+                        len(unique_ids), self.layer.name()))
+                return predicate
+
+        return self._format_sql_in(self.primary_key, unique_ids, self.filter_type, self.layer.providerType())
+
+    def _spatial_predicate(self, polygon: TransformedPolygon) -> Union[str, None]:
+        """ Spatial predicate instead of a list of IDs, if the filter type and the provider allow it.
+
+        Same relationship as the list of IDs, for 'contains' the polygon contains the feature.
+        """
+        if self.filter_type == FilterType.QgisExpression:
+            return "{function}(geom_from_wkt('{wkt}'), $geometry)".format(
+                function='contains' if self.spatial_relationship == 'contains' else 'intersects',
+                wkt=polygon.geometry.asWkt(6 if self.layer.crs().isGeographic() else 2),
+            )
+
+        if self.layer.providerType() == 'postgres':
+            return self._sql_st_relationship(polygon)
+
+        return None
+
+    def _sql_st_relationship(self, polygon: TransformedPolygon) -> str:
+        """ The PostGIS spatial predicate, with the polygon split in small parts if needed. """
+        uri = QgsDataSourceUri(self.layer.source())
+        use_st_intersect = self.spatial_relationship != 'contains'
+        if not use_st_intersect:
+            # The feature must be in the whole polygon, it can not be checked part by part
+            return self._format_sql_st_relationship(
+                self.layer.crs(), uri.geometryColumn(), polygon.geometry, use_st_intersect, SQL_GEOMETRY_AS_WKB)
+
+        parts = self._subdivided(polygon)
+        extent = self._layer_extent()
+        if extent is not None:
+            # Parts outside the extent of the request are useless
+            parts = [part for part in parts if part.boundingBox().intersects(extent)]
+            if not parts:
+                return NO_FEATURES
+
+        if len(parts) == 1:
+            return self._format_sql_st_relationship(
+                self.layer.crs(), uri.geometryColumn(), parts[0], use_st_intersect, SQL_GEOMETRY_AS_WKB)
+
+        # Each part is checked with the spatial index and against a small geometry
+        return '( {} )'.format(' OR '.join(
+            self._format_sql_st_relationship(
+                self.layer.crs(), uri.geometryColumn(), part, use_st_intersect, SQL_GEOMETRY_AS_WKB)
+            for part in parts
+        ))
+
+    @classmethod
+    def _format_sql_exists(
+            cls,
+            layer_uri: QgsDataSourceUri,
+            layer_srid: int,
+            polygon_uri: QgsDataSourceUri,
+            polygon_srid: int,
+            group_field: str,
+            groups: Tuple[str],
+    ) -> str:
+        """ The subquery on the polygon table, for the given groups.
+
+        The spatial index of the polygon table is used for each feature of the layer. If the CRS are not the same,
+        the geometry of the feature is transformed, not the geometry of the polygon table, to keep its index usable.
+
+        :returns: The subset SQL string.
+        """
+        # The table of the filtered layer is not aliased by the provider
+        table = cls._quoted_table(layer_uri)
+        polygon_table = cls._quoted_table(polygon_uri)
+
+        geom = '{}.{}'.format(table, QgsExpression.quotedColumnRef(layer_uri.geometryColumn()))
+        if polygon_srid != layer_srid:
+            geom = 'ST_Transform({}, {})'.format(geom, polygon_srid)
+
+        # Same split of the groups as the SQL query of the polygon for groups
+        sql = r"""
+EXISTS (
+    SELECT 1
+    FROM {polygon_table} AS lizmap_polygon
+    WHERE
+        ARRAY_REMOVE(
+            STRING_TO_ARRAY(
+                regexp_replace(
+                    lizmap_polygon.{polygon_field}, '[^a-zA-Z0-9_-]', ',', 'g'
+                ),
+                ','
+            ),
+        '') && ARRAY[{groups}]::text[]
+        AND ST_Intersects(lizmap_polygon.{polygon_geom}, {geom})
+)""".format(
+            polygon_table=polygon_table,
+            polygon_field=QgsExpression.quotedColumnRef(group_field),
+            groups=', '.join("'{}'".format(g.replace("'", "''")) for g in groups),
+            polygon_geom=QgsExpression.quotedColumnRef(polygon_uri.geometryColumn()),
+            geom=geom,
+        )
+        return sql
 
-                result = self._features_ids_with_sql_query(st_relation), ewkt
-                # Let's try to free the connection
-                self.connection = None
-                return result
+    @classmethod
+    def _format_sql_features_ids(
+            cls,
+            layer_uri: QgsDataSourceUri,
+            layer_srid: int,
+            polygon_uri: QgsDataSourceUri,
+            polygon_srid: int,
+            group_field: str,
+            groups: Tuple[str],
+            primary_key: str,
+            spatial_relationship: str,
+    ) -> str:
+        """ The query returning the primary keys of the features in the polygon of the groups.
 
-        # Still here ? So we use the slow method with QGIS API
-        subset = self._features_ids_with_qgis_api(polygon)
-        # Logger.info("LRU Cache _layer_not_postgres : {}".format(self._layer_not_postgres.cache_info()))
-        return subset, ewkt
+        Same relationship as ST_Contains in the subset string, for 'contains' the polygon contains the feature.
+
+        :returns: The SQL query.
+        """
+        table = cls._quoted_table(layer_uri)
+        geom = '{}.{}'.format(table, QgsExpression.quotedColumnRef(layer_uri.geometryColumn()))
+
+        polygon_geom = 'ST_Union(p.{})'.format(QgsExpression.quotedColumnRef(polygon_uri.geometryColumn()))
+        if polygon_srid != layer_srid:
+            polygon_geom = 'ST_Transform({}, {})'.format(polygon_geom, layer_srid)
+
+        layer_sql = ''
+        if layer_uri.sql():
+            # The subset string of the layer, as when features are read with the QGIS API
+            layer_sql = '\n    AND ( {} )'.format(layer_uri.sql())
+
+        # Same split of the groups as the SQL query of the polygon for groups
+        sql = r"""
+WITH lizmap_polygon AS (
+    SELECT {polygon_geom} AS lizmap_geom
+    FROM {polygon_table} AS p
+    WHERE
+        ARRAY_REMOVE(
+            STRING_TO_ARRAY(
+                regexp_replace(
+                    p.{polygon_field}, '[^a-zA-Z0-9_-]', ',', 'g'
+                ),
+                ','
+            ),
+        '') && ARRAY[{groups}]::text[]
+)
+SELECT {table}.{pk}
+FROM {table}, lizmap_polygon
+WHERE
+    {function}(lizmap_polygon.lizmap_geom, {geom}){layer_sql}
+""".format(
+            polygon_geom=polygon_geom,
+            polygon_table=cls._quoted_table(polygon_uri),
+            polygon_field=QgsExpression.quotedColumnRef(group_field),
+            groups=', '.join("'{}'".format(g.replace("'", "''")) for g in groups),
+            table=table,
+            pk=QgsExpression.quotedColumnRef(primary_key),
+            function='ST_Contains' if spatial_relationship == 'contains' else 'ST_Intersects',
+            geom=geom,
+            layer_sql=layer_sql,
+        )
+        return sql
+
+    @staticmethod
+    def _quoted_table(uri: QgsDataSourceUri) -> str:
+        """ The quoted table of the URI, with its schema if any. """
+        table = QgsExpression.quotedColumnRef(uri.table())
+        if uri.schema():
+            table = '{}.{}'.format(QgsExpression.quotedColumnRef(uri.schema()), table)
+        return table
+
+    @staticmethod
+    def _subdivided(polygon: TransformedPolygon) -> List[QgsGeometry]:
+        """ The polygon split in parts with a maximum number of vertices, from the cache if possible. """
+        if SUBDIVIDE_MAX_VERTICES <= 0 or polygon.geometry.constGet().nCoordinates() <= SUBDIVIDE_MAX_VERTICES:
+            return [polygon.geometry]
+
+        key = id(polygon)
+        cached = SUBDIVIDED_POLYGON_CACHE.get(key)
+        # The entry keeps a reference on the polygon, so the ID can not be reused by another object
+        if cached is not None and cached[0] is polygon:
+            return cached[1]
+
+        parts = polygon.geometry.subdivide(SUBDIVIDE_MAX_VERTICES).asGeometryCollection()
+        Logger.info("Polygon with {} vertices split in {} parts".format(
+            polygon.geometry.constGet().nCoordinates(), len(parts)))
+        SUBDIVIDED_POLYGON_CACHE.set(key, (polygon, parts))
+        return parts
 
     @profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
     def _polygon_for_groups_with_qgis_api(self, groups: tuple) -> QgsGeometry:
         """ All features from the polygon layer corresponding to the user groups """
         expression = """
@@ -230,7 +1152,6 @@ array_intersect(
         return QgsGeometry().collectGeometry(polygon_geoms)
 
     @profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
     def _polygon_for_groups_with_sql_query(self, groups: tuple) -> QgsGeometry:
         """ All features from the polygon layer corresponding to the user groups for a Postgresql layer.
 
@@ -280,17 +1201,7 @@ c.user_group && (
                 "Requesting the database about polygons for the current groups with : \n{}".format(sql))
 
             results = self.sql_query(uri, sql)
-            wkb = results[0][1]
-
-            geom = QgsGeometry()
-            if isinstance(wkb, QVariant) and wkb.isNull():
-                return geom
-
-            # Remove \x from string
-            # Related to https://gis.stackexchange.com/questions/411545/use-st-asbinary-from-postgis-in-pyqgis
-            wkb = wkb[2:]
-            geom.fromWkb(binascii.unhexlify(wkb))
-            return geom
+            return self._geometry_from_wkb(results[0][1])
         except Exception as e:
             # Let's be safe
             Logger.log_exception(e)
@@ -299,48 +1210,209 @@ c.user_group && (
                 "Using the QGIS API")
             return self._polygon_for_groups_with_qgis_api(groups)
 
+    @staticmethod
+    def _geometry_from_wkb(wkb: Union[bytes, memoryview, str, QVariant, None]) -> QgsGeometry:
+        """ The geometry from a bytea column, read by psycopg2 or by QGIS. """
+        geom = QgsGeometry()
+        if wkb is None or (isinstance(wkb, QVariant) and wkb.isNull()):
+            return geom
+
+        if isinstance(wkb, str):
+            # QGIS returns a string, remove \x from it
+            # Related to https://gis.stackexchange.com/questions/411545/use-st-asbinary-from-postgis-in-pyqgis
+            wkb = binascii.unhexlify(wkb[2:])
+        geom.fromWkb(bytes(wkb))
+        return geom
+
     @profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
-    def _features_ids_with_qgis_api(self, polygons: QgsGeometry) -> str:
+    def _features_ids_with_qgis_api(self, polygons: TransformedPolygon) -> list:
         """ List all features using the QGIS API.
 
-        :returns: The subset SQL string.
+        :param polygons: The polygon of the groups in the CRS of the filtered layer
+        :returns: The list of primary keys.
         """
         # For other types, we need to find all the ids with an expression
         # And then search for these ids in the substring, as it must be SQL
 
-        # Build the spatial index
-        index = QgsSpatialIndex()
-        index.addFeatures(self.layer.getFeatures())
+        index = self._spatial_index()
+
+        if self.spatial_relationship not in ('contains', 'intersects'):
+            raise Exception("Spatial relationship unknown")
 
-        # Find candidates, if not already in cache
-        transform = QgsCoordinateTransform(self.polygon.crs(), self.layer.crs(), self.project)
-        polygons.transform(transform)
-        candidates = index.intersects(polygons.boundingBox())
+        # Prepared geometry, to check the real relationship for the candidates
+        engine = polygons.engine
+
+        # Find candidates
+        candidates = index.intersects(polygons.geometry.boundingBox())
+
+        # Fetch all candidates at once, only with the primary key
+        request = QgsFeatureRequest()
+        request.setFilterFids(candidates)
+        request.setSubsetOfAttributes([self.primary_key], self.layer.fields())
 
-        # Check real intersection for the candidates
         unique_ids = []
-        for candidate_id in candidates:
-            feature = self.layer.getFeature(candidate_id)
+        for feature in self.layer.getFeatures(request):
+            if not feature.hasGeometry():
+                continue
+
+            # Keep a reference on the geometry, constGet() does not own it
+            geometry = feature.geometry()
             if self.spatial_relationship == 'contains':
-                if feature.geometry().contains(polygons):
-                    unique_ids.append(feature[self.primary_key])
-            elif self.spatial_relationship == 'intersects':
-                if feature.geometry().intersects(polygons):
+                # The polygon contains the feature, like ST_Contains in the subset string
+                if engine.contains(geometry.constGet()):
                     unique_ids.append(feature[self.primary_key])
-            else:
-                raise Exception("Spatial relationship unknown")
+            elif engine.intersects(geometry.constGet()):
+                unique_ids.append(feature[self.primary_key])
+
+        return unique_ids
+
+    def _use_vectorized(self) -> bool:
+        """ If the layer is a single point layer, checked with a bulk point in polygon test. """
+        if not USE_VECTORIZED or self.spatial_relationship != 'intersects':
+            return False
+
+        if not HAS_SHAPELY and not (USE_RAY_CASTING and HAS_NUMPY):
+            return False
+
+        wkb_type = self.layer.wkbType()
+        return QgsWkbTypes.geometryType(wkb_type) == QgsWkbTypes.PointGeometry \
+            and not QgsWkbTypes.isMultiType(wkb_type)
+
+    def _features_ids_with_sqlite(self, polygons: TransformedPolygon) -> Union[list, None]:
+        """ List all features with a single SQL query on the GeoPackage or SpatiaLite file.
+
+        :param polygons: The polygon of the groups in the CRS of the filtered layer
+        :returns: The list of primary keys, None if the file can not be queried directly.
+        """
+        if self.spatial_relationship not in ('contains', 'intersects'):
+            raise Exception("Spatial relationship unknown")
+
+        try:
+            return sqlite_features_ids(
+                self.layer, self.primary_key, polygons.geometry.boundingBox(), polygons.geometry, polygons.engine,
+                self.spatial_relationship, self._use_vectorized())
+        except Exception as e:
+            Logger.log_exception(e)
+            Logger.warning(
+                "The layer {} can not be queried with SQLite, using the QGIS API".format(self.layer.name()))
+            return None
+
+    def _precomputed(self) -> Union[Precomputed, None]:
+        """ Results computed offline for the project, if they are valid for the polygon layer. """
+        if not USE_PRECOMPUTED:
+            return None
+
+        results = precomputed(self.project_file)
+        if results is None or not results.is_valid_for_polygon_layer(self.polygon, self.group_field):
+            return None
+        return results
+
+    def _features_ids_with_membership(self, groups: tuple) -> Union[list, None]:
+        """ List all features from the precomputed features of each polygon.
 
-        return self._format_sql_in(self.primary_key, unique_ids)
+        A feature intersects the union of the polygons if it intersects one of them. The polygons are not reduced
+        like the union, so the membership is not used with a precision tolerance.
+
+        :returns: The list of primary keys, None if the polygon layer is not in memory.
+        """
+        if POLYGON_LAYER_MAX_FEATURES <= 0 or PRECISION_TOLERANCE > 0:
+            return None
+
+        polygons = polygon_layer(self.polygon, self.group_field, CACHE_TTL, POLYGON_LAYER_MAX_FEATURES)
+        if polygons is None:
+            return None
+
+        membership = polygon_membership(
+            self.layer, self.primary_key, polygons, self.polygon.crs(), self.project, CACHE_TTL)
+        return membership.feature_ids(groups)
+
+    @profiling
+    def _features_ids_in_parallel(self, polygons: TransformedPolygon) -> Union[list, None]:
+        """ List all features with a pool of processes, each one evaluating a tile of the polygon.
+
+        :param polygons: The polygon of the groups in the CRS of the filtered layer
+        :returns: The list of primary keys, None if the pool can not be used.
+        """
+        if self.spatial_relationship not in ('contains', 'intersects'):
+            raise Exception("Spatial relationship unknown")
+
+        if not can_spawn_processes():
+            Logger.warning("QGIS Server is not run by Python, the pool of processes can not be used")
+            return None
+
+        # noinspection PyArgumentList
+        uri = QgsProviderRegistry.instance().decodeUri('ogr', self.layer.source())
+        if not uri.get('path'):
+            return None
+
+        search = polygons.geometry.boundingBox()
+        try:
+            return parallel_features_ids(
+                uri['path'],
+                uri.get('layerName'),
+                self.primary_key,
+                bytes(polygons.geometry.asWkb()),
+                self.spatial_relationship,
+                (search.xMinimum(), search.yMinimum(), search.xMaximum(), search.yMaximum()),
+                PARALLEL_WORKERS,
+                PARALLEL_TIMEOUT,
+            )
+        except Exception as e:
+            Logger.log_exception(e)
+            Logger.warning(
+                "The layer {} can not be filtered with the pool of processes, using another method".format(
+                    self.layer.name()))
+            return None
+
+    @staticmethod
+    def _prepared(geometry: QgsGeometry) -> QgsGeometryEngine:
+        """ Prepared geometry engine, the geometry must be kept alive by the caller. """
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        return engine
+
+    def _layer_extent(self) -> Union[QgsRectangle, None]:
+        """ The extent of the request in the CRS of the filtered layer, if any. """
+        if self.extent is None:
+            return None
+
+        try:
+            transform = QgsCoordinateTransform(self.extent.crs(), self.layer.crs(), self.project)
+            return transform.transformBoundingBox(self.extent)
+        except QgsCsException as e:
+            Logger.warning(
+                "The extent of the request can not be transformed to the layer {} CRS : {}".format(
+                    self.layer.name(), str(e)))
+            return None
+
+    @profiling
+    def _spatial_index(self) -> QgsSpatialIndex:
+        """ Spatial index of the filtered layer, kept in the cache until the data is modified. """
+        stamp = layer_stamp(self.layer)
+        key = (self.layer.id(), self.layer.source(), self.layer.subsetString(), stamp)
+        if stamp is not None:
+            index = SPATIAL_INDEX_CACHE.get(key)
+            if index is not None:
+                return index
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([])
+        index = QgsSpatialIndex(self.layer.getFeatures(request))
+
+        if stamp is not None:
+            SPATIAL_INDEX_CACHE.set(
+                key, index, weight=max(self.layer.featureCount(), 1) * SPATIAL_INDEX_BYTES_PER_FEATURE)
+            Logger.info("Spatial index built for layer {} : {}".format(
+                self.layer.name(), SPATIAL_INDEX_CACHE.info()))
+        return index
 
     @profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
-    def _features_ids_with_sql_query(self, st_intersect: str) -> str:
+    def _features_ids_with_sql_query(self, st_intersect: str) -> list:
         """ List all features using a SQL query.
 
         Only for QGIS >= 3.10
 
-        :returns: The subset SQL string.
+        :returns: The list of primary keys.
         """
         uri = QgsDataSourceUri(self.layer.source())
 
@@ -350,51 +1422,132 @@ c.user_group && (
             table=uri.table(),
             st_intersect=st_intersect,
         )
+
+        extent = self._layer_extent()
+        if extent is not None:
+            # Use the spatial index to keep only features in the extent of the request
+            sql += ' AND "{geom}" && ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, {srid})'.format(
+                geom=uri.geometryColumn(),
+                xmin=extent.xMinimum(),
+                ymin=extent.yMinimum(),
+                xmax=extent.xMaximum(),
+                ymax=extent.yMaximum(),
+                srid=self.layer.sourceCrs().postgisSrid(),
+            )
+
         Logger.info(
             "Requesting the database about IDs to filter with {}...".format(sql[0:90]))
 
         results = self.sql_query(uri, sql)
-        unique_ids = [str(row[0]) for row in results]
-
-        return self._format_sql_in(self.primary_key, unique_ids)
+        return [row[0] for row in results]
 
     @classmethod
-    def _format_sql_in(cls, primary_key: str, values: Union[list, Tuple]) -> str:
-        """Format the SQL IN statement."""
+    def _format_sql_in(
+            cls,
+            primary_key: str,
+            values: Union[list, Tuple],
+            filter_type: FilterType = FilterType.SafeSqlQuery,
+            provider: str = '',
+    ) -> str:
+        """Format the SQL IN statement.
+
+        Values are sorted, consecutive integers are written as a range and long lists are split.
+        """
         if not values:
             return NO_FEATURES
 
-        cleaned = []
-        for value in values:
-            if isinstance(value, str):
-                cleaned.append("'{}'".format(value))
+        integers = sorted({v for v in values if isinstance(v, int) and not isinstance(v, bool)})
+        others = sorted({str(v) for v in values if not isinstance(v, int) or isinstance(v, bool)})
+
+        pk = '"{}"'.format(primary_key)
+        parts = []
+
+        # Ranges of consecutive integers
+        singles = []
+        start = 0
+        for i in range(1, len(integers) + 1):
+            if i < len(integers) and integers[i] == integers[i - 1] + 1:
+                continue
+
+            if i - start >= SQL_RANGE_MIN_LENGTH:
+                if filter_type == FilterType.QgisExpression:
+                    # BETWEEN is only available in QGIS expressions since QGIS 3.26
+                    parts.append('({pk} >= {min} AND {pk} <= {max})'.format(
+                        pk=pk, min=integers[start], max=integers[i - 1]))
+                else:
+                    parts.append('{pk} BETWEEN {min} AND {max}'.format(
+                        pk=pk, min=integers[start], max=integers[i - 1]))
             else:
-                cleaned.append(str(value))
+                singles.extend(str(v) for v in integers[start:i])
+            start = i
+
+        if provider == 'postgres' and filter_type == FilterType.SafeSqlQuery and len(singles) > 1:
+            # A single array literal is faster to parse than a list of expressions
+            parts.append('{pk} = ANY(ARRAY[{values}])'.format(pk=pk, values=','.join(singles)))
+            singles = []
+
+        singles.extend("'{}'".format(v.replace("'", "''")) for v in others)
+
+        for i in range(0, len(singles), SQL_IN_CHUNK_SIZE):
+            parts.append('{pk} IN ( {values} )'.format(
+                pk=pk, values=' , '.join(singles[i:i + SQL_IN_CHUNK_SIZE])))
 
-        return '"{pk}" IN ( {values} )'.format(pk=primary_key, values=' , '.join(cleaned))
+        if len(parts) == 1:
+            return parts[0]
+
+        return '( {} )'.format(' OR '.join(parts))
 
     @classmethod
     def _format_sql_st_relationship(
             cls,
             filtered_crs: QgsCoordinateReferenceSystem,
-            filtering_crs: QgsCoordinateReferenceSystem,
             geom_field: str,
             polygons: QgsGeometry,
             use_st_intersect: bool,
+            use_wkb: bool = False,
     ) -> str:
         """If layer is of type PostgreSQL, use a simple ST_Intersects/ST_Contains.
 
+        The polygon must already be in the CRS of the filtered layer, PostGIS does not transform it.
+
+        :param use_wkb: Write the polygon as hexadecimal WKB, faster to parse than WKT
         :returns: The subset SQL string.
         """
+        if use_wkb:
+            geometry = "ST_GeomFromWKB(decode('{wkb}', 'hex'), {crs})".format(
+                wkb=bytes(polygons.asWkb().toHex()).decode(),
+                crs=filtered_crs.postgisSrid(),
+            )
+        else:
+            geometry = "ST_GeomFromText('{wkt}', {crs})".format(
+                wkt=polygons.asWkt(6 if filtered_crs.isGeographic() else 2),
+                crs=filtered_crs.postgisSrid(),
+            )
+
         sql = """
 {function}(
-    ST_Transform(ST_GeomFromText('{wkt}', {from_crs}), {to_crs}),
+    {geometry},
     "{geom_field}"
 )""".format(
             function="ST_Intersects" if use_st_intersect else "ST_Contains",
             geom_field=geom_field,
-            wkt=polygons.asWkt(6 if filtering_crs.isGeographic() else 2),
-            from_crs=filtering_crs.postgisSrid(),
-            to_crs=filtered_crs.postgisSrid()
+            geometry=geometry,
         )
         return sql
+
+
+def _refresh_subset_sql(key: tuple, job: RefreshJob, stamp: tuple) -> None:
+    """ Compute the subset string and store it in the cache, in a background thread.
+
+    Only the psycopg2 connection pool is used, no QGIS layer nor project.
+    """
+    # noinspection PyBroadException
+    try:
+        rows = execute_postgres(CONNECTION_POOL, job.dsn, job.sql, STATEMENT_TIMEOUT)
+    except Exception as e:
+        # The expired entry is not replaced
+        Logger.log_exception(e)
+        return
+
+    result = FilterByPolygon._format_sql_in(job.primary_key, [row[0] for row in rows], job.filter_type, 'postgres')
+    SUBSET_CACHE.set(key, Stamped(stamp, result))
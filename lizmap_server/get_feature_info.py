@@ -2,7 +2,6 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-import json
 import os
 import xml.etree.ElementTree as ET
 
@@ -22,7 +21,11 @@ from qgis.core import (
 )
 from qgis.server import QgsServerFilter
 
-from lizmap_server.core import find_vector_layer, server_feature_id_expression
+from lizmap_server.core import (
+    find_vector_layer,
+    get_lizmap_config,
+    server_feature_id_expression,
+)
 from lizmap_server.logger import Logger, exception_handler
 from lizmap_server.tools import to_bool
 from lizmap_server.tooltip import Tooltip
@@ -152,17 +155,14 @@ class GetFeatureInfoFilter(QgsServerFilter):
                 'request GetFeatureInfo'.format(self.serverInterface().configFilePath()))
             return
 
-        config_path = Path(self.serverInterface().configFilePath() + '.cfg')
-        if not config_path.exists():
+        # Read from the config store, not from the disk for each request
+        cfg = get_lizmap_config(self.serverInterface().configFilePath())
+        if not cfg:
             logger.info(
                 'The QGIS project {} is not a Lizmap project, not possible to process with Lizmap this '
                 'request GetFeatureInfo'.format(self.serverInterface().configFilePath()))
             return
 
-        # str() because the plugin must be compatible Python 3.5
-        with open(str(config_path), 'r', encoding='utf-8') as cfg_file:
-            cfg = json.loads(cfg_file.read())
-
         project = QgsProject.instance()
         relation_manager = project.relationManager()
 
@@ -0,0 +1,142 @@
+"""
+JSON backend used to read Lizmap configs and to write JSON responses.
+
+orjson or ujson are used if installed, otherwise the standard library. The backend can be chosen with
+QGIS_SERVER_LIZMAP_JSON_BACKEND : orjson, ujson or json.
+
+JSON is written directly as UTF-8 bytes, for QgsServerResponse.write. If the faster backend can not read or write
+some data like the standard library, the standard library is used, with the same result and the same errors as
+before :
+* integers bigger than 64 bits,
+* with orjson, NaN and infinity, written as null by orjson, and dates or dataclasses, written by orjson only.
+
+orjson also writes UUID and Enum values, the standard library raises an error for them. They are not used by the
+values read from QGIS.
+
+This module must not import QGIS, so it can be used by benchmarks.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import json
+import math
+import os
+
+from collections import namedtuple
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+Backend = namedtuple('Backend', ['name', 'loads', 'dumps'])
+
+
+def _stdlib_dumps(data: Any) -> bytes:
+    return json.dumps(data).encode('utf-8')
+
+
+def _orjson_loads(data: Union[str, bytes]) -> Any:
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+def _has_non_finite_float(data: Any) -> bool:
+    """ If a float in the data is NaN or infinity. """
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        value_type = type(value)
+        if value_type is float:
+            if not math.isfinite(value):
+                return True
+        elif value_type is dict:
+            stack.extend(value.values())
+        elif value_type is list or value_type is tuple:
+            stack.extend(value)
+    return False
+
+
+def _orjson_unsupported(value: Any) -> Any:
+    """ Called by orjson for values the standard library can not write. """
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def _orjson_dumps(data: Any) -> bytes:
+    try:
+        # Keys of the results of the expression service can be integers
+        # Dates, dataclasses and subclasses of builtin types are given to the standard library
+        content = orjson.dumps(
+            data,
+            default=_orjson_unsupported,
+            option=(
+                orjson.OPT_NON_STR_KEYS
+                | orjson.OPT_PASSTHROUGH_DATETIME
+                | orjson.OPT_PASSTHROUGH_DATACLASS
+                | orjson.OPT_PASSTHROUGH_SUBCLASS
+            ),
+        )
+    except TypeError:
+        return _stdlib_dumps(data)
+
+    # Looking for NaN costs almost as much as the standard library, only if orjson might have written some
+    if b'null' in content and _has_non_finite_float(data):
+        return _stdlib_dumps(data)
+    return content
+
+
+def _ujson_loads(data: Union[str, bytes]) -> Any:
+    try:
+        return ujson.loads(data)
+    except ValueError:
+        return json.loads(data)
+
+
+def _ujson_dumps(data: Any) -> bytes:
+    try:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+    except (TypeError, OverflowError):
+        return _stdlib_dumps(data)
+
+
+BACKENDS = {
+    'orjson': Backend('orjson', _orjson_loads, _orjson_dumps) if orjson else None,
+    'ujson': Backend('ujson', _ujson_loads, _ujson_dumps) if ujson else None,
+    'json': Backend('json', json.loads, _stdlib_dumps),
+}
+
+
+def available_backends() -> list:
+    """ Names of the installed backends, the fastest first. """
+    return [name for name, backend in BACKENDS.items() if backend is not None]
+
+
+def get_backend(name: str = '') -> Backend:
+    """ The backend with the given name if installed, otherwise the fastest installed one. """
+    backend = BACKENDS.get(name.strip().lower())
+    if backend is not None:
+        return backend
+    return BACKENDS[available_backends()[0]]
+
+
+BACKEND = get_backend(os.getenv('QGIS_SERVER_LIZMAP_JSON_BACKEND', ''))
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """ Read JSON from a string or from UTF-8 bytes. """
+    return BACKEND.loads(data)
+
+
+def dumps(data: Any) -> bytes:
+    """ Write JSON as UTF-8 bytes. """
+    return BACKEND.dumps(data)
@@ -11,22 +11,24 @@ from qgis.core import (
 )
 from qgis.server import QgsAccessControlFilter, QgsServerInterface
 
-from lizmap_server.core import (
-    get_lizmap_config,
-    get_lizmap_groups,
-    get_lizmap_layer_login_filter,
-    get_lizmap_layers_config,
-    get_lizmap_override_filter,
-    get_lizmap_user_login,
-    is_editing_context,
-)
+from lizmap_server.compiled_config import LoginFilter
 from lizmap_server.filter_by_polygon import (
     ALL_FEATURES,
     NO_FEATURES,
+    USE_SPATIAL_PREDICATE,
+    USE_SQL_EXISTS,
     FilterByPolygon,
+    FilterType,
 )
 from lizmap_server.logger import Logger, profiling
-from lizmap_server.tools import to_bool
+from lizmap_server.request_context import ANONYMOUS_GROUPS, request_context
+
+
+def layer_filter_expression_available() -> bool:
+    """ If QGIS Server uses the layer filter expression given by the access control. """
+    # Disabling Lizmap layer filter expression for QGIS Server <= 3.16.1 and <= 3.10.12
+    # Fix in QGIS Server https://github.com/qgis/QGIS/pull/40556 3.18.0, 3.16.2, 3.10.13
+    return 31013 <= Qgis.QGIS_VERSION_INT < 31099 or 31602 <= Qgis.QGIS_VERSION_INT
 
 
 class LizmapAccessControlFilter(QgsAccessControlFilter):
@@ -38,11 +40,9 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
     def layerFilterExpression(self, layer: QgsVectorLayer) -> str:
         """ Return an additional expression filter """
-        # Disabling Lizmap layer filter expression for QGIS Server <= 3.16.1 and <= 3.10.12
-        # Fix in QGIS Server https://github.com/qgis/QGIS/pull/40556 3.18.0, 3.16.2, 3.10.13
-        if 31013 <= Qgis.QGIS_VERSION_INT < 31099 or 31602 <= Qgis.QGIS_VERSION_INT:
+        if layer_filter_expression_available():
             Logger.info("Lizmap layerFilterExpression")
-            filter_exp = self.get_lizmap_layer_filter(layer)
+            filter_exp = self.get_lizmap_layer_filter(layer, FilterType.QgisExpression)
             if filter_exp:
                 return filter_exp
 
@@ -57,7 +57,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
     def layerFilterSubsetString(self, layer: QgsVectorLayer) -> str:
         """ Return an additional subset string (typically SQL) filter """
         Logger.info("Lizmap layerFilterSubsetString")
-        filter_exp = self.get_lizmap_layer_filter(layer)
+        filter_exp = self.get_lizmap_layer_filter(layer, FilterType.SafeSqlQuery)
         if filter_exp:
             return filter_exp
 
@@ -68,16 +68,18 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         # Get default layer rights
         rights = super().layerPermissions(layer)
 
+        context = request_context(self.iface)
+
         # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(self.iface.requestHandler())
+        groups = context.groups
 
         # Set lizmap variables
-        user_login = get_lizmap_user_login(self.iface.requestHandler())
+        user_login = context.login
         project = QgsProject.instance()
         custom_var = project.customVariables()
         if custom_var.get('lizmap_user', None) != user_login:
             custom_var['lizmap_user'] = user_login
-            custom_var['lizmap_user_groups'] = list(groups)  # QGIS can't store a tuple
+            custom_var['lizmap_user_groups'] = sorted(groups)  # QGIS can't store a tuple
             project.setCustomVariables(custom_var)
 
         # If groups is empty, no Lizmap user groups provided by the request
@@ -86,14 +88,8 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return rights
 
         # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
-        if not cfg:
-            # Default layer rights applied
-            return rights
-
-        # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
-        if not cfg_layers:
+        compiled = context.compiled
+        if not compiled or not compiled.layers_by_name:
             # Default layer rights applied
             return rights
 
@@ -102,92 +98,54 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
         # Check lizmap edition config
         layer_id = layer.id()
-        if 'editionLayers' in cfg and cfg['editionLayers']:
-            if layer_id in cfg['editionLayers'] and cfg['editionLayers'][layer_id]:
-                edit_layer = cfg['editionLayers'][layer_id]
-
-                # Check if edition is possible
-                # By default not
-                can_edit = False
-                if 'acl' in edit_layer and edit_layer['acl']:
-                    # acl is defined and not an empty string
-                    # authorization defined for edition
-                    group_edit = edit_layer['acl'].split(',')
-                    group_edit = [g.strip() for g in group_edit]
-
-                    # check if a group is in authorization groups list
-                    if len(group_edit) != 0:
-                        for g in groups:
-                            if g in group_edit:
-                                can_edit = True
-                    else:
-                        can_edit = True
-                else:
-                    # acl is not defined or an empty string
-                    # no authorization defined for edition
-                    can_edit = True
-
-                if can_edit and 'capabilities' in edit_layer and edit_layer['capabilities']:
-                    # A user group can edit the layer and capabilities
-                    # edition for the layer is defined in Lizmap edition config
-                    edit_layer_cap = cfg['editionLayers'][layer_id]['capabilities']
-
-                    rights.canInsert = to_bool(edit_layer_cap['createFeature'])
-                    rights.canDelete = to_bool(edit_layer_cap['deleteFeature'])
-                    rights.canUpdate = any([
-                        to_bool(edit_layer_cap['modifyAttribute']),
-                        to_bool(edit_layer_cap['modifyGeometry']),
-                    ])
-
-                else:
-                    # Any user groups can edit the layer or capabilities
-                    # edition for the layer is not defined in Lizmap
-                    # edition config
-                    # Reset edition rights
-                    rights.canInsert = rights.canUpdate = rights.canDelete = False
-            else:
-                # The layer has no editionLayers config defined
-                # Reset edition rights
+        edit_layer = compiled.edition_layers.get(layer_id)
+        if edit_layer is None:
+            # The layer has no editionLayers config defined
+            # Reset edition rights
+            if compiled.edition_layers:
                 Logger.info(
                     "No edition config defined for layer: %s (%s)" % (layer_name, layer_id))
-                rights.canInsert = rights.canUpdate = rights.canDelete = False
+            else:
+                Logger.info("Lizmap config has no editionLayers")
+            rights.canInsert = rights.canUpdate = rights.canDelete = False
+        elif edit_layer.acl is None or not groups.isdisjoint(edit_layer.acl):
+            # No authorization defined for edition, or a user group can edit the layer
+            # The capabilities are False if not defined in Lizmap edition config
+            rights.canInsert = edit_layer.can_insert
+            rights.canDelete = edit_layer.can_delete
+            rights.canUpdate = edit_layer.can_update
         else:
-            # No editionLayers defined
+            # Any user groups can edit the layer
             # Reset edition rights
-            Logger.info("Lizmap config has no editionLayers")
             rights.canInsert = rights.canUpdate = rights.canDelete = False
 
         # Check Lizmap layer config
-        if layer_name not in cfg_layers or not cfg_layers[layer_name]:
+        cfg_layer = compiled.layers_by_name.get(layer_name)
+        if cfg_layer is None:
             # Lizmap layer config not defined
             Logger.info("Lizmap config has no layer: %s" % layer_name)
             # Default layer rights applied
             return rights
 
         # Check Lizmap layer group visibility
-        cfg_layer = cfg_layers[layer_name]
-        if 'group_visibility' not in cfg_layer or not cfg_layer['group_visibility']:
+        if cfg_layer.group_visibility is None:
             # Lizmap config has no options
             Logger.info("No Lizmap layer group visibility for: %s" % layer_name)
             # Default layer rights applied
             return rights
 
-        # Get Lizmap layer group visibility
-        group_visibility = [g.strip() for g in cfg_layer['group_visibility']]
-
         # If one Lizmap user group provided in request headers is
         # defined in Lizmap layer group visibility, the default layer
         # rights is applied
-        for g in groups:
-            if g in group_visibility:
-                Logger.info(
-                    "Group %s is in Lizmap layer group visibility for: %s" % (g, layer_name))
-                return rights
+        if not groups.isdisjoint(cfg_layer.group_visibility):
+            Logger.info(
+                "Groups %s are in Lizmap layer group visibility for: %s" % (', '.join(sorted(groups)), layer_name))
+            return rights
 
         # The lizmap user groups provided gy the request are not
         # authorized to get access to the layer
         Logger.info(
-            "Groups %s is in Lizmap layer group visibility for: %s" % (', '.join(groups), layer_name))
+            "Groups %s is in Lizmap layer group visibility for: %s" % (', '.join(sorted(groups)), layer_name))
         rights.canRead = False
         rights.canInsert = rights.canUpdate = rights.canDelete = False
         return rights
@@ -205,8 +163,10 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         """ The key used to cache documents """
         default_cache_key = super().cacheKey()
 
+        context = request_context(self.iface)
+
         # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(self.iface.requestHandler())
+        groups = context.groups
 
         # If groups is empty, no Lizmap user groups provided by the request
         # The default cache key is returned
@@ -214,82 +174,60 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return default_cache_key
 
         # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
-        if not cfg:
-            # The default cache key is returned
-            return default_cache_key
-
-        # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
-        if not cfg_layers:
+        compiled = context.compiled
+        if not compiled:
             # The default cache key is returned
             return default_cache_key
 
-        # Check group_visibility in Lizmap config layers
-        has_group_visibility = False
-        for l_name, cfg_layer in cfg_layers.items():
-            # check group_visibility in config
-            if 'group_visibility' not in cfg_layer or not cfg_layer['group_visibility']:
-                continue
-
-            # clean group_visibility
-            group_visibility = [g.strip() for g in cfg_layer['group_visibility']]
-
-            # the group_visibility was just an empty string
-            if len(group_visibility) == 1 and groups[0] == '':
-                continue
-
-            has_group_visibility = True
-            break
-
         # group_visibility option is defined in Lizmap config layers
-        if has_group_visibility:
+        if compiled.has_group_visibility:
             # The group provided in request is anonymous
-            if len(groups) == 1 and groups[0] == '':
+            if groups == ANONYMOUS_GROUPS:
                 return '@@'
-            # for other groups, removing duplicates and joining
-            return '@@'.join(list(set(groups)))
+            # for other groups, already without duplicates, sorted to have the same key for the same groups
+            return '@@'.join(sorted(groups))
 
         return default_cache_key
 
     @profiling
-    def get_lizmap_layer_filter(self, layer: QgsVectorLayer) -> str:
-        """ Get lizmap layer filter based on login filter """
+    def get_lizmap_layer_filter(
+            self, layer: QgsVectorLayer, filter_type: FilterType = FilterType.SafeSqlQuery) -> str:
+        """ Get lizmap layer filter based on login filter
+
+        :param layer: The layer to filter
+        :param filter_type: If the filter is a QGIS expression or a SQL subset string
+        """
+
+        context = request_context(self.iface)
 
-        # Check first the headers to avoid unnecessary config file reading
         # Override filter
-        if get_lizmap_override_filter(self.iface.requestHandler()):
+        if context.override:
             return ALL_FEATURES
 
-        # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(self.iface.requestHandler())
-        user_login = get_lizmap_user_login(self.iface.requestHandler())
+        # Get Lizmap user groups provided by the request, sorted to always write the same filter
+        groups = tuple(sorted(context.groups))
+        user_login = context.login
 
         # If groups is empty, no Lizmap user groups provided by the request
         if len(groups) == 0 and not user_login:
             return ALL_FEATURES
 
-        # If headers content implies to check for filter, read the Lizmap config
         # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
-        if not cfg:
-            return ALL_FEATURES
-
-        # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
-        if not cfg_layers:
+        compiled = context.compiled
+        if not compiled:
             return ALL_FEATURES
 
         # Get layer name
         layer_name = layer.name()
         # Check the layer in the CFG
-        if layer_name not in cfg_layers:
+        if layer_name not in compiled.layers_by_name:
             return ALL_FEATURES
 
         try:
-            edition_context = is_editing_context(self.iface.requestHandler())
             filter_polygon_config = FilterByPolygon(
-                cfg.get("filter_by_polygon"), layer, edition_context, use_st_relationship=False)
+                compiled.filter_by_polygon, layer, context.editing, use_st_relationship=False,
+                filter_type=filter_type, extent=context.extent, use_sql_exists=USE_SQL_EXISTS,
+                layers=compiled.polygon_filter_layers, use_spatial_predicate=USE_SPATIAL_PREDICATE)
             polygon_filter = ALL_FEATURES
             if filter_polygon_config.is_filtered():
                 if not filter_polygon_config.is_valid():
@@ -298,8 +236,16 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
                         "{}".format(NO_FEATURES))
                     return NO_FEATURES
 
-                # polygon_filter is set, we have a value to filter
-                polygon_filter, _ = filter_polygon_config.subset_sql(groups)
+                if filter_type == FilterType.SafeSqlQuery and filter_polygon_config.uses_expression_function() \
+                        and layer_filter_expression_available():
+                    # The layer filter expression with lizmap_in_user_polygon is enough
+                    Logger.info("The layer {} is filtered by polygon with an expression".format(layer_name))
+                elif filter_type == FilterType.QgisExpression and filter_polygon_config.uses_sql_exists():
+                    # The subset string with the subquery on the polygon table is enough
+                    Logger.info("The layer {} is filtered by polygon with a subquery".format(layer_name))
+                else:
+                    # polygon_filter is set, we have a value to filter
+                    polygon_filter, _ = filter_polygon_config.subset_sql(groups, with_polygon=False)
 
         except Exception as e:
             Logger.log_exception(e)
@@ -312,24 +258,23 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             Logger.info("The polygon filter subset string is not null : {}".format(polygon_filter))
 
         # Get layer login filter
-        cfg_layer_login_filter = get_lizmap_layer_login_filter(cfg, layer_name)
-        if not cfg_layer_login_filter:
+        login_filter_config = compiled.login_filters.get(layer_name)
+        if not login_filter_config:
             if polygon_filter:
                 return polygon_filter
             return ALL_FEATURES
 
         # Layer login filter only for edition does not filter layer
-        is_edition_only = 'edition_only' in cfg_layer_login_filter
-        if is_edition_only and to_bool(cfg_layer_login_filter['edition_only']):
+        if login_filter_config.edition_only:
             if polygon_filter:
                 return polygon_filter
             return ALL_FEATURES
 
-        attribute = cfg_layer_login_filter['filterAttribute']
+        attribute = login_filter_config.attribute
 
         # If groups is not empty but the only group like user login has no name
         # Return the filter for no user connected
-        if len(groups) == 1 and groups[0] == '' and user_login == '':
+        if context.groups == ANONYMOUS_GROUPS and user_login == '':
 
             # Default filter for no user connected
             # we use expression tools also for subset string
@@ -339,24 +284,24 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
             return login_filter
 
-        login_filter = self._filter_by_login(cfg_layer_login_filter, groups, user_login)
+        login_filter = self._filter_by_login(login_filter_config, groups, user_login)
         if polygon_filter:
             return '{} AND {}'.format(polygon_filter, login_filter)
 
         return login_filter
 
     @staticmethod
-    def _filter_by_login(cfg_layer_login_filter: dict, groups: tuple, login: str) -> str:
+    def _filter_by_login(login_filter_config: LoginFilter, groups: tuple, login: str) -> str:
         """ Build the string according to the filter by login configuration.
 
-        :param cfg_layer_login_filter: The Lizmap Filter by login configuration.
+        :param login_filter_config: The Lizmap Filter by login configuration.
         :param groups: List of groups for the current user
         :param login: The current user
         """
         # List of quoted values for expression
         quoted_values = []
 
-        if to_bool(cfg_layer_login_filter['filterPrivate']):
+        if login_filter_config.private:
             # If filter is private use user_login
             quoted_values.append(QgsExpression.quotedString(login))
         else:
@@ -368,7 +313,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
         # Build filter
         layer_filter = '{} IN ({})'.format(
-            QgsExpression.quotedColumnRef(cfg_layer_login_filter['filterAttribute']),
+            QgsExpression.quotedColumnRef(login_filter_config.attribute),
             ', '.join(quoted_values)
         )
 
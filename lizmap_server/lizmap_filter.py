@@ -5,9 +5,12 @@ __email__ = 'info@3liz.org'
 from qgis.core import QgsProject
 from qgis.server import QgsServerFilter, QgsServerInterface
 
-from lizmap_server.core import get_lizmap_config, get_lizmap_groups
 from lizmap_server.exception import LizmapFilterException
 from lizmap_server.logger import Logger
+from lizmap_server.request_context import (
+    build_request_context,
+    set_request_context,
+)
 
 
 class LizmapFilter(QgsServerFilter):
@@ -20,11 +23,16 @@ class LizmapFilter(QgsServerFilter):
 
     def requestReady(self):
         logger = Logger()
+        # The context of a previous request must never be used
+        set_request_context(None)
         # noinspection PyBroadException
         try:
-            # Check first the headers to avoid unnecessary config file reading
+            # Read once the headers and the parameters, used by all hooks of the request
+            context = build_request_context(self.iface)
+            set_request_context(context)
+
             # Get Lizmap user groups defined in request headers
-            groups = get_lizmap_groups(self.iface.requestHandler())
+            groups = context.groups
 
             # If groups is empty, no Lizmap user groups provided by the request
             # The request can be evaluated by QGIS Server
@@ -32,38 +40,27 @@ class LizmapFilter(QgsServerFilter):
                 return
 
             # Get Lizmap config
-            cfg = get_lizmap_config(self.iface.configFilePath())
-            if not cfg:
+            compiled = context.compiled
+            if not compiled:
                 # Lizmap config is empty
                 logger.warning("Lizmap config is empty")
                 # The request can be evaluated by QGIS Server
                 return
 
-            # Check Lizmap config options
-            if 'options' not in cfg or not cfg['options']:
-                # Lizmap config has no options
-                logger.warning("Lizmap config has no options")
-                # The request can be evaluated by QGIS Server
-                return
-
             # Check project acl option
-            cfg_options = cfg['options']
-            if 'acl' not in cfg_options or not cfg_options['acl']:
+            if compiled.acl is None:
                 # No acl defined
                 logger.info("No acl defined in Lizmap config")
                 # The request can be evaluated by QGIS Server
                 return
 
-            # Get project acl option
-            cfg_acl = cfg_options['acl']
             logger.info("Acl defined in Lizmap config")
 
             # If one Lizmap user group provided in request headers is
             # defined in project acl option, the request can be evaluated
             # by QGIS Server
-            for group in groups:
-                if group in cfg_acl:
-                    return
+            if not groups.isdisjoint(compiled.acl):
+                return
 
             # The lizmap user groups provided in request header are not
             # authorized to get access to the QGIS Project
@@ -78,6 +75,8 @@ class LizmapFilter(QgsServerFilter):
             logger.log_exception(e)
 
     def responseComplete(self):
+        set_request_context(None)
+
         # Remove lizmap variables for expression
         project = QgsProject.instance()
         custom_var = project.customVariables()
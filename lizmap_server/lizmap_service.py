@@ -17,11 +17,6 @@ from qgis.server import (
 
 from lizmap_server.core import (
     find_vector_layer_from_params,
-    get_lizmap_config,
-    get_lizmap_groups,
-    get_lizmap_layers_config,
-    get_lizmap_override_filter,
-    is_editing_context,
     write_json_response,
 )
 from lizmap_server.exception import ServiceError
@@ -31,6 +26,7 @@ from lizmap_server.filter_by_polygon import (
     FilterByPolygon,
 )
 from lizmap_server.logger import Logger, profiling
+from lizmap_server.request_context import request_context
 from lizmap_server.tools import version
 
 
@@ -119,36 +115,30 @@ class LizmapService(QgsService):
             'polygons': ''
         }
 
-        # Check first the headers to avoid unnecessary config file reading
+        context = request_context(self.server_iface)
+
         # Override filter
-        if get_lizmap_override_filter(self.server_iface.requestHandler()):
+        if context.override:
             write_json_response(body, response)
             return
 
-        # If headers content implies to check for filter, read the Lizmap config
         # Get Lizmap config
-        cfg = get_lizmap_config(self.server_iface.configFilePath())
-        if not cfg:
-            write_json_response(body, response)
-            return
-
-        # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
-        if not cfg_layers:
+        compiled = context.compiled
+        if not compiled:
             write_json_response(body, response)
             return
 
         # Get layer name
         layer_name = layer.name()
         # Check the layer in the CFG
-        if layer_name not in cfg_layers:
+        if layer_name not in compiled.layers_by_name:
             write_json_response(body, response)
             return
 
         try:
-            edition_context = is_editing_context(self.server_iface.requestHandler())
             filter_polygon_config = FilterByPolygon(
-                cfg.get("filter_by_polygon"), layer, edition_context, use_st_relationship=False)
+                compiled.filter_by_polygon, layer, context.editing, use_st_relationship=False,
+                layers=compiled.polygon_filter_layers)
             if filter_polygon_config.is_filtered():
                 if not filter_polygon_config.is_valid():
                     Logger.critical(
@@ -162,7 +152,7 @@ class LizmapService(QgsService):
                     return
                 else:
                     # Get Lizmap user groups provided by the request
-                    groups = get_lizmap_groups(self.server_iface.requestHandler())
+                    groups = tuple(sorted(context.groups))
                     # polygon_filter is set, we have a value to filter
                     sql, polygons = filter_polygon_config.subset_sql(groups)
                     body = {
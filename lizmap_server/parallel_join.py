@@ -0,0 +1,189 @@
+"""
+Spatial join between a polygon and a layer stored in a file, split in tiles evaluated by a pool of processes.
+
+This module must not import QGIS, it is imported by each process of the pool, which only uses OGR.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple, Union
+
+# Number of tiles given to each process
+TILES_PER_WORKER = 4
+
+_EXECUTOR = None
+_EXECUTOR_WORKERS = 0
+_LOCK = threading.Lock()
+
+
+def tiles(rectangle: Tuple[float, float, float, float], count: int) -> List[Tuple[float, float, float, float]]:
+    """ Split the rectangle (xmin, ymin, xmax, ymax) in a grid of at least the given number of tiles. """
+    x_min, y_min, x_max, y_max = rectangle
+    columns = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / columns))
+    width = (x_max - x_min) / columns
+    height = (y_max - y_min) / rows
+
+    result = []
+    for column in range(columns):
+        for row in range(rows):
+            result.append((
+                x_min + column * width,
+                y_min + row * height,
+                x_max if column == columns - 1 else x_min + (column + 1) * width,
+                y_max if row == rows - 1 else y_min + (row + 1) * height,
+            ))
+    return result
+
+
+def tile_features_ids(
+        path: str, layer_name: Union[str, None], primary_key: str, wkb: bytes, relationship: str,
+        tile: Tuple[float, float, float, float]) -> list:
+    """ Primary keys of the features in the polygon, among the features intersecting the tile.
+
+    Run in a process of the pool.
+    """
+    from osgeo import ogr
+
+    dataset = ogr.Open(path, 0)
+    if dataset is None:
+        raise IOError('The file {} can not be opened'.format(path))
+
+    layer = dataset.GetLayerByName(layer_name) if layer_name else dataset.GetLayer(0)
+    if layer is None:
+        raise IOError('The layer {} is not in {}'.format(layer_name, path))
+
+    polygon = ogr.CreateGeometryFromWkb(wkb)
+    x_min, y_min, x_max, y_max = tile
+    if relationship == 'intersects':
+        # A feature intersecting the polygon intersects the part of the polygon in one of the tiles
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)):
+            ring.AddPoint_2D(x, y)
+        rectangle = ogr.Geometry(ogr.wkbPolygon)
+        rectangle.AddGeometry(ring)
+        polygon = polygon.Intersection(rectangle)
+        if polygon is None or polygon.IsEmpty():
+            return []
+
+    # The feature ID is not a field for some formats, like the fid column of a GeoPackage
+    use_fid = layer.GetFIDColumn() == primary_key
+    layer.SetSpatialFilterRect(x_min, y_min, x_max, y_max)
+    layer.SetIgnoredFields([
+        layer.GetLayerDefn().GetFieldDefn(i).GetName()
+        for i in range(layer.GetLayerDefn().GetFieldCount())
+        if layer.GetLayerDefn().GetFieldDefn(i).GetName() != primary_key
+    ])
+
+    unique_ids = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+
+        if relationship == 'contains':
+            # The polygon contains the feature
+            found = polygon.Contains(geometry)
+        else:
+            found = geometry.Intersects(polygon)
+
+        if found:
+            unique_ids.append(feature.GetFID() if use_fid else feature.GetField(primary_key))
+
+    return unique_ids
+
+
+def can_spawn_processes() -> bool:
+    """ If new Python processes can be started, QGIS Server might be embedded in another executable. """
+    executable = os.path.basename(sys.executable or '')
+    return executable.startswith('python')
+
+
+def _executor(workers: int) -> ProcessPoolExecutor:
+    """ The pool of processes, kept between requests. """
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _LOCK:
+        if _EXECUTOR is None or _EXECUTOR_WORKERS != workers:
+            if _EXECUTOR is not None:
+                _EXECUTOR.shutdown(wait=False)
+            # Not forked, the server process has threads and QGIS resources
+            _EXECUTOR = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _EXECUTOR_WORKERS = workers
+        return _EXECUTOR
+
+
+def _reset_executor(executor: ProcessPoolExecutor) -> None:
+    """ Drop a broken or stuck pool, the next call starts a new one. """
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _LOCK:
+        if _EXECUTOR is executor:
+            _EXECUTOR = None
+            _EXECUTOR_WORKERS = 0
+    # Running tasks are not stopped, their processes exit once they are done
+    executor.shutdown(wait=False)
+
+
+def parallel_features_ids(
+        path: str, layer_name: Union[str, None], primary_key: str, wkb: bytes, relationship: str,
+        rectangle: Tuple[float, float, float, float], workers: int, timeout: float = 0) -> list:
+    """ Primary keys of the features in the polygon, evaluated tile by tile by a pool of processes.
+
+    If a process dies or if the timeout is reached, the pool is dropped and the error is raised, so the caller can
+    use another method.
+
+    :param path: The file of the layer
+    :param layer_name: The layer in the file, the first layer if None
+    :param primary_key: The field to return
+    :param wkb: The polygon, in the CRS of the layer
+    :param relationship: 'intersects' or 'contains', the polygon contains the feature
+    :param rectangle: Only features intersecting this rectangle (xmin, ymin, xmax, ymax) are candidates
+    :param workers: Number of processes
+    :param timeout: Number of seconds to wait for all tiles, 0 to wait until they are done
+    """
+    executor = _executor(workers)
+    deadline = time.monotonic() + timeout if timeout > 0 else None
+    futures = []
+    # A feature on several tiles is found several times
+    unique_ids = set()
+    try:
+        for tile in tiles(rectangle, workers * TILES_PER_WORKER):
+            futures.append(
+                executor.submit(tile_features_ids, path, layer_name, primary_key, wkb, relationship, tile))
+
+        for future in futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            unique_ids.update(future.result(timeout=remaining))
+    except (BrokenProcessPool, FuturesTimeoutError):
+        for future in futures:
+            future.cancel()
+        _reset_executor(executor)
+        raise
+    except Exception:
+        # The other tiles are useless
+        for future in futures:
+            future.cancel()
+        raise
+
+    return list(unique_ids)
+
+
+def shutdown() -> None:
+    """ Stop the pool of processes. """
+    global _EXECUTOR, _EXECUTOR_WORKERS
+    with _LOCK:
+        if _EXECUTOR is not None:
+            _EXECUTOR.shutdown(wait=True)
+        _EXECUTOR = None
+        _EXECUTOR_WORKERS = 0
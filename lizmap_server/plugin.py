@@ -4,6 +4,8 @@ __email__ = 'info@3liz.org'
 
 from qgis.server import QgsServerInterface, QgsServerOgcApi
 
+from lizmap_server import json_backend
+from lizmap_server.expression_functions import register_expression_functions
 from lizmap_server.expression_service import ExpressionService
 from lizmap_server.get_feature_info import GetFeatureInfoFilter
 from lizmap_server.lizmap_accesscontrol import LizmapAccessControlFilter
@@ -12,6 +14,7 @@ from lizmap_server.lizmap_service import LizmapService
 from lizmap_server.logger import Logger
 from lizmap_server.server_info_handler import ServerInfoHandler
 from lizmap_server.tools import check_environment_variable, version
+from lizmap_server.transaction_filter import TransactionFilter
 
 
 class LizmapServer:
@@ -23,6 +26,7 @@ class LizmapServer:
         self.logger = Logger()
         self.version = version()
         self.logger.info('Init server version "{}"'.format(self.version))
+        self.logger.info('JSON backend "{}"'.format(json_backend.BACKEND.name))
 
         service_registry = server_iface.serviceRegistry()
 
@@ -39,6 +43,9 @@ class LizmapServer:
 
         check_environment_variable()
 
+        register_expression_functions()
+        self.logger.info('Expression functions loaded')
+
         # Register service
         try:
             service_registry.registerService(ExpressionService())
@@ -74,3 +81,10 @@ class LizmapServer:
             self.logger.critical('Error loading filter "get feature info" : {}'.format(e))
             raise
         self.logger.info('Filter "get feature info" loaded')
+
+        try:
+            server_iface.registerFilter(TransactionFilter(self.server_iface), 200)
+        except Exception as e:
+            self.logger.critical('Error loading filter "transaction" : {}'.format(e))
+            raise
+        self.logger.info('Filter "transaction" loaded')
@@ -0,0 +1,141 @@
+"""
+In memory copy of the polygon layer used by the filter by polygon.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import re
+import time
+
+from collections import defaultdict
+from typing import Iterable, List, Union
+
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsVectorLayer,
+)
+
+from lizmap_server.cache import LRUCache
+from lizmap_server.change_detection import layer_stamp
+from lizmap_server.logger import Logger, profiling
+
+# Same characters as the SQL query used for a PostgreSQL polygon layer
+GROUP_SEPARATOR_SQL = re.compile(r'[^a-zA-Z0-9_-]')
+
+LAYERS = LRUCache(maxsize=20)
+
+
+def split_groups(value: Union[str, None], postgres: bool) -> frozenset:
+    """ Split a list of groups, from the polygon layer or from the user.
+
+    :param value: The list of groups
+    :param postgres: If the polygon layer is stored in PostgreSQL, any special character is a separator
+    """
+    if not isinstance(value, str):
+        # NULL from QGIS
+        return frozenset()
+
+    if postgres:
+        groups = GROUP_SEPARATOR_SQL.split(value)
+    else:
+        groups = [g.strip() for g in value.split(',')]
+
+    return frozenset(g for g in groups if g)
+
+
+class PolygonLayer:
+
+    def __init__(self, layer: QgsVectorLayer, group_field: str) -> None:
+        """ Load all polygons and their groups in memory.
+
+        :param layer: The polygon layer
+        :param group_field: The field with the list of groups, separated by a comma
+        """
+        self.layer_id = layer.id()
+        self.source = layer.source()
+        self.group_field = group_field
+        # PostgreSQL layers were filtered with a SQL query, keep the same behavior
+        self.postgres = layer.providerType() == 'postgres'
+        self.stamp = layer_stamp(layer)
+        self.loaded = time.monotonic()
+
+        # Feature ID -> geometry and groups
+        self.geometries = {}
+        self.groups = {}
+        # Group -> set of feature IDs
+        self.features = defaultdict(set)
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([group_field], layer.fields())
+        for feature in layer.getFeatures(request):
+            if not feature.hasGeometry():
+                continue
+
+            groups = self.split_groups(feature[group_field])
+            if not groups:
+                continue
+
+            self.geometries[feature.id()] = feature.geometry()
+            self.groups[feature.id()] = groups
+            for group in groups:
+                self.features[group].add(feature.id())
+
+    def split_groups(self, value: Union[str, None]) -> frozenset:
+        """ Split a list of groups, from the layer or from the user. """
+        return split_groups(value, self.postgres)
+
+    def feature_ids(self, groups: Iterable[str]) -> List[int]:
+        """ Sorted feature IDs of polygons for the given user groups. """
+        ids = set()
+        for group in self.split_groups(','.join(groups)):
+            ids.update(self.features.get(group, ()))
+        return sorted(ids)
+
+    def polygon_for_groups(self, groups: Iterable[str]) -> QgsGeometry:
+        """ All polygons for the given user groups, in a single geometry. """
+        geometries = [self.geometries[fid] for fid in self.feature_ids(groups)]
+        if self.postgres and geometries:
+            # Like ST_Union
+            return QgsGeometry.unaryUnion(geometries)
+        return QgsGeometry.collectGeometry(geometries)
+
+    def is_up_to_date(self, layer: QgsVectorLayer, ttl: float) -> bool:
+        """ If the copy is still valid for the layer.
+
+        If changes of the data can be detected, the stamp is checked. Otherwise, the copy is valid during the TTL.
+        """
+        if layer.source() != self.source:
+            return False
+
+        if self.stamp is not None:
+            return layer_stamp(layer) == self.stamp
+
+        return ttl <= 0 or time.monotonic() - self.loaded <= ttl
+
+
+@profiling
+def polygon_layer(
+        layer: QgsVectorLayer, group_field: str, ttl: float, max_features: int) -> Union[PolygonLayer, None]:
+    """ The in memory copy of the polygon layer, loaded or refreshed if needed.
+
+    None if the layer has too many features to be kept in memory.
+    """
+    key = (layer.id(), group_field)
+    copy = LAYERS.get(key)
+    if copy is not None and copy.is_up_to_date(layer, ttl):
+        return copy
+
+    if 0 < max_features < layer.featureCount():
+        Logger.info(
+            "The polygon layer {} has more than {} features, it is not loaded in memory".format(
+                layer.name(), max_features))
+        return None
+
+    copy = PolygonLayer(layer, group_field)
+    LAYERS.set(key, copy)
+    Logger.info("Polygon layer {} loaded in memory with {} polygons and {} groups".format(
+        layer.name(), len(copy.geometries), len(copy.features)))
+    return copy
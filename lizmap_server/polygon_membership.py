@@ -0,0 +1,133 @@
+"""
+For a filtered layer, the features intersecting each polygon of the polygon layer.
+
+The features of a user are then the union of the features of the polygons of the user groups.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import time
+
+from array import array
+from collections import defaultdict
+from typing import Iterable, List, Union
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProject,
+    QgsSpatialIndex,
+    QgsVectorLayer,
+)
+
+from lizmap_server.cache import LRUCache
+from lizmap_server.change_detection import layer_stamp
+from lizmap_server.logger import Logger, profiling
+from lizmap_server.polygon_layer import PolygonLayer
+
+MEMBERSHIPS = LRUCache(maxsize=20)
+
+
+class PolygonMembership:
+
+    def __init__(
+            self, layer: QgsVectorLayer, primary_key: str, polygons: PolygonLayer,
+            polygon_crs: QgsCoordinateReferenceSystem, project: QgsProject) -> None:
+        """ Compute the primary keys of the features intersecting each polygon, in a single pass on the layer.
+
+        :param layer: The filtered layer
+        :param primary_key: The field of the filtered layer to store
+        :param polygons: The in memory copy of the polygon layer
+        :param polygon_crs: The CRS of the polygon layer
+        :param project: The project, for the coordinate transform context
+        """
+        self.polygons = polygons
+        self.source = layer.source()
+        self.subset_string = layer.subsetString()
+        self.stamp = layer_stamp(layer)
+        self.loaded = time.monotonic()
+
+        # Polygons in the CRS of the filtered layer, with a prepared engine
+        transform = QgsCoordinateTransform(polygon_crs, layer.crs(), project)
+        geometries = {}
+        engines = {}
+        index = QgsSpatialIndex()
+        for fid, geometry in polygons.geometries.items():
+            # Work on a copy, the geometry is shared with the polygon layer
+            geometry = QgsGeometry(geometry)
+            geometry.transform(transform)
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            geometries[fid] = geometry
+            engines[fid] = engine
+            index.addFeature(fid, geometry.boundingBox())
+
+        members = defaultdict(list)
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([primary_key], layer.fields())
+        for feature in layer.getFeatures(request):
+            if not feature.hasGeometry():
+                continue
+
+            # Keep a reference on the geometry, constGet() does not own it
+            geometry = feature.geometry()
+            for fid in index.intersects(geometry.boundingBox()):
+                if engines[fid].intersects(geometry.constGet()):
+                    members[fid].append(feature[primary_key])
+
+        # Polygon feature ID -> sorted primary keys, as a compact array if possible
+        self.members = {}
+        for fid, keys in members.items():
+            keys = sorted(set(keys))
+            if all(isinstance(k, int) and not isinstance(k, bool) for k in keys):
+                try:
+                    self.members[fid] = array('q', keys)
+                    continue
+                except OverflowError:
+                    pass
+            self.members[fid] = tuple(keys)
+
+    def feature_ids(self, groups: Iterable[str]) -> List:
+        """ Primary keys of the features intersecting the polygons of the given user groups. """
+        result = set()
+        for fid in self.polygons.feature_ids(groups):
+            result.update(self.members.get(fid, ()))
+        return sorted(result)
+
+    def is_up_to_date(self, layer: QgsVectorLayer, polygons: PolygonLayer, ttl: float) -> bool:
+        """ If the membership is still valid for the layer and the polygon layer.
+
+        If changes of the data can be detected, the stamp is checked. Otherwise, the membership is valid during the TTL.
+        """
+        if polygons is not self.polygons:
+            # The polygon layer has been reloaded
+            return False
+
+        if layer.source() != self.source or layer.subsetString() != self.subset_string:
+            return False
+
+        if self.stamp is not None:
+            return layer_stamp(layer) == self.stamp
+
+        return ttl <= 0 or time.monotonic() - self.loaded <= ttl
+
+
+@profiling
+def polygon_membership(
+        layer: QgsVectorLayer, primary_key: str, polygons: PolygonLayer, polygon_crs: QgsCoordinateReferenceSystem,
+        project: QgsProject, ttl: float) -> Union[PolygonMembership, None]:
+    """ The membership of the features of the layer to each polygon, computed or refreshed if needed. """
+    key = (project.fileName(), layer.id(), primary_key, polygons.layer_id, polygons.group_field)
+    membership = MEMBERSHIPS.get(key)
+    if membership is not None and membership.is_up_to_date(layer, polygons, ttl):
+        return membership
+
+    membership = PolygonMembership(layer, primary_key, polygons, polygon_crs, project)
+    MEMBERSHIPS.set(key, membership)
+    Logger.info("Membership of the layer {} computed for {} polygons".format(
+        layer.name(), len(membership.members)))
+    return membership
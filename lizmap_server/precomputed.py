@@ -0,0 +1,397 @@
+"""
+Filter by polygon results computed offline, stored in a sidecar file next to the project.
+
+For each group found in the polygon layer, the polygon of the group and, for each layer filtered with the
+'intersects' relationship, the primary keys of the features in this polygon. The results for the groups of
+a user are the union of the results of each group.
+
+    python3 -m lizmap_server.precomputed /path/to/project.qgs
+
+The file is ignored if the project or its Lizmap config have been modified since, according to a checksum,
+or if a layer stored in a file has been modified since. For a PostgreSQL table, its change token is stored if
+QGIS_SERVER_LIZMAP_CHANGE_TOKEN_SQL is set when the file is computed and when it is read. Otherwise, the results
+of a layer stored in a database are only used during QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_TTL seconds after
+the file is written, like any cached result. They are also discarded when the layer is edited with a WFS Transaction.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from array import array
+from typing import Dict, Iterable, List, Tuple, Union
+
+from qgis.core import QgsApplication, QgsGeometry, QgsProject, QgsVectorLayer
+from qgis.PyQt.QtCore import QVariant
+
+from lizmap_server.cache import LRUCache
+from lizmap_server.change_detection import (
+    Stamped,
+    file_stamp,
+    layer_change_token,
+    layer_source_stamp,
+)
+from lizmap_server.logger import Logger
+from lizmap_server.polygon_layer import PolygonLayer
+from lizmap_server.polygon_membership import PolygonMembership
+from lizmap_server.tools import env_number
+
+SIDECAR_SUFFIX = '.lizmap-cache'
+MAGIC = b'LIZMAPPC'
+VERSION = 1
+# Magic, version and length of the JSON header, followed by the data
+HEADER = struct.Struct('<8sII')
+
+PRECOMPUTED = LRUCache(maxsize=20)
+
+# Same as the filter by polygon caches, in seconds after the file is written, 0 to disable the expiration
+CACHE_TTL = env_number('QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_TTL', 60.0)
+
+
+class PrecomputeError(Exception):
+    pass
+
+
+def project_checksum(project_path: str) -> str:
+    """ Checksum of the project and its Lizmap config. """
+    checksum = hashlib.sha256()
+    for path in (project_path, project_path + '.cfg'):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        checksum.update(b'\0')
+    return checksum.hexdigest()
+
+
+def data_stamp(layer: QgsVectorLayer) -> Union[List, None]:
+    """ The stamp of the data which can be stored in the file.
+
+    For a file, its modification time and size, they are kept by most deployment tools. For a PostgreSQL table,
+    its change token. None if changes of the layer can not be detected.
+    """
+    stamp = layer_source_stamp(layer)
+    if stamp:
+        return list(stamp[:2])
+
+    token = layer_change_token(layer)
+    if token is not None:
+        return ['token', token]
+    return None
+
+
+class Precomputed:
+
+    def __init__(self, path: str) -> None:
+        """ Read the sidecar file, the data is mapped in memory and read when needed. """
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Results of layers without stamp are valid during the TTL after the file is written
+            self.modified = os.fstat(f.fileno()).st_mtime
+
+        if len(self._mmap) < HEADER.size:
+            raise ValueError('The file {} is not a Lizmap cache file'.format(path))
+
+        magic, version, length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('The file {} is not a Lizmap cache file version {}'.format(path, VERSION))
+
+        header = json.loads(self._mmap[HEADER.size:HEADER.size + length].decode('utf-8'))
+        self._data = HEADER.size + length
+        self.checksum = header['checksum']
+        self.polygon_layer = header['polygon_layer']
+        # Group -> (offset, size) of the WKB polygon
+        self.polygons = header['polygons']
+        # Layer ID -> primary key, stamp and group -> (offset, size, type) of the primary keys
+        self.layers = header['layers']
+
+    def _bytes(self, offset: int, size: int) -> bytes:
+        return self._mmap[self._data + offset:self._data + offset + size]
+
+    def _is_valid_stamp(self, stamp: Union[List, None], layer: QgsVectorLayer) -> bool:
+        """ If the layer has not been modified since the stored stamp was computed. """
+        if stamp is None:
+            # Changes can not be detected, like for the cached results
+            return CACHE_TTL <= 0 or time.time() - self.modified <= CACHE_TTL
+
+        return stamp == data_stamp(layer)
+
+    def is_valid_for_polygon_layer(self, layer: QgsVectorLayer, group_field: str) -> bool:
+        """ If the polygons have been computed from this polygon layer, not modified since. """
+        if self.polygon_layer is None:
+            return False
+
+        return (
+            self.polygon_layer['id'] == layer.id()
+            and self.polygon_layer['group_field'] == group_field
+            and self._is_valid_stamp(self.polygon_layer['stamp'], layer)
+        )
+
+    def polygon(self, group: str) -> QgsGeometry:
+        """ The polygon of a group, empty if the group is not in the polygon layer. """
+        entry = self.polygons.get(group)
+        if entry is None:
+            return QgsGeometry()
+
+        geometry = QgsGeometry()
+        geometry.fromWkb(self._bytes(*entry))
+        return geometry
+
+    def feature_ids(self, layer: QgsVectorLayer, primary_key: str, groups: Iterable[str]) -> Union[List, None]:
+        """ Sorted primary keys of the features in the polygons of the groups.
+
+        None if the layer has not been computed, or if it has been modified since.
+        """
+        entry = self.layers.get(layer.id())
+        if entry is None or entry['primary_key'] != primary_key or not self._is_valid_stamp(entry['stamp'], layer):
+            return None
+
+        ids = set()
+        for group in groups:
+            item = entry['ids'].get(group)
+            if item is None:
+                continue
+
+            offset, size, typecode = item
+            if typecode == 'json':
+                ids.update(json.loads(self._bytes(offset, size)))
+            else:
+                values = array(typecode)
+                values.frombytes(self._bytes(offset, size))
+                ids.update(values)
+        return sorted(ids)
+
+    def discard(self, layer_id: str) -> int:
+        """ Stop using the results of an edited layer.
+
+        The results of all layers depend on the polygon layer.
+
+        :returns: The number of discarded layers.
+        """
+        if self.polygon_layer is not None and self.polygon_layer['id'] == layer_id:
+            count = len(self.layers) + 1
+            self.polygon_layer = None
+            self.layers = {}
+            return count
+
+        return 1 if self.layers.pop(layer_id, None) is not None else 0
+
+
+def precomputed(project_path: str) -> Union[Precomputed, None]:
+    """ The results computed offline for the project, None if there is no file or if it is outdated. """
+    path = project_path + SIDECAR_SUFFIX
+    stamp = (file_stamp(path), file_stamp(project_path), file_stamp(project_path + '.cfg'))
+    if stamp[0] is None:
+        return None
+
+    cached = PRECOMPUTED.get(project_path)
+    if cached is not None and cached.stamp == stamp:
+        return cached.value
+
+    result = None
+    try:
+        result = Precomputed(path)
+        if result.checksum != project_checksum(project_path):
+            Logger.warning(
+                "The file {} has been computed for another version of the project, it is ignored".format(path))
+            result = None
+        else:
+            Logger.info("Filter by polygon results read from {}".format(path))
+    except (OSError, ValueError, KeyError) as e:
+        Logger.warning("The file {} can not be read : {}".format(path, e))
+        result = None
+
+    PRECOMPUTED.set(project_path, Stamped(stamp, result))
+    return result
+
+
+def discard_precomputed(project_path: str, layer_id: str) -> int:
+    """ Stop using the results of an edited layer, until the file is computed again.
+
+    :returns: The number of discarded layers.
+    """
+    cached = PRECOMPUTED.get(project_path)
+    if cached is None or cached.value is None:
+        return 0
+    return cached.value.discard(layer_id)
+
+
+def storable_ids(values: Iterable) -> Tuple[List, int]:
+    """ The primary keys which can be written in the file, and the number of NULL primary keys left out.
+
+    A NULL primary key never matches the filter, the feature is not visible anyway.
+
+    :raises PrecomputeError: If a primary key is not a number nor a string, like a date.
+    """
+    ids = []
+    nulls = 0
+    for value in values:
+        if value is None or (isinstance(value, QVariant) and value.isNull()):
+            nulls += 1
+        elif isinstance(value, (int, float, str)):
+            ids.append(value)
+        else:
+            raise PrecomputeError('The primary key {} of type {} can not be stored'.format(
+                value, type(value).__name__))
+    return ids, nulls
+
+
+def _encode_ids(ids: List) -> (bytes, str):
+    """ The primary keys as a compact array if possible, otherwise as JSON. """
+    if all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        try:
+            return array('q', ids).tobytes(), 'q'
+        except OverflowError:
+            pass
+    return json.dumps(ids).encode('utf-8'), 'json'
+
+
+def write_precomputed(
+        path: str, checksum: str, polygon_layer: dict, polygons: Dict[str, bytes], layers: Dict[str, dict]) -> None:
+    """ Write the sidecar file, replacing the previous one at once.
+
+    :param path: The sidecar file
+    :param checksum: The checksum of the project and its config
+    :param polygon_layer: The ID, the group field and the stamp of the polygon layer
+    :param polygons: Group -> WKB polygon
+    :param layers: Layer ID -> primary key, stamp and group -> primary keys
+    """
+    blobs = []
+    offset = 0
+
+    def add(data: bytes) -> List[int]:
+        nonlocal offset
+        blobs.append(data)
+        offset += len(data)
+        return [offset - len(data), len(data)]
+
+    header = {
+        'checksum': checksum,
+        'polygon_layer': polygon_layer,
+        'polygons': {group: add(wkb) for group, wkb in polygons.items()},
+        'layers': {},
+    }
+    for layer_id, layer in layers.items():
+        ids = {}
+        for group, values in layer['ids'].items():
+            data, typecode = _encode_ids(values)
+            ids[group] = add(data) + [typecode]
+        header['layers'][layer_id] = {'primary_key': layer['primary_key'], 'stamp': layer['stamp'], 'ids': ids}
+
+    header = json.dumps(header).encode('utf-8')
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    # A server might still read the previous file, it is kept until it is closed
+    os.replace(temporary, path)
+
+
+def precompute(project_path: str) -> str:
+    """ Compute the results of the filter by polygon of the project, in the sidecar file.
+
+    :returns: The path of the sidecar file.
+    """
+    config_path = project_path + '.cfg'
+    if not os.path.exists(config_path):
+        raise PrecomputeError('The Lizmap config {} does not exist'.format(config_path))
+
+    with open(config_path, 'r') as f:
+        config = json.load(f).get('filter_by_polygon')
+    if not config or not config.get('layers'):
+        raise PrecomputeError('The project does not use the filter by polygon')
+
+    checksum = project_checksum(project_path)
+
+    # noinspection PyArgumentList
+    project = QgsProject.instance()
+    if not project.read(project_path):
+        raise PrecomputeError('The project {} can not be read : {}'.format(project_path, project.error()))
+
+    group_field = config['config']['group_field']
+    layer = project.mapLayer(config['config']['polygon_layer_id'])
+    if not isinstance(layer, QgsVectorLayer) or not layer.isValid():
+        raise PrecomputeError('The polygon layer is not valid')
+
+    polygons = PolygonLayer(layer, group_field)
+    groups = sorted(polygons.features.keys())
+    results = {
+        group: bytes(polygons.polygon_for_groups((group, )).asWkb()) for group in groups
+    }
+    print('{} groups found in the polygon layer {}'.format(len(groups), layer.name()))
+
+    layers = {}
+    for layer_config in config['layers']:
+        filtered = project.mapLayer(layer_config.get('layer'))
+        if not isinstance(filtered, QgsVectorLayer) or not filtered.isValid():
+            print('The layer {} is not valid, skipped'.format(layer_config.get('layer')))
+            continue
+
+        if layer_config.get('spatial_relationship') != 'intersects':
+            # A feature might be in the union of several polygons, but not in a single one
+            print('The layer {} is not filtered with "intersects", skipped'.format(filtered.name()))
+            continue
+
+        primary_key = layer_config.get('primary_key')
+        membership = PolygonMembership(filtered, primary_key, polygons, layer.crs(), project)
+        ids = {}
+        nulls = 0
+        try:
+            for group in groups:
+                values, group_nulls = storable_ids(membership.feature_ids((group, )))
+                nulls += group_nulls
+                if values:
+                    ids[group] = values
+        except PrecomputeError as e:
+            # The layer is filtered when the request is made
+            print('The layer {} is skipped : {}'.format(filtered.name(), e))
+            continue
+
+        if nulls:
+            print('The features of the layer {} with a NULL primary key are left out'.format(filtered.name()))
+        layers[filtered.id()] = {'primary_key': primary_key, 'stamp': data_stamp(filtered), 'ids': ids}
+        print('Layer {} computed for {} groups'.format(filtered.name(), len(ids)))
+
+    path = project_path + SIDECAR_SUFFIX
+    write_precomputed(
+        path,
+        checksum,
+        {'id': layer.id(), 'group_field': group_field, 'stamp': data_stamp(layer)},
+        results,
+        layers,
+    )
+    return path
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Compute the filter by polygon of a Lizmap project, in a file next to the project.')
+    parser.add_argument('project', help='The QGIS project, with its Lizmap config')
+    args = parser.parse_args()
+
+    application = QgsApplication([], False)
+    application.initQgis()
+    try:
+        path = precompute(os.path.abspath(args.project))
+    except PrecomputeError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    finally:
+        application.exitQgis()
+
+    print('Written in {}'.format(path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
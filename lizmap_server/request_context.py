@@ -0,0 +1,82 @@
+"""
+Lizmap information about the current request, read once from the headers and the parameters.
+
+The context is built when the request is ready and removed when the response is complete. Access control
+hooks are called for each layer, they read the context instead of the request handler.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import threading
+
+from collections import namedtuple
+from typing import Union
+
+from qgis.server import QgsServerInterface
+
+from lizmap_server.core import (
+    get_lizmap_compiled_config,
+    get_lizmap_groups,
+    get_lizmap_override_filter,
+    get_lizmap_user_login,
+    get_request_extent,
+    is_editing_context,
+)
+
+# groups : frozenset of the user groups, empty if no groups are given, {''} for an anonymous user
+# login : the user login, an empty string if not given
+# override : if the filters must not be applied
+# editing : if the request is made in an editing session
+# extent : the extent of the request with a margin, None in an editing session or if the request has no extent
+# config_path : the QGIS project path
+# config : the Lizmap config, None if not found
+# compiled : the Lizmap config compiled for the access control hooks, None if not found
+LizmapRequestContext = namedtuple(
+    'LizmapRequestContext',
+    ['groups', 'login', 'override', 'editing', 'extent', 'config_path', 'config', 'compiled'])
+
+ANONYMOUS_GROUPS = frozenset([''])
+
+_CURRENT = threading.local()
+
+
+def build_request_context(server_iface: QgsServerInterface) -> LizmapRequestContext:
+    """ Read the Lizmap information from the current request. """
+    handler = server_iface.requestHandler()
+    editing = is_editing_context(handler)
+    config_path = server_iface.configFilePath()
+    compiled = get_lizmap_compiled_config(config_path)
+    return LizmapRequestContext(
+        groups=frozenset(get_lizmap_groups(handler)),
+        login=get_lizmap_user_login(handler),
+        override=bool(get_lizmap_override_filter(handler)),
+        editing=editing,
+        # Only features in the extent of the request are needed, but not in an editing session
+        extent=None if editing else get_request_extent(handler),
+        config_path=config_path,
+        config=compiled.config if compiled else None,
+        compiled=compiled,
+    )
+
+
+def set_request_context(context: Union[LizmapRequestContext, None]) -> None:
+    """ The context of the current request, None when the response is complete. """
+    _CURRENT.context = context
+
+
+def current_request_context() -> Union[LizmapRequestContext, None]:
+    """ The context of the current request, None if the request has not been through the Lizmap filter. """
+    return getattr(_CURRENT, 'context', None)
+
+
+def request_context(server_iface: QgsServerInterface) -> LizmapRequestContext:
+    """ The context of the current request.
+
+    It is built from the request if the request has not been through the Lizmap filter.
+    """
+    context = getattr(_CURRENT, 'context', None)
+    if context is None or context.config_path != server_iface.configFilePath():
+        return build_request_context(server_iface)
+    return context
@@ -0,0 +1,259 @@
+"""
+Direct SQLite queries on GeoPackage and SpatiaLite layers, using their R-Tree spatial index.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import sqlite3
+import struct
+
+from contextlib import closing
+from pathlib import Path
+from typing import List, Sequence, Tuple, Union
+
+from qgis.core import (
+    QgsDataSourceUri,
+    QgsGeometry,
+    QgsGeometryEngine,
+    QgsProviderRegistry,
+    QgsRectangle,
+    QgsVectorLayer,
+)
+
+from lizmap_server.logger import Logger, profiling
+from lizmap_server.vectorized import points_in_polygon
+
+# Size of the envelope in the header of a GeoPackage geometry, according to the envelope indicator
+GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+# Flag of an empty geometry in the header of a GeoPackage geometry
+GPKG_EMPTY_FLAG = 0x10
+
+
+def quoted_identifier(name: str) -> str:
+    """ Quote a table or a column name for SQLite. """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def gpkg_geometry_to_wkb(blob: bytes) -> bytes:
+    """ The WKB of a geometry stored in a GeoPackage, without the GeoPackage header. """
+    if len(blob) < 8 or blob[0:2] != b'GP':
+        raise ValueError('Not a GeoPackage geometry')
+
+    envelope = GPKG_ENVELOPE_SIZES.get((blob[3] >> 1) & 0x07)
+    if envelope is None:
+        raise ValueError('Invalid envelope in the GeoPackage geometry')
+
+    return blob[8 + envelope:]
+
+
+def gpkg_points_xy(blobs: Sequence[bytes]) -> Tuple['numpy.ndarray', 'numpy.ndarray']:
+    """ The coordinates of GeoPackage points, NaN for empty or invalid points.
+
+    NumPy must be installed. Points with the same header and in little endian, the usual case, are read at once.
+    """
+    import numpy
+
+    count = len(blobs)
+    x = numpy.full(count, numpy.nan)
+    y = numpy.full(count, numpy.nan)
+    if count == 0:
+        return x, y
+
+    size = len(blobs[0])
+    if size >= 8 and blobs[0][0:2] == b'GP' and (blobs[0][3] >> 1) & 0x07 in GPKG_ENVELOPE_SIZES:
+        # Header of 8 bytes and the envelope, then the byte order and the type of the WKB, then X and Y
+        offset = 8 + GPKG_ENVELOPE_SIZES[(blobs[0][3] >> 1) & 0x07]
+        if size >= offset + 21:
+            data = numpy.frombuffer(b''.join(blobs), dtype=numpy.uint8)
+            if data.size == count * size:
+                data = data.reshape(count, size)
+                same = (
+                    (data[:, 0] == ord('G')) & (data[:, 1] == ord('P'))
+                    & (data[:, 3] == data[0, 3])
+                    # Little endian WKB
+                    & (data[:, offset] == 1)
+                )
+                if same.all():
+                    xy = numpy.ascontiguousarray(data[:, offset + 5:offset + 21]).view('<f8')
+                    x, y = xy[:, 0].copy(), xy[:, 1].copy()
+                    if data[0, 3] & GPKG_EMPTY_FLAG:
+                        x[:] = numpy.nan
+                        y[:] = numpy.nan
+                    return x, y
+
+    # One by one
+    for i, blob in enumerate(blobs):
+        if len(blob) < 8 or blob[0:2] != b'GP' or blob[3] & GPKG_EMPTY_FLAG:
+            continue
+
+        envelope = GPKG_ENVELOPE_SIZES.get((blob[3] >> 1) & 0x07)
+        if envelope is None or len(blob) < 8 + envelope + 21:
+            continue
+
+        order = '<' if blob[8 + envelope] == 1 else '>'
+        x[i], y[i] = struct.unpack_from(order + 'dd', blob, 8 + envelope + 5)
+    return x, y
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """ Read only connection to the SQLite file. """
+    return sqlite3.connect('{}?mode=ro'.format(Path(path).absolute().as_uri()), uri=True)
+
+
+def _load_spatialite(connection: sqlite3.Connection) -> bool:
+    """ Load the SpatiaLite extension if possible. """
+    try:
+        connection.enable_load_extension(True)
+        connection.load_extension('mod_spatialite')
+        connection.enable_load_extension(False)
+        return True
+    except (AttributeError, sqlite3.Error) as e:
+        # AttributeError if Python is built without the extension loading
+        Logger.info("SpatiaLite extension not available : {}".format(str(e)))
+        return False
+
+
+def _table_exists(connection: sqlite3.Connection, table: str) -> bool:
+    """ If the table exists in the SQLite file. """
+    result = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table, )).fetchone()
+    return result is not None
+
+
+@profiling
+def sqlite_features_ids(
+        layer: QgsVectorLayer, primary_key: str, rectangle: QgsRectangle, polygon: QgsGeometry,
+        engine: QgsGeometryEngine, relationship: str, points: bool = False) -> Union[List, None]:
+    """ Primary keys of the features in the polygon, in a single SQL query.
+
+    None if the layer can not be queried directly, the QGIS API must be used in this case.
+
+    :param layer: A GeoPackage or a SpatiaLite layer
+    :param primary_key: The field to return
+    :param rectangle: Only features intersecting this rectangle are candidates, in the layer CRS
+    :param polygon: The polygon, in the layer CRS
+    :param engine: The prepared engine of the polygon
+    :param relationship: 'intersects' or 'contains', the polygon contains the feature
+    :param points: If the GeoPackage layer has single points, checked at once with a bulk point in polygon test
+    """
+    # noinspection PyArgumentList
+    path = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source()).get('path')
+    if not path or not Path(path).is_file():
+        return None
+
+    with closing(_connect(path)) as connection:
+        if layer.providerType() == 'spatialite':
+            return _spatialite_features_ids(connection, layer, primary_key, rectangle, polygon, relationship)
+
+        if path.lower().endswith('.gpkg'):
+            return _gpkg_features_ids(
+                connection, layer, primary_key, rectangle, polygon, engine, relationship, points)
+
+    return None
+
+
+def _gpkg_features_ids(
+        connection: sqlite3.Connection, layer: QgsVectorLayer, primary_key: str, rectangle: QgsRectangle,
+        polygon: QgsGeometry, engine: QgsGeometryEngine, relationship: str, points: bool) -> Union[List, None]:
+    """ Candidates from the R-Tree of the GeoPackage, checked with the prepared polygon. """
+    # noinspection PyArgumentList
+    table = QgsProviderRegistry.instance().decodeUri('ogr', layer.source()).get('layerName')
+
+    sql = "SELECT table_name, column_name FROM gpkg_geometry_columns"
+    parameters = ()
+    if table:
+        sql += " WHERE table_name = ?"
+        parameters = (table, )
+    tables = connection.execute(sql, parameters).fetchall()
+    if len(tables) != 1:
+        return None
+    table, geometry_column = tables[0]
+
+    rtree = 'rtree_{}_{}'.format(table, geometry_column)
+    if not _table_exists(connection, rtree):
+        Logger.info("No spatial index {} in the GeoPackage".format(rtree))
+        return None
+
+    fid = [row[1] for row in connection.execute('PRAGMA table_info({})'.format(quoted_identifier(table))) if row[5]]
+    if len(fid) != 1:
+        return None
+
+    sql = (
+        'SELECT t.{pk}, t.{geom} FROM {table} AS t JOIN {rtree} AS r ON r.id = t.{fid} '
+        'WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?'
+    ).format(
+        pk=quoted_identifier(primary_key),
+        geom=quoted_identifier(geometry_column),
+        table=quoted_identifier(table),
+        rtree=quoted_identifier(rtree),
+        fid=quoted_identifier(fid[0]),
+    )
+    parameters = (rectangle.xMaximum(), rectangle.xMinimum(), rectangle.yMaximum(), rectangle.yMinimum())
+
+    if points and relationship == 'intersects':
+        # All coordinates are read at once, without a geometry for each feature
+        rows = connection.execute(sql + ' AND t.{} IS NOT NULL'.format(quoted_identifier(geometry_column)), parameters)
+        rows = rows.fetchall()
+        if not rows:
+            return []
+
+        keys, blobs = zip(*rows)
+        x, y = gpkg_points_xy(blobs)
+        inside = points_in_polygon(polygon, x, y)
+        return [key for key, found in zip(keys, inside) if found]
+
+    unique_ids = []
+    for pk, blob in connection.execute(sql, parameters):
+        if blob is None:
+            continue
+
+        # Keep a reference on the geometry, constGet() does not own it
+        geometry = QgsGeometry()
+        geometry.fromWkb(gpkg_geometry_to_wkb(blob))
+        if relationship == 'contains':
+            # The polygon contains the feature
+            if engine.contains(geometry.constGet()):
+                unique_ids.append(pk)
+        elif engine.intersects(geometry.constGet()):
+            unique_ids.append(pk)
+
+    return unique_ids
+
+
+def _spatialite_features_ids(
+        connection: sqlite3.Connection, layer: QgsVectorLayer, primary_key: str, rectangle: QgsRectangle,
+        polygon: QgsGeometry, relationship: str) -> Union[List, None]:
+    """ Candidates from the spatial index of the SpatiaLite table, checked by SpatiaLite. """
+    if not _load_spatialite(connection):
+        return None
+
+    uri = QgsDataSourceUri(layer.source())
+    index = 'idx_{}_{}'.format(uri.table(), uri.geometryColumn())
+    if not _table_exists(connection, index):
+        Logger.info("No spatial index {} in the SpatiaLite database".format(index))
+        return None
+
+    geom = 't.{}'.format(quoted_identifier(uri.geometryColumn()))
+    polygon_sql = 'GeomFromWKB(?, ST_SRID({}))'.format(geom)
+    if relationship == 'contains':
+        predicate = 'ST_Contains({}, {})'.format(polygon_sql, geom)
+    else:
+        predicate = 'ST_Intersects({}, {})'.format(polygon_sql, geom)
+
+    sql = (
+        'SELECT t.{pk} FROM {table} AS t WHERE t.ROWID IN ('
+        'SELECT pkid FROM {index} WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?'
+        ') AND {predicate} = 1'
+    ).format(
+        pk=quoted_identifier(primary_key),
+        table=quoted_identifier(uri.table()),
+        index=quoted_identifier(index),
+        predicate=predicate,
+    )
+    parameters = (
+        rectangle.xMaximum(), rectangle.xMinimum(), rectangle.yMaximum(), rectangle.yMinimum(),
+        bytes(polygon.asWkb()),
+    )
+    return [row[0] for row in connection.execute(sql, parameters)]
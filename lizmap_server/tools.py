@@ -27,6 +27,24 @@ def to_bool(val: Union[str, int, float, bool], default_value: bool = True) -> bo
         return default_value
 
 
+def env_number(name: str, default: Union[int, float]) -> Union[int, float]:
+    """ Read a numeric setting from an environment variable, with a default value. """
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+
+    try:
+        return type(default)(value)
+    except ValueError:
+        # Do not use logger here, circular import
+        # noinspection PyTypeChecker
+        QgsMessageLog.logMessage(
+            "The environment variable {} has an invalid value '{}', using the default value {}".format(
+                name, value, default),
+            "Lizmap", Qgis.Warning)
+        return default
+
+
 def version() -> str:
     """ Returns the Lizmap current version. """
     file_path = Path(__file__).parent.joinpath('metadata.txt')
@@ -0,0 +1,334 @@
+"""
+QGIS Server filter removing the filter by polygon results affected by a WFS Transaction.
+
+The edited features are read before the transaction, and after it with the IDs of the inserted features given by
+the response. For a filtered layer, only the results of the groups with a polygon touching an edited feature are
+removed. For the polygon layer, only the results of the groups of the edited polygons are removed.
+
+Only the caches of the server process which handled the transaction are updated. The other processes see the
+edit with the stamp of the layer, the modification of the file or the change token of the table, otherwise after
+the TTL of their caches.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+import xml.etree.ElementTree as ET
+
+from collections import namedtuple
+from typing import Dict, List, Union
+
+from qgis.core import QgsFeatureRequest, QgsProject, QgsVectorLayer
+from qgis.server import QgsServerFilter, QgsServerInterface
+
+from lizmap_server.change_detection import layer_stamp
+from lizmap_server.core import (
+    find_vector_layer,
+    get_lizmap_config,
+    server_feature_id_expression,
+)
+from lizmap_server.filter_by_polygon import (
+    invalidate_features,
+    invalidate_layer,
+    invalidate_polygon_layer,
+)
+from lizmap_server.logger import Logger
+from lizmap_server.polygon_layer import split_groups
+
+# A single operation of a transaction
+# feature_ids is None if the features are not given by their IDs
+Action = namedtuple('Action', ['operation', 'type_name', 'feature_ids', 'values'])
+
+# The features of a layer edited by a transaction
+# stamp : the stamp of the layer before the transaction
+# geometries : the geometries of the edited features, before and after, None if the features are unknown
+# groups : for the polygon layer, the groups of the edited polygons, before and after
+LayerEdit = namedtuple('LayerEdit', ['layer', 'stamp', 'geometries', 'groups'])
+
+# A transaction read before it is executed
+Transaction = namedtuple('Transaction', ['config', 'actions', 'edits'])
+
+
+def _local_name(tag: str) -> str:
+    """ The XML tag without the namespace. """
+    return tag.rsplit('}', 1)[-1]
+
+
+def _feature_id(value: str) -> str:
+    """ The server feature ID, without the type name. """
+    return value.split('.', 1)[1] if '.' in value else value
+
+
+def parse_transaction(data: Union[bytes, str]) -> List[Action]:
+    """ Operations of a WFS Transaction in XML. """
+    actions = []
+    root = ET.fromstring(data)
+    for element in root:
+        operation = _local_name(element.tag)
+        if operation == 'Insert':
+            for feature in element:
+                values = {_local_name(child.tag): child.text for child in feature if len(child) == 0}
+                actions.append(Action(operation, _local_name(feature.tag), [], values))
+
+        elif operation in ('Update', 'Delete'):
+            type_name = element.attrib.get('typeName', element.attrib.get('typename', ''))
+            type_name = type_name.split(':', 1)[-1]
+
+            values = {}
+            feature_ids = []
+            for child in element.iter():
+                name = _local_name(child.tag)
+                if name == 'Property':
+                    items = {_local_name(c.tag): c.text for c in child}
+                    if items.get('Name'):
+                        values[items['Name']] = items.get('Value')
+                elif name in ('FeatureId', 'ResourceId', 'GmlObjectId'):
+                    for attribute, value in child.attrib.items():
+                        if _local_name(attribute) in ('fid', 'rid', 'id'):
+                            feature_ids.append(_feature_id(value))
+                elif name == 'Filter' and not any(
+                        _local_name(c.tag) in ('FeatureId', 'ResourceId', 'GmlObjectId') for c in child):
+                    # Features selected with another filter
+                    feature_ids = None
+                    break
+
+            actions.append(Action(operation, type_name, feature_ids, values))
+
+    return actions
+
+
+def parse_transaction_response(data: Union[bytes, str]) -> Dict[str, List[str]]:
+    """ IDs of the inserted features by type name, from the response of a WFS Transaction in XML. """
+    inserted = {}
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        return inserted
+
+    for element in root.iter():
+        if _local_name(element.tag) not in ('InsertResult', 'InsertResults'):
+            continue
+
+        for child in element.iter():
+            if _local_name(child.tag) not in ('FeatureId', 'ResourceId'):
+                continue
+
+            for attribute, value in child.attrib.items():
+                if _local_name(attribute) in ('fid', 'rid'):
+                    type_name = value.split('.', 1)[0] if '.' in value else ''
+                    inserted.setdefault(type_name, []).append(_feature_id(value))
+
+    return inserted
+
+
+def parse_transaction_parameters(params: Dict[str, str]) -> List[Action]:
+    """ Operations of a WFS Transaction with key value parameters. """
+    operation = params.get('OPERATION', '').capitalize()
+    if not operation:
+        return []
+
+    feature_ids = [f for f in params.get('FEATUREID', '').split(',') if f]
+    type_name = params.get('TYPENAME', '')
+    if not type_name and feature_ids:
+        type_name = feature_ids[0].split('.', 1)[0]
+
+    return [Action(operation, type_name, [_feature_id(f) for f in feature_ids] or None, {})]
+
+
+class TransactionFilter(QgsServerFilter):
+
+    def __init__(self, server_iface: QgsServerInterface) -> None:
+        super().__init__(server_iface)
+        self.iface = server_iface
+        # The current transaction, read before it is executed
+        self.transaction = None
+
+    def requestReady(self):
+        """ Read the features edited by a WFS Transaction, before they are edited. """
+        self.transaction = None
+        handler = self.iface.requestHandler()
+        params = handler.parameterMap()
+
+        if params.get('SERVICE', '').upper() != 'WFS':
+            return
+
+        if params.get('REQUEST', '').upper() != 'TRANSACTION':
+            return
+
+        # noinspection PyBroadException
+        try:
+            cfg = get_lizmap_config(self.iface.configFilePath())
+            if not cfg or not cfg.get('filter_by_polygon'):
+                return
+
+            data = bytes(handler.data())
+            if data.strip():
+                actions = parse_transaction(data)
+            else:
+                actions = parse_transaction_parameters(params)
+
+            # noinspection PyArgumentList
+            edits = edited_layers(QgsProject.instance(), cfg['filter_by_polygon'], actions)
+            if edits:
+                self.transaction = Transaction(cfg['filter_by_polygon'], actions, edits)
+        except Exception as e:
+            Logger.log_exception(e)
+            Logger.critical("Error while reading the features edited by a WFS Transaction")
+
+    def responseComplete(self):
+        """ Remove cached results for the features edited by a WFS Transaction. """
+        transaction, self.transaction = self.transaction, None
+        if transaction is None:
+            return
+
+        # noinspection PyBroadException
+        try:
+            inserted = parse_transaction_response(bytes(self.iface.requestHandler().body()))
+            # noinspection PyArgumentList
+            invalidate_transaction(
+                QgsProject.instance(), transaction.config, transaction.actions, transaction.edits, inserted)
+        except Exception as e:
+            Logger.log_exception(e)
+            Logger.critical("Error while removing filter by polygon results after a WFS Transaction")
+
+
+def _action_layer(project: QgsProject, type_name: str) -> Union[QgsVectorLayer, None]:
+    """ The layer of a type name of the transaction. """
+    layer = find_vector_layer(type_name, project)
+    if layer is None and type_name:
+        # In WFS, spaces are replaced in the type name
+        layer = find_vector_layer(type_name.replace('_', ' '), project)
+    return layer
+
+
+def edited_layers(project: QgsProject, config: dict, actions: List[Action]) -> Dict[str, LayerEdit]:
+    """ The layers of the filter by polygon edited by the operations, with the features before the transaction.
+
+    :returns: The edits by layer ID.
+    """
+    polygon_layer_id = config.get('config', {}).get('polygon_layer_id')
+    group_field = config.get('config', {}).get('group_field')
+    filtered = {layer.get('layer') for layer in config.get('layers', [])}
+
+    edits = {}
+    for action in actions:
+        layer = _action_layer(project, action.type_name)
+        if layer is None or (layer.id() not in filtered and layer.id() != polygon_layer_id):
+            continue
+
+        edit = edits.setdefault(layer.id(), LayerEdit(layer, layer_stamp(layer), [], set()))
+        if action.operation not in ('Update', 'Delete') or edit.geometries is None:
+            # Inserted features are read after the transaction
+            continue
+
+        if action.feature_ids is None or not _read_features(
+                edit, action.feature_ids, group_field if layer.id() == polygon_layer_id else None):
+            edits[layer.id()] = edit._replace(geometries=None)
+
+    return edits
+
+
+def invalidate_transaction(
+        project: QgsProject, config: dict, actions: List[Action], edits: Dict[str, LayerEdit],
+        inserted: Dict[str, List[str]]) -> int:
+    """ Remove the filter by polygon results affected by the operations, once executed.
+
+    :param project: The project
+    :param config: The filter by polygon configuration
+    :param actions: The operations of the transaction
+    :param edits: The edited layers, read before the transaction
+    :param inserted: The IDs of the inserted features by type name, from the response
+    :returns: The number of removed entries.
+    """
+    polygon_layer_id = config.get('config', {}).get('polygon_layer_id')
+    group_field = config.get('config', {}).get('group_field')
+    filtered = {layer.get('layer') for layer in config.get('layers', [])}
+
+    # Inserted features by layer ID, the type name of the response might be written differently
+    inserted_ids = {}
+    for type_name, feature_ids in inserted.items():
+        layer = _action_layer(project, type_name)
+        if layer is not None:
+            inserted_ids.setdefault(layer.id(), []).extend(feature_ids)
+
+    # New state of the edited features, all inserted features of a layer are read at once
+    read_inserts = set()
+    for action in actions:
+        layer = _action_layer(project, action.type_name)
+        edit = edits.get(layer.id()) if layer is not None else None
+        if edit is None or edit.geometries is None:
+            continue
+
+        polygon_group_field = group_field if layer.id() == polygon_layer_id else None
+        if action.operation == 'Insert':
+            if layer.id() in read_inserts:
+                continue
+
+            if layer.id() not in inserted_ids:
+                # Not given by the response
+                if layer.id() == polygon_layer_id and group_field in action.values:
+                    # Groups of the new polygon are enough
+                    edit.groups.update(split_groups(action.values[group_field], layer.providerType() == 'postgres'))
+                else:
+                    edits[layer.id()] = edit._replace(geometries=None)
+                continue
+
+            read_inserts.add(layer.id())
+            feature_ids = inserted_ids[layer.id()]
+        elif action.operation == 'Update':
+            feature_ids = action.feature_ids
+        else:
+            continue
+
+        if not _read_features(edit, feature_ids, polygon_group_field):
+            edits[layer.id()] = edit._replace(geometries=None)
+
+    count = 0
+    for layer_id, edit in edits.items():
+        if layer_id in filtered:
+            if edit.geometries is None:
+                count += invalidate_layer(project.fileName(), layer_id)
+            else:
+                count += invalidate_features(project, edit.layer, edit.stamp, edit.geometries)
+
+        if layer_id == polygon_layer_id:
+            groups = frozenset(edit.groups) if edit.geometries is not None else None
+            count += invalidate_polygon_layer(project.fileName(), layer_id, groups, edit.layer, edit.stamp)
+
+    if count:
+        Logger.info("{} filter by polygon results removed after a WFS Transaction".format(count))
+    return count
+
+
+def _read_features(edit: LayerEdit, feature_ids: List[str], group_field: Union[str, None]) -> bool:
+    """ Add the geometries and the groups of the features to the edit.
+
+    A feature not found is ignored, it does not exist before an insert or after a delete.
+
+    :returns: False if a feature ID is not valid for the layer.
+    """
+    layer = edit.layer
+    for feature_id in feature_ids:
+        request = QgsFeatureRequest()
+        expression = server_feature_id_expression(feature_id, layer.dataProvider())
+        if expression:
+            request.setFilterExpression(expression)
+        else:
+            try:
+                request.setFilterFid(int(feature_id))
+            except ValueError:
+                return False
+
+        if group_field:
+            request.setSubsetOfAttributes([group_field], layer.fields())
+        else:
+            request.setNoAttributes()
+
+        for feature in layer.getFeatures(request):
+            if feature.hasGeometry():
+                edit.geometries.append(feature.geometry())
+            if group_field:
+                edit.groups.update(split_groups(feature[group_field], layer.providerType() == 'postgres'))
+
+    return True
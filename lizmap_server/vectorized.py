@@ -0,0 +1,94 @@
+"""
+Bulk point in polygon tests, with NumPy and Shapely if they are installed.
+"""
+
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+from typing import Sequence
+
+from qgis.core import QgsGeometry
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    # noinspection PyUnresolvedReferences
+    import shapely
+    # Vectorized predicates are only available since Shapely 2
+    HAS_SHAPELY = HAS_NUMPY and int(shapely.__version__.split('.')[0]) >= 2
+except ImportError:
+    HAS_SHAPELY = False
+
+
+def points_in_polygon(polygon: QgsGeometry, x: Sequence[float], y: Sequence[float]) -> Sequence[bool]:
+    """ For each point, if it intersects the polygon.
+
+    With Shapely 2, the prepared polygon is used. Otherwise, a ray casting with NumPy is used, a point
+    exactly on the boundary of the polygon might be considered outside.
+
+    :param polygon: A polygon or a multi polygon
+    :param x: The X coordinates of the points, in the CRS of the polygon
+    :param y: The Y coordinates of the points, in the CRS of the polygon
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+
+    if HAS_SHAPELY:
+        geometry = shapely.from_wkb(bytes(polygon.asWkb()))
+        shapely.prepare(geometry)
+        return shapely.intersects_xy(geometry, x, y)
+
+    return ray_casting(polygon_rings(polygon), x, y)
+
+
+def polygon_rings(polygon: QgsGeometry) -> list:
+    """ For each part of the polygon, the list of its rings as arrays of coordinates. """
+    parts = polygon.asMultiPolygon() if polygon.isMultipart() else [polygon.asPolygon()]
+    return [
+        [numpy.array([(point.x(), point.y()) for point in ring], dtype=float) for ring in part]
+        for part in parts
+    ]
+
+
+def ray_casting(parts: list, x: 'numpy.ndarray', y: 'numpy.ndarray') -> 'numpy.ndarray':
+    """ Even-odd rule, for each part the edges are tested against all points at once.
+
+    :param parts: For each part, the list of rings as arrays of coordinates
+    :param x: The X coordinates of the points
+    :param y: The Y coordinates of the points
+    """
+    result = numpy.zeros(len(x), dtype=bool)
+    for rings in parts:
+        if not rings or len(rings[0]) == 0:
+            continue
+
+        # Only points in the bounding box of the exterior ring
+        exterior = rings[0]
+        candidates = numpy.flatnonzero(
+            (x >= exterior[:, 0].min()) & (x <= exterior[:, 0].max())
+            & (y >= exterior[:, 1].min()) & (y <= exterior[:, 1].max())
+            & ~result
+        )
+        if candidates.size == 0:
+            continue
+
+        px = x[candidates]
+        py = y[candidates]
+        inside = numpy.zeros(candidates.size, dtype=bool)
+        # Holes are handled by the even-odd rule
+        for ring in rings:
+            for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+                if y1 == y2:
+                    # An horizontal edge is never crossed by the horizontal ray
+                    continue
+                crossing = (y1 > py) != (y2 > py)
+                inside ^= crossing & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+
+        result[candidates[inside]] = True
+
+    return result
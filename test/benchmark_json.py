@@ -0,0 +1,109 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+"""
+Benchmark of the JSON backends, on a Lizmap config and on the response of an Evaluate request.
+
+QGIS is not used. The config is the largest CFG file of the tests, with its layers copied to reach the given
+number of layers. From the root of the repository :
+
+    PYTHONPATH=. python3 test/benchmark_json.py --layers 5000 --features 10000
+    PYTHONPATH=. python3 test/benchmark_json.py --config /srv/lizmap/instances/big_project.qgs.cfg
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import time
+
+from typing import Callable
+
+from lizmap_server.json_backend import BACKENDS, available_backends
+
+
+def largest_config() -> str:
+    """ The largest CFG file of the tests. """
+    data = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    return max(glob.glob(os.path.join(data, '*.cfg')), key=os.path.getsize)
+
+
+def big_config(path: str, layers: int) -> dict:
+    """ The config with its layers and their attribute tables copied, up to the number of layers. """
+    with open(path, 'rb') as f:
+        config = json.loads(f.read())
+
+    source = list(config.get('layers', {}).items())
+    attribute_layers = config.get('attributeLayers', {})
+    i = 0
+    while source and len(config['layers']) < layers:
+        name, layer = source[i % len(source)]
+        copy_name = '{}_{}'.format(name, i)
+        config['layers'][copy_name] = dict(copy.deepcopy(layer), id='{}_{}'.format(layer.get('id'), i), name=copy_name)
+        if name in attribute_layers:
+            attribute_layers[copy_name] = copy.deepcopy(attribute_layers[name])
+        i += 1
+    return config
+
+
+def evaluate_response(features: int) -> dict:
+    """ The body of an Evaluate response, with a few expressions evaluated for each feature. """
+    body = {'status': 'success', 'results': [], 'errors': [], 'features': features}
+    for i in range(features):
+        body['results'].append({
+            0: i,
+            1: 'Feature n°{} in "Montpellier"'.format(i),
+            2: i * 1.5,
+            3: None,
+            4: [i, i + 1],
+        })
+        body['errors'].append({0: '$id', 1: 'concat(\'Feature n°\', $id)', 2: '$area', 3: 'NULL', 4: 'array()'})
+    return body
+
+
+def timing(function: Callable, repeat: int) -> float:
+    """ The best duration of the function, in milliseconds. """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=largest_config(), help='The Lizmap config')
+    parser.add_argument('--layers', type=int, default=5000, help='Minimum number of layers in the config')
+    parser.add_argument('--features', type=int, default=10000, help='Number of features in the Evaluate response')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is kept')
+    args = parser.parse_args()
+
+    config = json.dumps(big_config(args.config, args.layers)).encode('utf-8')
+    print('Config : {} layers, {:.1f} MB'.format(args.layers, len(config) / 1024 / 1024))
+    body = evaluate_response(args.features)
+    print('Evaluate : {} features'.format(args.features))
+
+    json_loads = json_dumps = None
+    # The standard library first, as the reference
+    for name in reversed(available_backends()):
+        backend = BACKENDS[name]
+        # Same content with each backend
+        assert json.loads(backend.dumps(body)) == json.loads(json.dumps(body))
+        assert backend.loads(config) == json.loads(config)
+
+        loads = timing(lambda: backend.loads(config), args.repeat)
+        dumps = timing(lambda: backend.dumps(body), args.repeat)
+        if name == 'json':
+            json_loads, json_dumps = loads, dumps
+            print('{:>7} : config loads {:8.1f} ms, evaluate dumps {:8.1f} ms'.format(name, loads, dumps))
+        else:
+            print('{:>7} : config loads {:8.1f} ms x{:.1f}, evaluate dumps {:8.1f} ms x{:.1f}'.format(
+                name, loads, json_loads / loads, dumps, json_dumps / dumps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+"""
+Benchmark of the spatial join with a pool of processes, against a single process.
+
+Only OGR is needed, QGIS is not used. From the root of the repository :
+
+    PYTHONPATH=. python3 test/benchmark_parallel_join.py --features 2000000 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from osgeo import ogr, osr
+
+from lizmap_server.parallel_join import (
+    parallel_features_ids,
+    shutdown,
+    tile_features_ids,
+)
+
+
+def create_points(path: str, count: int) -> None:
+    """ GeoPackage with random points in a 100 km square. """
+    driver = ogr.GetDriverByName('GPKG')
+    dataset = driver.CreateDataSource(path)
+    crs = osr.SpatialReference()
+    crs.ImportFromEPSG(2154)
+    layer = dataset.CreateLayer('points', crs, ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn('id', ogr.OFTInteger))
+
+    random.seed(42)
+    layer.StartTransaction()
+    for i in range(count):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('id', i)
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(random.uniform(700000, 800000), random.uniform(6600000, 6700000))
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    dataset = None
+
+
+def polygon_wkb() -> bytes:
+    """ A detailed polygon, like an administrative boundary. """
+    center = ogr.Geometry(ogr.wkbPoint)
+    center.AddPoint_2D(750000, 6650000)
+    return center.Buffer(40000, 2000).ExportToWkb()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--features', type=int, default=1000000, help='Number of points')
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[1, 2, os.cpu_count() or 1], help='Number of processes')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'points.gpkg')
+        print('Creating {} points...'.format(args.features))
+        create_points(path, args.features)
+
+        wkb = polygon_wkb()
+        rectangle = (710000, 6610000, 790000, 6690000)
+
+        start = time.perf_counter()
+        expected = tile_features_ids(path, 'points', 'id', wkb, 'intersects', rectangle)
+        reference = time.perf_counter() - start
+        print('Single process : {:.2f} s, {} features found'.format(reference, len(expected)))
+
+        for workers in args.workers:
+            # The first call starts the processes
+            parallel_features_ids(path, 'points', 'id', wkb, 'intersects', rectangle, workers)
+
+            start = time.perf_counter()
+            result = parallel_features_ids(path, 'points', 'id', wkb, 'intersects', rectangle, workers)
+            duration = time.perf_counter() - start
+            assert sorted(result) == sorted(expected)
+            print('{} processes : {:.2f} s, speedup x{:.1f}'.format(workers, duration, reference / duration))
+
+        shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the LRU cache. """
+
+import threading
+import time
+import unittest
+
+from lizmap_server.cache import BackgroundRefresh, LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru_size(self):
+        """ Test the least recently used entry is dropped first. """
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(2, len(cache))
+
+    def test_ttl(self):
+        """ Test an entry is expired after the time to live. """
+        cache = LRUCache(maxsize=2, ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_info(self):
+        """ Test hits and misses counters. """
+        cache = LRUCache(maxsize=10)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(1, cache.get('a'))
+
+        info = cache.info()
+        self.assertEqual(2, info.hits)
+        self.assertEqual(1, info.misses)
+        self.assertEqual(10, info.maxsize)
+        self.assertEqual(1, info.currsize)
+
+        cache.clear()
+        self.assertEqual((0, 0, 10, 0, 0), tuple(cache.info()))
+
+    def test_max_weight(self):
+        """ Test entries are dropped according to a weight budget. """
+        cache = LRUCache(maxsize=10, max_weight=100)
+        cache.set('a', 1, weight=60)
+        cache.set('b', 2, weight=30)
+        self.assertEqual(90, cache.info().weight)
+
+        cache.set('c', 3, weight=20)
+        self.assertNotIn('a', cache)
+        self.assertEqual(50, cache.info().weight)
+
+        # Too heavy for the cache
+        cache.set('d', 4, weight=101)
+        self.assertNotIn('d', cache)
+
+        # Replacing an entry
+        cache.set('b', 2, weight=10)
+        self.assertEqual(30, cache.info().weight)
+
+    def test_invalidate(self):
+        """ Test removing entries matching a predicate. """
+        cache = LRUCache(maxsize=10)
+        cache.set(('layer_a', 'group_1'), 1)
+        cache.set(('layer_a', 'group_2'), 2)
+        cache.set(('layer_b', 'group_1'), 3)
+
+        self.assertEqual(2, cache.invalidate(lambda key: key[0] == 'layer_a'))
+        self.assertEqual(1, len(cache))
+        self.assertIn(('layer_b', 'group_1'), cache)
+        self.assertEqual(0, cache.invalidate(lambda key: key[0] == 'layer_a'))
+
+    def test_items_replace(self):
+        """ Test reading and replacing entries matching a predicate. """
+        cache = LRUCache(maxsize=10, ttl=0.05)
+        cache.set(('layer_a', 'group_1'), 1, weight=3)
+        cache.set(('layer_b', 'group_1'), 2)
+
+        self.assertListEqual([(('layer_a', 'group_1'), 1)], cache.items(lambda key: key[0] == 'layer_a'))
+        self.assertEqual(0, cache.info().hits)
+
+        self.assertTrue(cache.replace(('layer_a', 'group_1'), 10))
+        self.assertEqual(10, cache.get(('layer_a', 'group_1')))
+        self.assertEqual(4, cache.info().weight)
+        self.assertFalse(cache.replace(('layer_c', 'group_1'), 3))
+        self.assertNotIn(('layer_c', 'group_1'), cache)
+
+        # Same creation time, the entry still expires
+        time.sleep(0.07)
+        self.assertIsNone(cache.get(('layer_a', 'group_1')))
+
+    def test_grace(self):
+        """ Test an expired entry is returned by get_stale during the grace period. """
+        cache = LRUCache(maxsize=2, ttl=0.05, grace=0.1)
+        cache.set('a', 1)
+        self.assertEqual((1, False), cache.get_stale('a'))
+
+        time.sleep(0.07)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((1, True), cache.get_stale('a'))
+        self.assertNotIn('a', cache)
+
+        time.sleep(0.1)
+        self.assertEqual((None, False), cache.get_stale('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_background_refresh(self):
+        """ Test a key is computed once at a time in the background. """
+        refresh = BackgroundRefresh()
+        event = threading.Event()
+        results = []
+
+        def compute():
+            event.wait(1)
+            results.append(1)
+
+        self.assertTrue(refresh.submit('a', compute))
+        self.assertFalse(refresh.submit('a', compute))
+        self.assertEqual(1, refresh.pending())
+
+        event.set()
+        refresh.shutdown()
+        self.assertListEqual([1], results)
+        self.assertEqual(0, refresh.pending())
+
+        # Threads are started again if needed
+        self.assertTrue(refresh.submit('a', compute))
+        refresh.shutdown()
+        self.assertListEqual([1, 1], results)
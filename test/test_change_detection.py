@@ -0,0 +1,135 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the detection of data changes. """
+
+import os
+import tempfile
+import time
+import unittest
+
+from lizmap_server.change_detection import (
+    HAS_PSYCOPG2,
+    ChangeNotifications,
+    ChangeTokens,
+    file_stamp,
+)
+
+# A local PostgreSQL database, eg "service=lizmap_test" or "dbname=lizmap host=localhost"
+TEST_DSN = os.getenv('QGIS_SERVER_LIZMAP_TEST_PG_DSN', '')
+
+
+class TestChangeDetection(unittest.TestCase):
+
+    def test_file_stamp(self):
+        """ Test the stamp changes if the file is replaced. """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'project.qgs.cfg')
+            self.assertIsNone(file_stamp(path))
+
+            with open(path, 'w') as f:
+                f.write('{}')
+            stamp = file_stamp(path)
+            self.assertIsNotNone(stamp)
+            self.assertEqual(stamp, file_stamp(path))
+
+            # Same size and same modification time, but another file
+            other = os.path.join(directory, 'other.cfg')
+            with open(other, 'w') as f:
+                f.write('[]')
+            os.utime(other, ns=(stamp[0], stamp[0]))
+            os.replace(other, path)
+            self.assertNotEqual(stamp, file_stamp(path))
+
+    def test_change_tokens(self):
+        """ Test the token is read from the query, at most once during the interval. """
+        statements = []
+
+        def execute(connection_info: str, sql: str) -> list:
+            statements.append(sql)
+            return [[len(statements)]]
+
+        tokens = ChangeTokens('SELECT max(updated_at) FROM {schema}.{table} -- {name}', 0.05, execute)
+        self.assertEqual('1', tokens.token('dbname=a', 'public', 'town"halls'))
+        self.assertEqual('SELECT max(updated_at) FROM "public"."town""halls" -- \'public.town"halls\'', statements[0])
+        self.assertEqual('1', tokens.token('dbname=a', 'public', 'town"halls'))
+        self.assertEqual(1, len(statements))
+
+        time.sleep(0.06)
+        self.assertEqual('2', tokens.token('dbname=a', 'public', 'town"halls'))
+
+        # Disabled
+        self.assertIsNone(ChangeTokens('', 1, execute).token('dbname=a', 'public', 'townhalls'))
+
+    def test_change_tokens_error(self):
+        """ Test no token is available if the query fails. """
+        def execute(connection_info: str, sql: str) -> list:
+            raise ConnectionError('Connection lost')
+
+        self.assertIsNone(ChangeTokens('SELECT 1', 1, execute).token('dbname=a', 'public', 'townhalls'))
+
+    def test_notifications_disabled(self):
+        """ Test no generation is available without channel. """
+        self.assertIsNone(ChangeNotifications('').generation('dbname=a', 'public', 'townhalls'))
+
+    @unittest.skipIf(not TEST_DSN or not HAS_PSYCOPG2, 'A local PostgreSQL database and psycopg2 are required')
+    def test_notifications(self):
+        """ Test the generation of a table is incremented by a notification. """
+        import psycopg2
+
+        notifications = ChangeNotifications('lizmap_test_changes', reconnect_delay=0.1)
+        try:
+            first = notifications.generation(TEST_DSN, 'public', 'townhalls')
+
+            # Wait for the listening connection
+            deadline = time.monotonic() + 5
+            while notifications.generation(TEST_DSN, 'public', 'townhalls') == first:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+            listening = notifications.generation(TEST_DSN, 'public', 'townhalls')
+
+            connection = psycopg2.connect(TEST_DSN)
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute("NOTIFY lizmap_test_changes, 'public.townhalls';")
+            connection.close()
+
+            deadline = time.monotonic() + 5
+            while notifications.generation(TEST_DSN, 'public', 'townhalls') == listening:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+
+            # Other tables are not affected
+            self.assertEqual(first[1], notifications.generation(TEST_DSN, 'public', 'bakeries')[1])
+        finally:
+            notifications.stop()
+
+    @unittest.skipIf(not TEST_DSN or not HAS_PSYCOPG2, 'A local PostgreSQL database and psycopg2 are required')
+    def test_change_tokens_postgresql(self):
+        """ Test the token follows the edits of a table. """
+        import psycopg2
+
+        connection = psycopg2.connect(TEST_DSN)
+        connection.autocommit = True
+
+        def execute(connection_info: str, sql: str) -> list:
+            with connection.cursor() as c:
+                c.execute(sql)
+                return c.fetchall()
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TEMPORARY TABLE lizmap_test_tokens (id serial, updated_at timestamp DEFAULT now());")
+                cursor.execute("INSERT INTO lizmap_test_tokens DEFAULT VALUES;")
+
+            tokens = ChangeTokens('SELECT max(updated_at) FROM {table}', 0, execute)
+            token = tokens.token(TEST_DSN, 'pg_temp', 'lizmap_test_tokens')
+            self.assertEqual(token, tokens.token(TEST_DSN, 'pg_temp', 'lizmap_test_tokens'))
+
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO lizmap_test_tokens DEFAULT VALUES;")
+            self.assertNotEqual(token, tokens.token(TEST_DSN, 'pg_temp', 'lizmap_test_tokens'))
+        finally:
+            connection.close()
@@ -0,0 +1,109 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the compiled Lizmap config. """
+
+import os
+import unittest
+
+from lizmap_server.compiled_config import (
+    CompiledConfig,
+    EditionConfig,
+    LoginFilter,
+    PolygonFilterLayer,
+    parse_groups,
+    polygon_filter_layers,
+)
+from lizmap_server.core import get_lizmap_compiled_config
+
+
+class TestCompiledConfig(unittest.TestCase):
+
+    def test_parse_groups(self):
+        """ Test groups from a list or a string. """
+        self.assertIsNone(parse_groups(None))
+        self.assertIsNone(parse_groups(''))
+        self.assertIsNone(parse_groups([]))
+        self.assertEqual(frozenset(['a', 'b']), parse_groups('a, b ,a'))
+        self.assertEqual(frozenset(['a', 'b']), parse_groups([' a', 'b']))
+
+    def test_compiled_config(self):
+        """ Test the lookup tables built from the config. """
+        compiled = CompiledConfig({
+            'options': {'acl': ['admins', 'test2']},
+            'layers': {
+                'lines': {'id': 'lines_id', 'group_visibility': [' admins ', 'test2']},
+                'points': {'id': 'points_id', 'group_visibility': ['']},
+                'polygons': {'id': 'polygons_id'},
+            },
+            'editionLayers': {
+                'lines_id': {
+                    'acl': 'admins, editors',
+                    'capabilities': {
+                        'createFeature': 'True',
+                        'modifyAttribute': 'False',
+                        'modifyGeometry': 'True',
+                        'deleteFeature': 'False',
+                    },
+                },
+                'points_id': {'acl': ''},
+            },
+            'loginFilteredLayers': {
+                'lines': {'layerId': 'lines_id', 'filterAttribute': 'owner', 'filterPrivate': 'True'},
+                'points': {'layerId': 'points_id', 'filterAttribute': 'owner'},
+            },
+        })
+        self.assertEqual(frozenset(['admins', 'test2']), compiled.acl)
+
+        self.assertEqual(frozenset(['admins', 'test2']), compiled.layers_by_name['lines'].group_visibility)
+        self.assertIs(compiled.layers_by_name['lines'], compiled.layers_by_id['lines_id'])
+        # Just an empty string
+        self.assertIsNone(compiled.layers_by_id['points_id'].group_visibility)
+        self.assertIsNone(compiled.layers_by_name['polygons'].group_visibility)
+        self.assertTrue(compiled.has_group_visibility)
+
+        self.assertEqual(
+            EditionConfig(frozenset(['admins', 'editors']), True, True, False), compiled.edition_layers['lines_id'])
+        self.assertEqual(EditionConfig(None, False, False, False), compiled.edition_layers['points_id'])
+        self.assertNotIn('polygons_id', compiled.edition_layers)
+
+        self.assertEqual(LoginFilter('lines_id', 'owner', True, False), compiled.login_filters['lines'])
+        # Not well formed
+        self.assertNotIn('points', compiled.login_filters)
+
+        self.assertEqual({}, compiled.polygon_filter_layers)
+
+    def test_no_group_visibility(self):
+        """ Test a config without group visibility. """
+        compiled = CompiledConfig({'layers': {'lines': {'id': 'lines_id', 'group_visibility': []}}})
+        self.assertIsNone(compiled.acl)
+        self.assertFalse(compiled.has_group_visibility)
+        self.assertEqual({}, compiled.edition_layers)
+        self.assertEqual({}, compiled.login_filters)
+
+    def test_polygon_filter_layers(self):
+        """ Test the layers filtered by polygon are read once. """
+        layers = polygon_filter_layers({
+            'config': {'polygon_layer_id': 'polygons_id', 'group_field': 'groups'},
+            'layers': [
+                {'layer': 'lines_id', 'primary_key': 'id', 'filter_mode': 'display_and_editing',
+                 'spatial_relationship': 'intersects'},
+                {'primary_key': 'id'},
+                {'layer': 'lines_id', 'primary_key': 'other'},
+            ],
+        })
+        self.assertEqual(
+            {'lines_id': PolygonFilterLayer('lines_id', 'id', 'display_and_editing', 'intersects')}, layers)
+        self.assertEqual({}, polygon_filter_layers(None))
+
+    def test_compiled_once(self):
+        """ Test the config is compiled once for a version of the file. """
+        project_path = os.path.join(os.path.dirname(__file__), 'data', 'france_parts_liz_grp_v.qgs')
+        compiled = get_lizmap_compiled_config(project_path)
+        self.assertIs(compiled, get_lizmap_compiled_config(project_path))
+        self.assertTrue(compiled.has_group_visibility)
+        self.assertEqual(
+            frozenset(['test2', 'admins']), compiled.layers_by_name['france_parts'].group_visibility)
+
+        self.assertIsNone(get_lizmap_compiled_config('/not/a/project.qgs'))
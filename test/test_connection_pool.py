@@ -0,0 +1,174 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the pool of database connections. """
+
+import os
+import time
+import unittest
+
+from lizmap_server.connection_pool import (
+    HAS_PSYCOPG2,
+    ConnectionPool,
+    ConnectionPoolError,
+    check_postgres,
+    close_postgres,
+    connect_postgres,
+    execute_postgres,
+)
+
+# libpq connection string of a local PostgreSQL database, for instance "host=/tmp/pg dbname=postgres"
+TEST_DSN = os.getenv('QGIS_SERVER_LIZMAP_TEST_PG_DSN', '')
+
+
+class FakeConnection:
+    """ Stand-in for a PostgreSQL connection. """
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.broken = False
+        self.closed = False
+        self.statements = []
+
+    def executeSql(self, sql: str) -> list:
+        if self.broken:
+            raise ConnectionError('Connection lost')
+        self.statements.append(sql)
+        return [[1]]
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_reuse(self):
+        """ Test connections are reused for the same URI only. """
+        pool = ConnectionPool(FakeConnection)
+
+        with pool.connection('dbname=a') as connection:
+            first = connection
+            self.assertEqual([[1]], connection.executeSql('SELECT 1'))
+        self.assertEqual(1, pool.info().idle)
+
+        with pool.connection('dbname=a') as connection:
+            self.assertIs(first, connection)
+
+        with pool.connection('dbname=b') as connection:
+            self.assertIsNot(first, connection)
+
+        info = pool.info()
+        self.assertEqual(2, info.created)
+        self.assertEqual(1, info.reused)
+        self.assertEqual(0, info.in_use)
+
+    def test_exception_discard(self):
+        """ Test a connection is not reused after an exception. """
+        pool = ConnectionPool(FakeConnection)
+
+        with self.assertRaises(ValueError):
+            with pool.connection('dbname=a'):
+                raise ValueError()
+
+        self.assertEqual(1, pool.info().discarded)
+        self.assertEqual(0, pool.info().idle)
+        self.assertEqual(0, pool.info().in_use)
+
+    def test_health_check(self):
+        """ Test a broken connection is replaced. """
+        pool = ConnectionPool(
+            FakeConnection, health_check=lambda c: c.executeSql('SELECT 1'), health_check_interval=0)
+
+        with pool.connection('dbname=a') as connection:
+            connection.broken = True
+
+        with pool.connection('dbname=a') as connection:
+            self.assertFalse(connection.broken)
+
+        info = pool.info()
+        self.assertEqual(2, info.created)
+        self.assertEqual(0, info.reused)
+        self.assertEqual(1, info.discarded)
+
+    def test_idle_timeout(self):
+        """ Test idle connections are dropped. """
+        pool = ConnectionPool(FakeConnection, idle_timeout=0.05)
+        with pool.connection('dbname=a'):
+            pass
+
+        time.sleep(0.1)
+        with pool.connection('dbname=a'):
+            pass
+
+        self.assertEqual(2, pool.info().created)
+        self.assertEqual(1, pool.info().discarded)
+
+    def test_max_size(self):
+        """ Test the maximum number of connections. """
+        pool = ConnectionPool(FakeConnection, max_size=1, acquire_timeout=0.05)
+        connection = pool.acquire('dbname=a')
+        with self.assertRaises(ConnectionPoolError):
+            pool.acquire('dbname=a')
+
+        pool.release('dbname=a', connection)
+        self.assertIs(connection, pool.acquire('dbname=a'))
+
+    def test_close(self):
+        """ Test dropped connections are closed, not the idle ones. """
+        pool = ConnectionPool(FakeConnection, close=lambda c: setattr(c, 'closed', True))
+
+        with self.assertRaises(ValueError):
+            with pool.connection('dbname=a') as connection:
+                raise ValueError()
+        self.assertTrue(connection.closed)
+
+        with pool.connection('dbname=a') as connection:
+            pass
+        self.assertFalse(connection.closed)
+
+        pool.clear()
+        self.assertTrue(connection.closed)
+        self.assertEqual(0, pool.info().idle)
+
+
+@unittest.skipIf(not TEST_DSN or not HAS_PSYCOPG2, 'A local PostgreSQL database and psycopg2 are required')
+class TestPostgresConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(
+            lambda dsn: connect_postgres(dsn, 'Lizmap test'),
+            health_check=check_postgres,
+            health_check_interval=0,
+            close=close_postgres,
+        )
+
+    def tearDown(self):
+        self.pool.clear()
+
+    def test_reuse(self):
+        """ Test the same server session is used by successive queries. """
+        pid = execute_postgres(self.pool, TEST_DSN, 'SELECT pg_backend_pid();')[0][0]
+        self.assertEqual(pid, execute_postgres(self.pool, TEST_DSN, 'SELECT pg_backend_pid();')[0][0])
+        self.assertEqual(
+            'Lizmap test', execute_postgres(self.pool, TEST_DSN, "SELECT current_setting('application_name');")[0][0])
+
+        info = self.pool.info()
+        self.assertEqual(1, info.created)
+        self.assertEqual(2, info.reused)
+
+    def test_statement_timeout(self):
+        """ Test the statement timeout stops the query, and does not stay on the connection. """
+        with self.assertRaises(Exception):
+            execute_postgres(self.pool, TEST_DSN, 'SELECT pg_sleep(1);', statement_timeout=50)
+        self.assertEqual(1, self.pool.info().discarded)
+
+        execute_postgres(self.pool, TEST_DSN, 'SELECT 1;', statement_timeout=50)
+        self.assertEqual('0', execute_postgres(self.pool, TEST_DSN, 'SHOW statement_timeout;')[0][0])
+        self.assertEqual(2, self.pool.info().created)
+
+    def test_broken_connection(self):
+        """ Test a closed connection is replaced. """
+        pid = execute_postgres(self.pool, TEST_DSN, 'SELECT pg_backend_pid();')[0][0]
+        with self.pool.connection(TEST_DSN) as connection:
+            connection.close()
+
+        self.assertNotEqual(pid, execute_postgres(self.pool, TEST_DSN, 'SELECT pg_backend_pid();')[0][0])
+        self.assertEqual(1, self.pool.info().discarded)
@@ -4,18 +4,43 @@ __email__ = 'info@3liz.org'
 
 """ Test filter by polygon. """
 
+import tempfile
 import unittest
 
+from pathlib import Path
+
 from qgis.core import (
     QgsCoordinateReferenceSystem,
+    QgsDataSourceUri,
     QgsFeature,
+    QgsFeatureRequest,
     QgsGeometry,
     QgsProject,
+    QgsRectangle,
+    QgsReferencedRectangle,
     QgsVectorLayer,
     edit,
 )
 
-from lizmap_server.filter_by_polygon import FilterByPolygon
+from lizmap_server import filter_by_polygon, json_backend
+from lizmap_server.change_detection import layer_source_stamp
+from lizmap_server.expression_functions import (
+    USER_POLYGONS,
+    register_expression_functions,
+)
+from lizmap_server.filter_by_polygon import (
+    FEATURE_IDS_CACHE,
+    SUBSET_CACHE,
+    FilterByPolygon,
+    FilterType,
+)
+from lizmap_server.polygon_layer import PolygonLayer, split_groups
+from lizmap_server.polygon_membership import polygon_membership
+from lizmap_server.precomputed import (
+    SIDECAR_SUFFIX,
+    project_checksum,
+    write_precomputed,
+)
 
 
 class TestFilterByPolygon(unittest.TestCase):
@@ -146,6 +171,40 @@ class TestFilterByPolygon(unittest.TestCase):
         self.assertEqual(
             'SRID=4326;MultiPolygon (((0 0, 0 -5, -5 -5, -5 0, 0 0)))', ewkt)
 
+        # Only in the extent of the request, the features of the whole polygon are shared between tiles
+        FEATURE_IDS_CACHE.clear()
+        extent = QgsReferencedRectangle(QgsRectangle(-2, -2, -0.5, -0.5), points.crs())
+        config = FilterByPolygon(json, points, editing=False, extent=extent)
+        subset, _ = config.subset_sql(('admins', ))
+        self.assertEqual('"id" IN ( 3 )', subset)
+        self.assertEqual(0, FEATURE_IDS_CACHE.info().hits)
+        self.assertEqual(1, FEATURE_IDS_CACHE.info().misses)
+
+        extent = QgsReferencedRectangle(QgsRectangle(0.5, 0.5, 2, 2), points.crs())
+        config = FilterByPolygon(json, points, editing=False, extent=extent)
+        subset, _ = config.subset_sql(('admins', ))
+        self.assertEqual('"id" IN ( 1 )', subset)
+        self.assertEqual(1, FEATURE_IDS_CACHE.info().hits)
+
+        extent = QgsReferencedRectangle(QgsRectangle(8, 8, 12, 12), points.crs())
+        config = FilterByPolygon(json, points, editing=False, extent=extent)
+        subset, _ = config.subset_sql(('admins', ))
+        self.assertEqual('1 = 0', subset)
+        self.assertEqual(2, FEATURE_IDS_CACHE.info().hits)
+
+        # Same features for an expression
+        config = FilterByPolygon(json, points, editing=False, extent=extent, filter_type=FilterType.QgisExpression)
+        subset, _ = config.subset_sql(('admins', ))
+        self.assertEqual('1 = 0', subset)
+        self.assertEqual(3, FEATURE_IDS_CACHE.info().hits)
+
+        # A new instance, with the same groups in another order, is using the cache
+        hits = SUBSET_CACHE.info().hits
+        config = FilterByPolygon(json, points, editing=False)
+        subset, _ = config.subset_sql((' west', 'west'))
+        self.assertEqual('"id" IN ( 3 )', subset)
+        self.assertEqual(hits + 1, SUBSET_CACHE.info().hits)
+
         # The only layer is editing only
         json = {
             "config": {
@@ -184,6 +243,355 @@ class TestFilterByPolygon(unittest.TestCase):
         # self.assertEqual('', config.subset_sql(groups))
         project.clear()
 
+    # noinspection PyArgumentList
+    def test_expression_function(self):
+        """ Test the filter by polygon with the lizmap_in_user_polygon expression function. """
+        register_expression_functions()
+
+        polygon = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygon):
+            feature = QgsFeature(polygon.fields())
+            feature.setGeometry(QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,5 0,0 0))'))
+            feature.setAttributes([1, "east,admins"])
+            self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer('Point?crs=epsg:3857&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(111319 111325)'), (2, 'POINT(-111319 -111325)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        json = {
+            "config": {
+                "polygon_layer_id": polygon.id(),
+                "group_field": "groups"
+            },
+            "layers": [
+                {
+                    "layer": points.id(),
+                    "primary_key": "id",
+                    "spatial_relationship": "intersects",
+                    "filter_mode": "display_and_editing"
+                }
+            ]
+        }
+
+        project = QgsProject.instance()
+        project.addMapLayer(polygon)
+        # The groups of the current user
+        project.setCustomVariables({'lizmap_user_groups': ['unknown', 'east']})
+
+        filter_by_polygon.USE_EXPRESSION_FUNCTION = True
+        try:
+            config = FilterByPolygon(json, points, filter_type=FilterType.QgisExpression)
+            self.assertTrue(config.uses_expression_function())
+
+            expression, ewkt = config.subset_sql(('east', 'unknown'))
+            self.assertEqual("lizmap_in_user_polygon($geometry, '{}')".format(points.id()), expression)
+            self.assertEqual('SRID=4326;MultiPolygon (((0 0, 0 5, 5 5, 5 0, 0 0)))', ewkt)
+
+            request = QgsFeatureRequest()
+            request.setFilterExpression(expression)
+            self.assertListEqual([1], [f['id'] for f in points.getFeatures(request)])
+
+            # The groups of the current user can be given
+            request.setFilterExpression(
+                "lizmap_in_user_polygon($geometry, '{}', 'east, unknown')".format(points.id()))
+            self.assertListEqual([1], [f['id'] for f in points.getFeatures(request)])
+
+            # Not the polygon of other groups
+            for groups in ('admins', 'east'):
+                request.setFilterExpression(
+                    "lizmap_in_user_polygon($geometry, '{}', '{}')".format(points.id(), groups))
+                self.assertListEqual([], [f['id'] for f in points.getFeatures(request)])
+
+            # Nor with the variable of the expression context
+            request.setFilterExpression(
+                "with_variable('lizmap_user_groups', 'admins', lizmap_in_user_polygon($geometry, '{}'))".format(
+                    points.id()))
+            self.assertListEqual([1], [f['id'] for f in points.getFeatures(request)])
+
+            # Removed from the cache, computed again from the Lizmap config of the project
+            USER_POLYGONS.clear()
+            with tempfile.TemporaryDirectory() as directory:
+                project_path = str(Path(directory).joinpath('polygon.qgs'))
+                Path(project_path + '.cfg').write_bytes(json_backend.dumps({'filter_by_polygon': json}))
+                project.setFileName(project_path)
+                project.addMapLayer(points)
+
+                request.setFilterExpression(expression)
+                self.assertListEqual([1], [f['id'] for f in points.getFeatures(request)])
+                self.assertEqual(1, USER_POLYGONS.info().currsize)
+
+            expression, _ = config.subset_sql(('unknown', ))
+            self.assertEqual('1 = 0', expression)
+        finally:
+            filter_by_polygon.USE_EXPRESSION_FUNCTION = False
+            project.clear()
+
+    # noinspection PyArgumentList
+    def test_spatial_predicate_contains(self):
+        """ Test the spatial predicate keeps the same features as the list of IDs, for 'contains'. """
+        polygon = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygon):
+            feature = QgsFeature(polygon.fields())
+            feature.setGeometry(QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,5 0,0 0))'))
+            feature.setAttributes([1, "east"])
+            self.assertTrue(polygon.addFeature(feature))
+
+        areas = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer', 'areas', 'memory')
+        with edit(areas):
+            for fid, wkt in (
+                    # Contains the polygon, not kept
+                    (1, 'POLYGON((-1 -1,-1 6,6 6,6 -1,-1 -1))'),
+                    # Inside the polygon, kept
+                    (2, 'POLYGON((1 1,1 2,2 2,2 1,1 1))'),
+                    # Outside
+                    (3, 'POLYGON((10 10,10 11,11 11,11 10,10 10))'),
+                    # Same geometry, kept
+                    (4, 'POLYGON((0 0,0 5,5 5,5 0,0 0))'),
+            ):
+                feature = QgsFeature(areas.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(areas.addFeature(feature))
+
+        json = {
+            "config": {
+                "polygon_layer_id": polygon.id(),
+                "group_field": "groups"
+            },
+            "layers": [
+                {
+                    "layer": areas.id(),
+                    "primary_key": "id",
+                    "spatial_relationship": "contains",
+                    "filter_mode": "display_and_editing"
+                }
+            ]
+        }
+
+        project = QgsProject.instance()
+        project.addMapLayer(polygon)
+
+        def features(expression: str) -> list:
+            request = QgsFeatureRequest()
+            request.setFilterExpression(expression)
+            return sorted(f['id'] for f in areas.getFeatures(request))
+
+        try:
+            config = FilterByPolygon(
+                json, areas, filter_type=FilterType.QgisExpression, use_spatial_predicate=True)
+            ids = config._subset_sql(('east', ))
+            self.assertEqual('"id" IN ( 2 , 4 )', ids)
+
+            # Not enabled
+            filter_by_polygon.MAX_FEATURE_IDS = 1
+            config = FilterByPolygon(json, areas, filter_type=FilterType.QgisExpression)
+            self.assertEqual(ids, config._subset_sql(('east', )))
+
+            config = FilterByPolygon(
+                json, areas, filter_type=FilterType.QgisExpression, use_spatial_predicate=True)
+            predicate = config._subset_sql(('east', ))
+            self.assertTrue(predicate.startswith("contains(geom_from_wkt('"))
+            self.assertTrue(predicate.endswith("'), $geometry)"))
+            self.assertListEqual([2, 4], features(ids))
+            self.assertListEqual(features(ids), features(predicate))
+        finally:
+            filter_by_polygon.MAX_FEATURE_IDS = 10000
+            project.clear()
+
+    def test_subdivided_polygon(self):
+        """ Test the polygon split in small parts. """
+        geometry = QgsGeometry.fromWkt('POINT(0 0)').buffer(10, 50)
+        polygon = filter_by_polygon.TransformedPolygon(geometry, geometry, None)
+
+        self.assertListEqual([geometry], FilterByPolygon._subdivided(polygon))
+
+        filter_by_polygon.SUBDIVIDE_MAX_VERTICES = 16
+        try:
+            parts = FilterByPolygon._subdivided(polygon)
+            self.assertGreater(len(parts), 1)
+            for part in parts:
+                self.assertLessEqual(part.constGet().nCoordinates(), 16)
+            self.assertAlmostEqual(geometry.area(), sum(part.area() for part in parts), 4)
+
+            # From the cache
+            self.assertIs(parts, FilterByPolygon._subdivided(polygon))
+        finally:
+            filter_by_polygon.SUBDIVIDE_MAX_VERTICES = 0
+
+    def test_reduce_precision(self):
+        """ Test the polygon simplified and snapped to a grid. """
+        polygon = QgsVectorLayer('Polygon?field=id:integer&field=groups:string', 'polygon', 'memory')
+        config = FilterByPolygon(None, polygon)
+        config.polygon = polygon
+
+        geometry = QgsGeometry.fromWkt('POINT(0 0)').buffer(10, 50)
+        self.assertIs(geometry, config._reduce_precision(geometry))
+
+        filter_by_polygon.PRECISION_TOLERANCE = 1
+        try:
+            reduced = config._reduce_precision(geometry)
+            self.assertLess(reduced.constGet().nCoordinates(), geometry.constGet().nCoordinates())
+            self.assertTrue(reduced.isGeosValid())
+            self.assertLess(reduced.hausdorffDistance(geometry), 1)
+        finally:
+            filter_by_polygon.PRECISION_TOLERANCE = 0.0
+
+    # noinspection PyArgumentList
+    def test_precomputed_precision(self):
+        """ Test the precomputed features are not used with a precision tolerance. """
+        polygon = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        square = QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,5 0,0 0))')
+        with edit(polygon):
+            feature = QgsFeature(polygon.fields())
+            feature.setGeometry(square)
+            feature.setAttributes([1, 'east'])
+            self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer('Point?crs=epsg:4326&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(1 1)'), (2, 'POINT(-1 -1)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        json = {
+            "config": {"polygon_layer_id": polygon.id(), "group_field": "groups"},
+            "layers": [{"layer": points.id(), "primary_key": "id", "spatial_relationship": "intersects"}],
+        }
+
+        project = QgsProject.instance()
+        with tempfile.TemporaryDirectory() as directory:
+            project_path = str(Path(directory).joinpath('project.qgs'))
+            Path(project_path).write_text('<qgis/>')
+            Path(project_path + '.cfg').write_text('{}')
+            # Not the real result, to know where the IDs come from
+            write_precomputed(
+                project_path + SIDECAR_SUFFIX,
+                project_checksum(project_path),
+                {'id': polygon.id(), 'group_field': 'groups', 'stamp': None},
+                {'east': bytes(square.asWkb())},
+                {points.id(): {'primary_key': 'id', 'stamp': None, 'ids': {'east': [2]}}},
+            )
+            project.setFileName(project_path)
+            project.addMapLayers([polygon, points])
+
+            try:
+                filter_by_polygon.clear_cache()
+                config = FilterByPolygon(json, points)
+                self.assertEqual('"id" IN ( 2 )', config._subset_sql(('east', )))
+
+                filter_by_polygon.PRECISION_TOLERANCE = 1
+                filter_by_polygon.clear_cache()
+                config = FilterByPolygon(json, points)
+                self.assertEqual('"id" IN ( 1 )', config._subset_sql(('east', )))
+            finally:
+                filter_by_polygon.PRECISION_TOLERANCE = 0.0
+                filter_by_polygon.clear_cache()
+                project.clear()
+
+    def test_split_groups(self):
+        """ Test groups used as a cache key. """
+        self.assertSetEqual({'a', 'b'}, split_groups('b,a', False))
+        self.assertSetEqual({'a', 'b c'}, split_groups('a, b c,a,', False))
+        self.assertSetEqual({'a', 'b', 'c'}, split_groups('a, b c,a,', True))
+        self.assertSetEqual(set(), split_groups(None, True))
+
+    def test_polygon_layer_in_memory(self):
+        """ Test the in memory copy of the polygon layer. """
+        polygon = QgsVectorLayer('Polygon?field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygon):
+            for wkt, groups in (
+                    ('POLYGON((0 0,0 5,5 5,5 0,0 0))', 'east, admins'),
+                    ('POLYGON((0 0,0 -5,-5 -5,-5 0,0 0))', 'west,admins'),
+                    ('POLYGON((10 10,10 15,15 15,15 10,10 10))', None)):
+                feature = QgsFeature(polygon.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([1, groups])
+                self.assertTrue(polygon.addFeature(feature))
+
+        layer = PolygonLayer(polygon, 'groups')
+        self.assertEqual(2, len(layer.geometries))
+        self.assertSetEqual({'east', 'west', 'admins'}, set(layer.features.keys()))
+        self.assertListEqual([1, 2], layer.feature_ids(('admins', 'east')))
+        self.assertListEqual([1], layer.feature_ids(('east', 'unknown')))
+        self.assertListEqual([], layer.feature_ids(('unknown', )))
+        self.assertTrue(layer.polygon_for_groups(('unknown', )).isEmpty())
+        self.assertEqual(
+            'MultiPolygon (((0 0, 0 -5, -5 -5, -5 0, 0 0)))',
+            layer.polygon_for_groups(('west', )).asWkt(0))
+        self.assertTrue(layer.is_up_to_date(polygon, 60))
+
+    # noinspection PyArgumentList
+    def test_polygon_membership(self):
+        """ Test the features intersecting each polygon. """
+        polygon = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygon):
+            for wkt, groups in (
+                    ('POLYGON((0 0,0 5,5 5,5 0,0 0))', 'east,admins'),
+                    ('POLYGON((0 0,0 -5,-5 -5,-5 0,0 0))', 'west,admins')):
+                feature = QgsFeature(polygon.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([1, groups])
+                self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer('Point?crs=epsg:4326&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(1 1)'), (2, 'POINT(10 10)'), (3, 'POINT(-1 -1)'), (4, 'POINT(0 0)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        polygons = PolygonLayer(polygon, 'groups')
+        membership = polygon_membership(points, 'id', polygons, polygon.crs(), QgsProject.instance(), 60)
+        self.assertListEqual([1, 4], membership.feature_ids(('east', )))
+        self.assertListEqual([1, 3, 4], membership.feature_ids(('admins', 'west')))
+        self.assertListEqual([], membership.feature_ids(('unknown', )))
+
+        # From the cache
+        self.assertIs(
+            membership, polygon_membership(points, 'id', polygons, polygon.crs(), QgsProject.instance(), 60))
+
+        # The polygon layer has been reloaded
+        polygons = PolygonLayer(polygon, 'groups')
+        self.assertIsNot(
+            membership, polygon_membership(points, 'id', polygons, polygon.crs(), QgsProject.instance(), 60))
+
+        json = {
+            "config": {"polygon_layer_id": polygon.id(), "group_field": "groups"},
+            "layers": [{"layer": points.id(), "primary_key": "id", "spatial_relationship": "intersects"}],
+        }
+        project = QgsProject.instance()
+        project.addMapLayer(polygon)
+        try:
+            config = FilterByPolygon(json, points)
+            self.assertListEqual([1, 4], config._features_ids_with_membership(('east', )))
+
+            # The polygon of the groups is reduced, not the polygons of the membership
+            filter_by_polygon.PRECISION_TOLERANCE = 1
+            self.assertIsNone(config._features_ids_with_membership(('east', )))
+        finally:
+            filter_by_polygon.PRECISION_TOLERANCE = 0
+            project.clear()
+
+    def test_layer_source_stamp(self):
+        """ Test the modification stamp of a layer. """
+        points = QgsVectorLayer('Point?field=id:integer', 'points', 'memory')
+        self.assertIsNone(layer_source_stamp(points))
+
+        path = Path(__file__).parent.joinpath('data', 'test_filter_layer_data_by_polygon_for_groups', 'bakeries.shp')
+        bakeries = QgsVectorLayer(str(path), 'bakeries', 'ogr')
+        self.assertTrue(bakeries.isValid())
+        stamp = layer_source_stamp(bakeries)
+        self.assertIsNotNone(stamp)
+        self.assertEqual(stamp, layer_source_stamp(bakeries))
+
     def test_format_sql_in(self):
         """ Test SQL IN statement. """
         # Integer only
@@ -201,19 +609,45 @@ class TestFilterByPolygon(unittest.TestCase):
         expected = '"code" IN ( \'a\' , \'b\' , \'c\' )'
         self.assertEqual(expected, sql)
 
+        # String with a quote
+        sql = FilterByPolygon._format_sql_in('code', ("a'b", ))
+        expected = '"code" IN ( \'a\'\'b\' )'
+        self.assertEqual(expected, sql)
+
+        # Unsorted integers with consecutive values
+        values = (9, 5, 4, 3, 2, 1, 7, 20, 21, 22, 23, 24, 25)
+        sql = FilterByPolygon._format_sql_in('code', values)
+        expected = '( "code" BETWEEN 1 AND 5 OR "code" BETWEEN 20 AND 25 OR "code" IN ( 7 , 9 ) )'
+        self.assertEqual(expected, sql)
+
+        # As a QGIS expression
+        sql = FilterByPolygon._format_sql_in('code', values, FilterType.QgisExpression, 'postgres')
+        expected = (
+            '( ("code" >= 1 AND "code" <= 5) OR ("code" >= 20 AND "code" <= 25) OR "code" IN ( 7 , 9 ) )')
+        self.assertEqual(expected, sql)
+
+        # For PostgreSQL
+        sql = FilterByPolygon._format_sql_in('code', values, FilterType.SafeSqlQuery, 'postgres')
+        expected = '( "code" BETWEEN 1 AND 5 OR "code" BETWEEN 20 AND 25 OR "code" = ANY(ARRAY[7,9]) )'
+        self.assertEqual(expected, sql)
+
+        # Long list
+        sql = FilterByPolygon._format_sql_in('code', list(range(0, 4000, 2)))
+        self.assertTrue(sql.startswith('( "code" IN ( 0 , 2 , 4 '))
+        self.assertEqual(2, sql.count(' IN '))
+
     def test_subset_string_postgres(self):
         """ Test building a postgresql string for filter by polygon. """
         # ST_Intersect
         sql = FilterByPolygon._format_sql_st_relationship(
             QgsCoordinateReferenceSystem("EPSG:2154"),
-            QgsCoordinateReferenceSystem("EPSG:4326"),
             'geom',
-            QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,5 0,0 0))'),
+            QgsGeometry.fromWkt('POLYGON((700000 6600000,700000 6600005.5,700005 6600005.5,700000 6600000))'),
             use_st_intersect=True,
         )
         expected = """
 ST_Intersects(
-    ST_Transform(ST_GeomFromText('Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))', 4326), 2154),
+    ST_GeomFromText('Polygon ((700000 6600000, 700000 6600005.5, 700005 6600005.5, 700000 6600000))', 2154),
     "geom"
 )"""
         self.assertEqual(expected, sql)
@@ -221,14 +655,93 @@ ST_Intersects(
         # ST_Contains
         sql = FilterByPolygon._format_sql_st_relationship(
             QgsCoordinateReferenceSystem("EPSG:2154"),
-            QgsCoordinateReferenceSystem("EPSG:4326"),
             'geom',
-            QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,5 0,0 0))'),
+            QgsGeometry.fromWkt('POLYGON((700000 6600000,700000 6600005.5,700005 6600005.5,700000 6600000))'),
             use_st_intersect=False,
         )
         expected = """
 ST_Contains(
-    ST_Transform(ST_GeomFromText('Polygon ((0 0, 0 5, 5 5, 5 0, 0 0))', 4326), 2154),
+    ST_GeomFromText('Polygon ((700000 6600000, 700000 6600005.5, 700005 6600005.5, 700000 6600000))', 2154),
     "geom"
 )"""
         self.assertEqual(expected, sql)
+
+        # As WKB
+        sql = FilterByPolygon._format_sql_st_relationship(
+            QgsCoordinateReferenceSystem("EPSG:2154"),
+            'geom',
+            QgsGeometry.fromWkt('POINT(1 2)'),
+            use_st_intersect=True,
+            use_wkb=True,
+        )
+        expected = """
+ST_Intersects(
+    ST_GeomFromWKB(decode('0101000000000000000000f03f0000000000000040', 'hex'), 2154),
+    "geom"
+)"""
+        self.assertEqual(expected, sql)
+
+    def test_subset_string_postgres_exists(self):
+        """ Test the subquery on the polygon table. """
+        sql = FilterByPolygon._format_sql_exists(
+            QgsDataSourceUri(
+                "dbname='lizmap' key='id' srid=2154 type=Point table=\"public\".\"shop\" (geom)"),
+            2154,
+            QgsDataSourceUri(
+                "dbname='lizmap' key='id' srid=4326 type=MultiPolygon table=\"admin\".\"town\" (the_geom)"),
+            4326,
+            'groups',
+            ('east', 'west'),
+        )
+        expected = r"""
+EXISTS (
+    SELECT 1
+    FROM "admin"."town" AS lizmap_polygon
+    WHERE
+        ARRAY_REMOVE(
+            STRING_TO_ARRAY(
+                regexp_replace(
+                    lizmap_polygon."groups", '[^a-zA-Z0-9_-]', ',', 'g'
+                ),
+                ','
+            ),
+        '') && ARRAY['east', 'west']::text[]
+        AND ST_Intersects(lizmap_polygon."the_geom", ST_Transform("public"."shop"."geom", 4326))
+)"""
+        self.assertEqual(expected, sql)
+
+    def test_sql_features_ids(self):
+        """ Test the query of the feature IDs, used by the background refresh. """
+        sql = FilterByPolygon._format_sql_features_ids(
+            QgsDataSourceUri(
+                "dbname='lizmap' key='id' srid=2154 type=Point table=\"public\".\"shop\" (geom) sql=open"),
+            2154,
+            QgsDataSourceUri(
+                "dbname='lizmap' key='id' srid=4326 type=MultiPolygon table=\"admin\".\"town\" (the_geom)"),
+            4326,
+            'groups',
+            ('east', 'west'),
+            'id',
+            'contains',
+        )
+        expected = r"""
+WITH lizmap_polygon AS (
+    SELECT ST_Transform(ST_Union(p."the_geom"), 2154) AS lizmap_geom
+    FROM "admin"."town" AS p
+    WHERE
+        ARRAY_REMOVE(
+            STRING_TO_ARRAY(
+                regexp_replace(
+                    p."groups", '[^a-zA-Z0-9_-]', ',', 'g'
+                ),
+                ','
+            ),
+        '') && ARRAY['east', 'west']::text[]
+)
+SELECT "public"."shop"."id"
+FROM "public"."shop", lizmap_polygon
+WHERE
+    ST_Contains(lizmap_polygon.lizmap_geom, "public"."shop"."geom")
+    AND ( open )
+"""
+        self.assertEqual(expected, sql)
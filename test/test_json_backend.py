@@ -0,0 +1,68 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the JSON backends. """
+
+import datetime
+import json
+import unittest
+
+from lizmap_server.json_backend import (
+    BACKENDS,
+    available_backends,
+    get_backend,
+)
+
+
+class TestJsonBackend(unittest.TestCase):
+
+    def test_get_backend(self):
+        """ Test the fastest installed backend is used by default. """
+        self.assertEqual('json', available_backends()[-1])
+        self.assertEqual(available_backends()[0], get_backend().name)
+        self.assertEqual(available_backends()[0], get_backend('foo').name)
+        self.assertEqual('json', get_backend(' JSON ').name)
+
+    def test_backends(self):
+        """ Test all installed backends read and write the same content. """
+        data = {
+            'status': 'success',
+            'results': [{0: 1, 1: 'Montpellier é', 2: 1.5, 3: None, 4: [True, False]}],
+            'url': 'https://lizmap.com/',
+        }
+        for name in available_backends():
+            backend = BACKENDS[name]
+            with self.subTest(backend=name):
+                content = backend.dumps(data)
+                self.assertIsInstance(content, bytes)
+                self.assertEqual(json.loads(json.dumps(data)), json.loads(content))
+
+                self.assertEqual(json.loads(content), backend.loads(content))
+                self.assertEqual(json.loads(content), backend.loads(content.decode('utf-8')))
+
+                # Not supported by all backends, the standard library is used
+                self.assertEqual(b'[18446744073709551616]', backend.dumps([2 ** 64]))
+                self.assertTrue(str(backend.loads('[NaN]')[0]) == 'nan')
+
+                with self.assertRaises(ValueError):
+                    backend.loads('{"not": valid}')
+
+                with self.assertRaises(TypeError):
+                    backend.dumps({'set': {1, 2}})
+
+    def test_dumps_like_stdlib(self):
+        """ Test all installed backends write NaN and dates like the standard library. """
+        data = {'values': [1.5, None, float('nan'), float('inf'), -float('inf')], 'null': None}
+        for name in available_backends():
+            backend = BACKENDS[name]
+            with self.subTest(backend=name):
+                # Written again by the standard library, the spaces are not the same
+                self.assertEqual(json.dumps(data), json.dumps(json.loads(backend.dumps(data))))
+                self.assertEqual(b'[null]', backend.dumps([None]))
+
+                with self.assertRaises(TypeError):
+                    backend.dumps([datetime.date(2022, 1, 1)])
+
+                with self.assertRaises(TypeError):
+                    backend.dumps({'date': datetime.datetime(2022, 1, 1, 12, 0)})
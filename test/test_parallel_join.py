@@ -0,0 +1,99 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the spatial join with a pool of processes. """
+
+import os
+import unittest
+
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from qgis.core import QgsGeometry, QgsVectorLayer
+
+from lizmap_server import parallel_join
+from lizmap_server.parallel_join import (
+    parallel_features_ids,
+    shutdown,
+    tile_features_ids,
+    tiles,
+)
+
+BAKERIES = Path(__file__).parent.joinpath('data', 'test_filter_layer_data_by_polygon_for_groups', 'bakeries.shp')
+
+
+class TestParallelJoin(unittest.TestCase):
+
+    def test_tiles(self):
+        """ Test the rectangle split in tiles. """
+        result = tiles((0, 0, 10, 20), 4)
+        self.assertEqual(4, len(result))
+        self.assertIn((0, 0, 5, 10), result)
+        self.assertIn((5, 10, 10, 20), result)
+        self.assertAlmostEqual(200, sum((t[2] - t[0]) * (t[3] - t[1]) for t in result))
+
+        self.assertListEqual([(0, 0, 10, 20)], tiles((0, 0, 10, 20), 1))
+        self.assertEqual(9, len(tiles((0, 0, 10, 20), 7)))
+
+    def test_parallel_features_ids(self):
+        """ Test the same features are found with or without the pool of processes. """
+        path = BAKERIES
+        layer = QgsVectorLayer(str(path), 'bakeries', 'ogr')
+        self.assertTrue(layer.isValid())
+
+        # A diamond in the middle of the layer extent
+        extent = layer.extent()
+        center = extent.center()
+        polygon = QgsGeometry.fromWkt('POLYGON(({x0} {y}, {x} {y1}, {x2} {y}, {x} {y0}, {x0} {y}))'.format(
+            x0=extent.xMinimum(), x=center.x(), x2=extent.xMaximum(),
+            y0=extent.yMinimum(), y=center.y(), y1=extent.yMaximum()))
+        search = polygon.boundingBox()
+        rectangle = (search.xMinimum(), search.yMinimum(), search.xMaximum(), search.yMaximum())
+        wkb = bytes(polygon.asWkb())
+
+        expected = tile_features_ids(str(path), None, 'id', wkb, 'intersects', rectangle)
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), layer.featureCount())
+
+        try:
+            result = parallel_features_ids(str(path), None, 'id', wkb, 'intersects', rectangle, 2)
+        finally:
+            shutdown()
+        self.assertListEqual(sorted(expected), sorted(result))
+
+    def test_broken_pool(self):
+        """ Test the pool is started again after a process died. """
+        layer = QgsVectorLayer(str(BAKERIES), 'bakeries', 'ogr')
+        extent = layer.extent()
+        rectangle = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        wkb = bytes(QgsGeometry.fromRect(extent).asWkb())
+
+        try:
+            # A process of the pool dies
+            with self.assertRaises(BrokenProcessPool):
+                parallel_join._executor(2).submit(os._exit, 1).result()
+
+            with self.assertRaises(BrokenProcessPool):
+                parallel_features_ids(str(BAKERIES), None, 'id', wkb, 'intersects', rectangle, 2)
+            self.assertIsNone(parallel_join._EXECUTOR)
+
+            result = parallel_features_ids(str(BAKERIES), None, 'id', wkb, 'intersects', rectangle, 2)
+            self.assertEqual(layer.featureCount(), len(result))
+        finally:
+            shutdown()
+
+    def test_timeout(self):
+        """ Test the pool is dropped when the timeout is reached. """
+        layer = QgsVectorLayer(str(BAKERIES), 'bakeries', 'ogr')
+        extent = layer.extent()
+        rectangle = (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+        wkb = bytes(QgsGeometry.fromRect(extent).asWkb())
+
+        try:
+            with self.assertRaises(FuturesTimeoutError):
+                parallel_features_ids(str(BAKERIES), None, 'id', wkb, 'intersects', rectangle, 2, timeout=0.000001)
+            self.assertIsNone(parallel_join._EXECUTOR)
+        finally:
+            shutdown()
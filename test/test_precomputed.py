@@ -0,0 +1,95 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the filter by polygon results computed offline. """
+
+import os
+import tempfile
+import time
+import unittest
+
+from qgis.core import NULL, QgsGeometry, QgsVectorLayer
+from qgis.PyQt.QtCore import QDate
+
+from lizmap_server.precomputed import (
+    CACHE_TTL,
+    PRECOMPUTED,
+    SIDECAR_SUFFIX,
+    PrecomputeError,
+    precomputed,
+    project_checksum,
+    storable_ids,
+    write_precomputed,
+)
+
+
+class TestPrecomputed(unittest.TestCase):
+
+    def setUp(self) -> None:
+        PRECOMPUTED.clear()
+
+    def test_sidecar_file(self):
+        """ Test the results are read from the file, until the project is modified. """
+        polygons = QgsVectorLayer('Polygon?crs=epsg:2154', 'polygons', 'memory')
+        points = QgsVectorLayer('Point?crs=epsg:2154', 'points', 'memory')
+        lines = QgsVectorLayer('LineString?crs=epsg:2154', 'lines', 'memory')
+        square = QgsGeometry.fromWkt('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))')
+
+        with tempfile.TemporaryDirectory() as directory:
+            project_path = os.path.join(directory, 'project.qgs')
+            with open(project_path, 'w') as f:
+                f.write('<qgis/>')
+            with open(project_path + '.cfg', 'w') as f:
+                f.write('{}')
+
+            self.assertIsNone(precomputed(project_path))
+
+            write_precomputed(
+                project_path + SIDECAR_SUFFIX,
+                project_checksum(project_path),
+                {'id': polygons.id(), 'group_field': 'groups', 'stamp': None},
+                {'group_a': bytes(square.asWkb())},
+                {
+                    points.id(): {
+                        'primary_key': 'id', 'stamp': None, 'ids': {'group_a': [3, 1, 2], 'group_b': [2, 5]}},
+                    lines.id(): {'primary_key': 'code', 'stamp': None, 'ids': {'group_a': ['x', 'y']}},
+                },
+            )
+
+            results = precomputed(project_path)
+            self.assertIsNotNone(results)
+            self.assertTrue(results.is_valid_for_polygon_layer(polygons, 'groups'))
+            self.assertFalse(results.is_valid_for_polygon_layer(polygons, 'other_field'))
+
+            self.assertTrue(results.polygon('group_a').equals(square))
+            self.assertTrue(results.polygon('group_c').isEmpty())
+
+            self.assertListEqual([1, 2, 3, 5], results.feature_ids(points, 'id', ('group_a', 'group_b')))
+            self.assertListEqual([], results.feature_ids(points, 'id', ('group_c', )))
+            self.assertIsNone(results.feature_ids(points, 'other_key', ('group_a', )))
+            self.assertListEqual(['x', 'y'], results.feature_ids(lines, 'code', ('group_a', )))
+
+            # An edited layer
+            self.assertEqual(1, results.discard(points.id()))
+            self.assertIsNone(results.feature_ids(points, 'id', ('group_a', )))
+            self.assertListEqual(['x', 'y'], results.feature_ids(lines, 'code', ('group_a', )))
+
+            # Changes of the layers can not be detected, they are trusted during the TTL after the file is written
+            old = time.time() - CACHE_TTL - 10
+            os.utime(project_path + SIDECAR_SUFFIX, (old, old))
+            results = precomputed(project_path)
+            self.assertIsNotNone(results)
+            self.assertFalse(results.is_valid_for_polygon_layer(polygons, 'groups'))
+            self.assertIsNone(results.feature_ids(lines, 'code', ('group_a', )))
+
+            # The Lizmap config is modified
+            with open(project_path + '.cfg', 'w') as f:
+                f.write('{"filter_by_polygon": {}}')
+            self.assertIsNone(precomputed(project_path))
+
+    def test_storable_ids(self):
+        """ Test the primary keys written in the file. """
+        self.assertEqual(([1, 'a', 2.5], 2), storable_ids([1, None, 'a', NULL, 2.5]))
+        with self.assertRaises(PrecomputeError):
+            storable_ids([1, QDate(2022, 1, 1)])
@@ -0,0 +1,94 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the context of a request. """
+
+import os
+import unittest
+
+from lizmap_server.request_context import (
+    ANONYMOUS_GROUPS,
+    build_request_context,
+    request_context,
+    set_request_context,
+)
+
+
+class FakeRequestHandler:
+    """ Headers and parameters of a request. """
+
+    def __init__(self, headers: dict, params: dict):
+        self.headers = headers
+        self.params = params
+
+    def requestHeaders(self) -> dict:
+        return self.headers
+
+    def parameterMap(self) -> dict:
+        return self.params
+
+
+class FakeServerInterface:
+
+    def __init__(self, handler: FakeRequestHandler, config_path: str):
+        self.handler = handler
+        self.config_path = config_path
+
+    def requestHandler(self) -> FakeRequestHandler:
+        return self.handler
+
+    def configFilePath(self) -> str:
+        return self.config_path
+
+
+class TestRequestContext(unittest.TestCase):
+
+    def tearDown(self) -> None:
+        set_request_context(None)
+
+    def test_build_request_context(self):
+        """ Test the context is read from the headers and the parameters. """
+        project_path = os.path.join(os.path.dirname(__file__), 'data', 'france_parts_liz.qgs')
+        iface = FakeServerInterface(
+            FakeRequestHandler(
+                {'X-Lizmap-User-Groups': 'group_b, group_a, group_b', 'X-Lizmap-User': 'alice'},
+                {'SERVICE': 'WMS', 'REQUEST': 'GetLegendGraphic', 'LIZMAP_OVERRIDE_FILTER': 'true'},
+            ),
+            project_path,
+        )
+        context = build_request_context(iface)
+        self.assertEqual(frozenset(['group_a', 'group_b']), context.groups)
+        self.assertEqual('alice', context.login)
+        self.assertTrue(context.override)
+        self.assertFalse(context.editing)
+        self.assertIsNone(context.extent)
+        self.assertEqual(project_path, context.config_path)
+        self.assertIsNotNone(context.config)
+        self.assertIs(context.config, context.compiled.config)
+
+        # Immutable
+        with self.assertRaises(AttributeError):
+            # noinspection PyPropertyAccess
+            context.login = 'bob'
+
+        anonymous = build_request_context(
+            FakeServerInterface(FakeRequestHandler({'X-Lizmap-User-Groups': ''}, {}), project_path))
+        self.assertEqual(ANONYMOUS_GROUPS, anonymous.groups)
+        self.assertFalse(anonymous.override)
+
+    def test_current_request_context(self):
+        """ Test the context of the request is used while the request is processed. """
+        iface = FakeServerInterface(FakeRequestHandler({'X-Lizmap-User-Groups': 'group_a'}, {}), '/tmp/a.qgs')
+        context = build_request_context(iface)
+        set_request_context(context)
+        self.assertIs(context, request_context(iface))
+
+        # Another project
+        other = FakeServerInterface(FakeRequestHandler({'X-Lizmap-User-Groups': 'group_b'}, {}), '/tmp/b.qgs')
+        self.assertEqual(frozenset(['group_b']), request_context(other).groups)
+
+        # The response is complete
+        set_request_context(None)
+        self.assertIsNot(context, request_context(iface))
+        self.assertEqual(frozenset(['group_a']), request_context(iface).groups)
@@ -1,17 +1,21 @@
 """Test tools."""
 
+import json
 import os
+import tempfile
 import unittest
 import xml.etree.ElementTree as ET
 
 from qgis.core import QgsField, QgsFields
 from qgis.PyQt.QtCore import QVariant
 
+from lizmap_server import core
 from lizmap_server.core import (
     _server_feature_id_expression,
     get_lizmap_config,
     get_lizmap_layer_login_filter,
     get_lizmap_layers_config,
+    get_request_extent,
 )
 from lizmap_server.get_feature_info import GetFeatureInfoFilter
 from lizmap_server.tools import to_bool
@@ -21,6 +25,16 @@ __license__ = 'GPL version 3'
 __email__ = 'info@3liz.org'
 
 
+class FakeRequestHandler:
+    """ Only the parameters of a request. """
+
+    def __init__(self, params: dict):
+        self.params = params
+
+    def parameterMap(self) -> dict:
+        return self.params
+
+
 class TestServerCore(unittest.TestCase):
 
     def test_config_value_to_boolean(self):
@@ -45,6 +59,37 @@ class TestServerCore(unittest.TestCase):
         qgis_project_path = os.path.join(data_path, 'france_parts_liz.qgs')
         self.assertIsNotNone(get_lizmap_config(qgis_project_path))
 
+    def test_lizmap_config_store(self):
+        """ Test the lizmap config is read again when the CFG file is modified """
+        interval = core.CONFIG_CHECK_INTERVAL
+        self.addCleanup(setattr, core, 'CONFIG_CHECK_INTERVAL', interval)
+
+        with tempfile.TemporaryDirectory() as directory:
+            qgis_project_path = os.path.join(directory, 'project.qgs')
+            with open(qgis_project_path, 'w') as f:
+                f.write('<qgis/>')
+            with open(qgis_project_path + '.cfg', 'w') as f:
+                json.dump({'options': {}}, f)
+
+            core.CONFIG_CHECK_INTERVAL = 60
+            config = get_lizmap_config(qgis_project_path)
+            self.assertEqual({'options': {}}, config)
+            self.assertIs(config, get_lizmap_config(qgis_project_path))
+
+            with open(qgis_project_path + '.cfg', 'w') as f:
+                json.dump({'options': {'acl': ['admins']}}, f)
+
+            # Not checked again yet
+            self.assertIs(config, get_lizmap_config(qgis_project_path))
+
+            core.CONFIG_CHECK_INTERVAL = 0
+            self.assertEqual({'options': {'acl': ['admins']}}, get_lizmap_config(qgis_project_path))
+            self.assertEqual(frozenset(['admins']), core.get_lizmap_compiled_config(qgis_project_path).acl)
+
+            os.remove(qgis_project_path + '.cfg')
+            self.assertIsNone(get_lizmap_config(qgis_project_path))
+            self.assertIsNone(core.get_lizmap_compiled_config(qgis_project_path))
+
     def test_get_lizmap_layers_config(self):
         """ Test get layers Lizmap config """
 
@@ -140,6 +185,57 @@ class TestServerCore(unittest.TestCase):
                 'order': 0
             })
 
+    def test_get_request_extent(self):
+        """ Test the extent of a request, with a margin. """
+        # Not a request with an extent
+        self.assertIsNone(get_request_extent(FakeRequestHandler({'SERVICE': 'WMS', 'REQUEST': 'GetLegendGraphic'})))
+        self.assertIsNone(get_request_extent(FakeRequestHandler({'SERVICE': 'WFS', 'REQUEST': 'GetFeature'})))
+
+        # WMS 1.3.0 with inverted axis
+        extent = get_request_extent(FakeRequestHandler({
+            'SERVICE': 'WMS',
+            'REQUEST': 'GetMap',
+            'VERSION': '1.3.0',
+            'CRS': 'EPSG:4326',
+            'BBOX': '40,0,44,8',
+        }))
+        self.assertEqual('EPSG:4326', extent.crs().authid())
+        self.assertEqual('-2,39,10,45', ','.join([str(round(v)) for v in (
+            extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())]))
+
+        # GetFeatureInfo around the point
+        extent = get_request_extent(FakeRequestHandler({
+            'SERVICE': 'WMS',
+            'REQUEST': 'GetFeatureInfo',
+            'VERSION': '1.3.0',
+            'CRS': 'EPSG:2154',
+            'BBOX': '0,0,1000,1000',
+            'WIDTH': '1000',
+            'HEIGHT': '1000',
+            'I': '499.5',
+            'J': '499.5',
+        }))
+        self.assertEqual('404,404,596,596', ','.join([str(round(v)) for v in (
+            extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())]))
+
+        # GetFeatureInfo with a filter
+        self.assertIsNone(get_request_extent(FakeRequestHandler({
+            'SERVICE': 'WMS',
+            'REQUEST': 'GetFeatureInfo',
+            'CRS': 'EPSG:2154',
+            'BBOX': '0,0,1000,1000',
+            'FILTER': 'layer:"id" = 1',
+        })))
+
+        # WFS with a BBOX
+        extent = get_request_extent(FakeRequestHandler({
+            'SERVICE': 'WFS',
+            'REQUEST': 'GetFeature',
+            'BBOX': '0,0,1000,1000,EPSG:2154',
+        }))
+        self.assertEqual('EPSG:2154', extent.crs().authid())
+        self.assertEqual(-250, extent.xMinimum())
+
     def test_parse_xml_get_feature_info(self):
         """ Test to GetFeatureInfo XML. """
         string = '''<GetFeatureInfoResponse>
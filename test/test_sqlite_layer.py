@@ -0,0 +1,117 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test SQLite queries on GeoPackage layers. """
+
+import struct
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsGeometry,
+    QgsRectangle,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    edit,
+)
+
+from lizmap_server.sqlite_layer import (
+    gpkg_geometry_to_wkb,
+    gpkg_points_xy,
+    sqlite_features_ids,
+)
+from lizmap_server.vectorized import HAS_NUMPY, HAS_SHAPELY
+
+
+class TestSqliteLayer(unittest.TestCase):
+
+    def test_gpkg_geometry_to_wkb(self):
+        """ Test reading the WKB of a GeoPackage geometry. """
+        wkb = bytes(QgsGeometry.fromWkt('POINT(1 2)').asWkb())
+
+        # Without envelope
+        blob = b'GP' + bytes([0, 0x01]) + struct.pack('<i', 4326) + wkb
+        self.assertEqual(wkb, gpkg_geometry_to_wkb(blob))
+
+        # With a XY envelope
+        blob = b'GP' + bytes([0, 0x03]) + struct.pack('<i', 4326) + struct.pack('<4d', 1, 1, 2, 2) + wkb
+        self.assertEqual(wkb, gpkg_geometry_to_wkb(blob))
+
+        with self.assertRaises(ValueError):
+            gpkg_geometry_to_wkb(wkb)
+
+    @unittest.skipIf(not HAS_NUMPY, 'NumPy is not installed')
+    def test_gpkg_points_xy(self):
+        """ Test reading the coordinates of GeoPackage points at once. """
+        def point(x, y, flags=0x01, envelope=b'', order='<'):
+            wkb = struct.pack(order + 'bIdd', 1 if order == '<' else 0, 1, x, y)
+            return b'GP' + bytes([0, flags]) + struct.pack('<i', 4326) + envelope + wkb
+
+        # Same header, read at once
+        x, y = gpkg_points_xy([point(1, 2), point(3, 4)])
+        self.assertListEqual([1, 3], x.tolist())
+        self.assertListEqual([2, 4], y.tolist())
+
+        # With a XY envelope
+        x, y = gpkg_points_xy([point(1, 2, 0x03, struct.pack('<4d', 1, 1, 2, 2))])
+        self.assertListEqual([1], x.tolist())
+        self.assertListEqual([2], y.tolist())
+
+        # Mixed headers, big endian and empty point, one by one
+        x, y = gpkg_points_xy([
+            point(1, 2), point(3, 4, 0x03, struct.pack('<4d', 3, 3, 4, 4)), point(5, 6, order='>'),
+            point(float('nan'), float('nan'), 0x11)])
+        self.assertListEqual([1, 3, 5], x.tolist()[0:3])
+        self.assertListEqual([2, 4, 6], y.tolist()[0:3])
+        self.assertNotEqual(x[3], x[3])
+
+        x, y = gpkg_points_xy([])
+        self.assertEqual(0, len(x))
+
+    def test_gpkg_features_ids(self):
+        """ Test the candidates from the R-Tree, checked with the polygon. """
+        points = QgsVectorLayer('Point?crs=epsg:4326&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(1 1)'), (2, 'POINT(10 10)'), (3, 'POINT(4 0.5)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory).joinpath('points.gpkg'))
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            options.layerName = 'points'
+            result = QgsVectorFileWriter.writeAsVectorFormatV2(
+                points, path, QgsCoordinateTransformContext(), options)
+            self.assertEqual(QgsVectorFileWriter.NoError, result[0])
+
+            layer = QgsVectorLayer('{}|layername=points'.format(path), 'points', 'ogr')
+            self.assertTrue(layer.isValid())
+
+            # A triangle, the point 3 is in the bounding box only
+            polygon = QgsGeometry.fromWkt('POLYGON((0 0,0 5,5 5,0 0))')
+            engine = QgsGeometry.createGeometryEngine(polygon.constGet())
+            engine.prepareGeometry()
+
+            ids = sqlite_features_ids(layer, 'id', polygon.boundingBox(), polygon, engine, 'intersects')
+            self.assertListEqual([1], ids)
+
+            ids = sqlite_features_ids(layer, 'id', QgsRectangle(2, 2, 3, 3), polygon, engine, 'intersects')
+            self.assertListEqual([], ids)
+
+            if HAS_SHAPELY:
+                # Same result with the bulk test, the point 1 on the boundary too
+                ids = sqlite_features_ids(
+                    layer, 'id', polygon.boundingBox(), polygon, engine, 'intersects', True)
+                self.assertListEqual([1], ids)
+
+            # Memory layers can not be queried
+            self.assertIsNone(
+                sqlite_features_ids(points, 'id', polygon.boundingBox(), polygon, engine, 'intersects'))
@@ -0,0 +1,259 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the parsing of WFS Transaction. """
+
+import tempfile
+import unittest
+
+from pathlib import Path
+
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsGeometry,
+    QgsProject,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    edit,
+)
+
+from lizmap_server.change_detection import layer_stamp
+from lizmap_server.filter_by_polygon import (
+    FEATURE_IDS_CACHE,
+    SUBSET_CACHE,
+    FilterByPolygon,
+)
+from lizmap_server.transaction_filter import (
+    Action,
+    edited_layers,
+    invalidate_transaction,
+    parse_transaction,
+    parse_transaction_parameters,
+    parse_transaction_response,
+)
+
+
+class TestTransactionFilter(unittest.TestCase):
+
+    def test_parse_transaction(self):
+        """ Test the operations are read from the XML. """
+        data = b"""<?xml version="1.0" encoding="UTF-8"?>
+        <wfs:Transaction service="WFS" version="1.0.0"
+            xmlns:wfs="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc"
+            xmlns:qgs="http://www.qgis.org/gml">
+          <wfs:Insert>
+            <qgs:townhalls_EPSG2154>
+              <qgs:name>Paris</qgs:name>
+              <qgs:polygon_group>group_a,group_b</qgs:polygon_group>
+            </qgs:townhalls_EPSG2154>
+          </wfs:Insert>
+          <wfs:Update typeName="qgs:townhalls_EPSG2154">
+            <wfs:Property>
+              <wfs:Name>polygon_group</wfs:Name>
+              <wfs:Value>group_c</wfs:Value>
+            </wfs:Property>
+            <ogc:Filter>
+              <ogc:FeatureId fid="townhalls_EPSG2154.1"/>
+              <ogc:FeatureId fid="townhalls_EPSG2154.2"/>
+            </ogc:Filter>
+          </wfs:Update>
+          <wfs:Delete typeName="qgs:shop_bakery">
+            <ogc:Filter>
+              <ogc:PropertyIsEqualTo>
+                <ogc:PropertyName>name</ogc:PropertyName>
+                <ogc:Literal>Paris</ogc:Literal>
+              </ogc:PropertyIsEqualTo>
+            </ogc:Filter>
+          </wfs:Delete>
+        </wfs:Transaction>
+        """
+        actions = parse_transaction(data)
+        self.assertEqual(3, len(actions))
+
+        self.assertEqual('Insert', actions[0].operation)
+        self.assertEqual('townhalls_EPSG2154', actions[0].type_name)
+        self.assertEqual('group_a,group_b', actions[0].values['polygon_group'])
+
+        self.assertEqual('Update', actions[1].operation)
+        self.assertEqual('townhalls_EPSG2154', actions[1].type_name)
+        self.assertListEqual(['1', '2'], actions[1].feature_ids)
+        self.assertDictEqual({'polygon_group': 'group_c'}, actions[1].values)
+
+        # Not selected by feature IDs
+        self.assertEqual('Delete', actions[2].operation)
+        self.assertEqual('shop_bakery', actions[2].type_name)
+        self.assertIsNone(actions[2].feature_ids)
+
+    def test_parse_transaction_response(self):
+        """ Test the IDs of the inserted features are read from the response. """
+        data = b"""<?xml version="1.0" encoding="UTF-8"?>
+        <WFS_TransactionResponse version="1.0.0"
+            xmlns="http://www.opengis.net/wfs" xmlns:ogc="http://www.opengis.net/ogc">
+          <InsertResult>
+            <ogc:FeatureId fid="townhalls_EPSG2154.12"/>
+            <ogc:FeatureId fid="townhalls_EPSG2154.13"/>
+          </InsertResult>
+          <TransactionResult>
+            <Status><SUCCESS/></Status>
+          </TransactionResult>
+        </WFS_TransactionResponse>
+        """
+        self.assertDictEqual({'townhalls_EPSG2154': ['12', '13']}, parse_transaction_response(data))
+        self.assertDictEqual({}, parse_transaction_response(b'Not XML'))
+
+    def test_parse_transaction_parameters(self):
+        """ Test the operation is read from the key value parameters. """
+        actions = parse_transaction_parameters({
+            'OPERATION': 'DELETE',
+            'FEATUREID': 'townhalls_EPSG2154.1,townhalls_EPSG2154.3',
+        })
+        self.assertEqual(1, len(actions))
+        self.assertEqual('Delete', actions[0].operation)
+        self.assertEqual('townhalls_EPSG2154', actions[0].type_name)
+        self.assertListEqual(['1', '3'], actions[0].feature_ids)
+
+        self.assertListEqual([], parse_transaction_parameters({}))
+
+    # noinspection PyArgumentList
+    def test_invalidate_transaction(self):
+        """ Test only the results of the groups touching the edited features are removed. """
+        polygon = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygon):
+            for wkt, groups in (
+                    ('POLYGON((0 0,0 5,5 5,5 0,0 0))', 'east'),
+                    ('POLYGON((0 0,0 -5,-5 -5,-5 0,0 0))', 'west')):
+                feature = QgsFeature(polygon.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([1, groups])
+                self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer('Point?crs=epsg:4326&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(1 1)'), (2, 'POINT(-1 -1)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        config = {
+            "config": {"polygon_layer_id": polygon.id(), "group_field": "groups"},
+            "layers": [{"layer": points.id(), "primary_key": "id", "spatial_relationship": "intersects"}],
+        }
+
+        project = QgsProject.instance()
+        project.addMapLayers([polygon, points])
+
+        def cached_groups() -> list:
+            return sorted(key[3] for key, _ in SUBSET_CACHE.items(lambda key: key[4] == points.id()))
+
+        try:
+            for groups in (('east', ), ('west', )):
+                FilterByPolygon(config, points).subset_sql(groups)
+            self.assertListEqual([('east', ), ('west', )], cached_groups())
+
+            # A point moved in the polygon of the group east
+            actions = [Action('Update', 'points', ['1'], {})]
+            edits = edited_layers(project, config, actions)
+            with edit(points):
+                points.changeGeometry(1, QgsGeometry.fromWkt('POINT(2 2)'))
+            self.assertGreater(invalidate_transaction(project, config, actions, edits, {}), 0)
+            self.assertListEqual([('west', )], cached_groups())
+
+            # A new point, outside all polygons
+            FilterByPolygon(config, points).subset_sql(('east', ))
+            actions = [Action('Insert', 'points', [], {'id': '3'})]
+            edits = edited_layers(project, config, actions)
+            with edit(points):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt('POINT(10 10)'))
+                feature.setAttributes([3])
+                self.assertTrue(points.addFeature(feature))
+            fid = str(max(points.allFeatureIds()))
+            invalidate_transaction(project, config, actions, edits, {'points': [fid]})
+            self.assertListEqual([('east', ), ('west', )], cached_groups())
+
+            # Without the ID of the inserted feature, all results of the layer
+            edits = edited_layers(project, config, actions)
+            invalidate_transaction(project, config, actions, edits, {})
+            self.assertListEqual([], cached_groups())
+
+            # The polygon of the group west is deleted, its groups are read before
+            for groups in (('east', ), ('west', )):
+                FilterByPolygon(config, points).subset_sql(groups)
+            actions = [Action('Delete', 'polygon', ['2'], {})]
+            edits = edited_layers(project, config, actions)
+            with edit(polygon):
+                polygon.deleteFeature(2)
+            invalidate_transaction(project, config, actions, edits, {})
+            self.assertListEqual([('east', )], cached_groups())
+        finally:
+            project.clear()
+
+    # noinspection PyArgumentList
+    def test_invalidate_polygon_geopackage(self):
+        """ Test the results of the groups not edited are still used after an edit of a GeoPackage polygon layer. """
+        polygons = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer&field=groups:string', 'polygon', 'memory')
+        with edit(polygons):
+            for wkt, groups in (
+                    ('POLYGON((0 0,0 5,5 5,5 0,0 0))', 'east'),
+                    ('POLYGON((0 0,0 -5,-5 -5,-5 0,0 0))', 'west')):
+                feature = QgsFeature(polygons.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([1, groups])
+                self.assertTrue(polygons.addFeature(feature))
+
+        points = QgsVectorLayer('Point?crs=epsg:4326&field=id:integer', 'points', 'memory')
+        with edit(points):
+            for fid, wkt in ((1, 'POINT(1 1)'), (2, 'POINT(-1 -1)')):
+                feature = QgsFeature(points.fields())
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                feature.setAttributes([fid])
+                self.assertTrue(points.addFeature(feature))
+
+        project = QgsProject.instance()
+        with tempfile.TemporaryDirectory() as directory:
+            path = str(Path(directory).joinpath('polygon.gpkg'))
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = 'GPKG'
+            options.layerName = 'polygon'
+            result = QgsVectorFileWriter.writeAsVectorFormatV2(
+                polygons, path, QgsCoordinateTransformContext(), options)
+            self.assertEqual(QgsVectorFileWriter.NoError, result[0])
+
+            polygon = QgsVectorLayer('{}|layername=polygon'.format(path), 'polygon', 'ogr')
+            self.assertTrue(polygon.isValid())
+            project.addMapLayers([polygon, points])
+
+            config = {
+                "config": {"polygon_layer_id": polygon.id(), "group_field": "groups"},
+                "layers": [{"layer": points.id(), "primary_key": "id", "spatial_relationship": "intersects"}],
+            }
+
+            try:
+                for groups in (('east', ), ('west', )):
+                    FilterByPolygon(config, points).subset_sql(groups)
+
+                # The polygon of the group east is edited, the file is written
+                east = [f.id() for f in polygon.getFeatures() if f['groups'] == 'east'][0]
+                actions = [Action('Update', 'polygon', [str(east)], {})]
+                edits = edited_layers(project, config, actions)
+                stamp = layer_stamp(polygon)
+                with edit(polygon):
+                    polygon.changeGeometry(east, QgsGeometry.fromWkt('POLYGON((0 0,0 6,6 6,6 0,0 0))'))
+                self.assertNotEqual(stamp, layer_stamp(polygon))
+                invalidate_transaction(project, config, actions, edits, {})
+
+                cached = SUBSET_CACHE.items(lambda key: key[4] == points.id())
+                self.assertListEqual([('west', )], [key[3] for key, _ in cached])
+                self.assertEqual(layer_stamp(polygon), cached[0][1].stamp[1])
+
+                # Still found in the cache, the feature IDs are not computed again
+                info = FEATURE_IDS_CACHE.info()
+                FilterByPolygon(config, points).subset_sql(('west', ))
+                self.assertEqual(info.misses, FEATURE_IDS_CACHE.info().misses)
+                FilterByPolygon(config, points).subset_sql(('east', ))
+                self.assertEqual(info.misses + 1, FEATURE_IDS_CACHE.info().misses)
+            finally:
+                project.clear()
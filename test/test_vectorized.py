@@ -0,0 +1,42 @@
+__copyright__ = 'Copyright 2022, 3Liz'
+__license__ = 'GPL version 3'
+__email__ = 'info@3liz.org'
+
+""" Test the bulk point in polygon tests. """
+
+import unittest
+
+from qgis.core import QgsGeometry
+
+from lizmap_server.vectorized import (
+    HAS_NUMPY,
+    points_in_polygon,
+    polygon_rings,
+    ray_casting,
+)
+
+if HAS_NUMPY:
+    import numpy
+
+
+@unittest.skipIf(not HAS_NUMPY, 'NumPy is not installed')
+class TestVectorized(unittest.TestCase):
+
+    def test_points_in_polygon(self):
+        """ Test points in a multi polygon with a hole. """
+        polygon = QgsGeometry.fromWkt(
+            'MultiPolygon (((0 0, 0 10, 10 10, 10 0, 0 0), (4 4, 4 6, 6 6, 6 4, 4 4)),'
+            '((20 0, 20 5, 25 0, 20 0)))')
+        x = [1, 5, 11, 21, 24, -1]
+        y = [1, 5, 5, 1, 4, -1]
+        expected = [True, False, False, True, False, False]
+
+        self.assertListEqual(expected, [bool(v) for v in points_in_polygon(polygon, x, y)])
+
+        # Same result without Shapely
+        result = ray_casting(polygon_rings(polygon), numpy.array(x, dtype=float), numpy.array(y, dtype=float))
+        self.assertListEqual(expected, [bool(v) for v in result])
+
+        # Single polygon
+        polygon = QgsGeometry.fromWkt('Polygon ((0 0, 0 10, 10 10, 10 0, 0 0))')
+        self.assertListEqual([True, False], [bool(v) for v in points_in_polygon(polygon, [5, 15], [5, 5])])